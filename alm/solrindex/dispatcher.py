@@ -0,0 +1,299 @@
+
+"""Sending index changes to Solr, in the foreground or background"""
+
+from alm.solrindex.querycache import query_cache
+from alm.solrindex.shards import make_connection
+from alm.solrindex.solrpycore import PoolTimeout
+from alm.solrindex.solrpycore import SolrConnection
+from alm.solrindex.solrpycore import SolrException
+import atexit
+import httplib
+import logging
+import os
+import Queue
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+commit_strategies = ('hard', 'soft', 'within', 'none')
+
+
+class CommitPolicy(object):
+    """How changes sent to Solr get committed.
+
+    strategy is one of:
+
+    'hard'    Send a commit after the changes (the default).
+    'soft'    Send a soft commit, which makes the changes searchable
+              without flushing them to disk (Solr 4.0+).
+    'within'  Ask Solr to commit the changes within `within`
+              milliseconds, so Solr can group the commits of many
+              transactions.
+    'none'    Leave committing to Solr's autoCommit settings.
+
+    wait_flush and wait_searcher are passed to SolrConnection.commit().
+    """
+
+    def __init__(self, strategy='hard', within=1000, wait_flush=True,
+                 wait_searcher=True):
+        if strategy not in commit_strategies:
+            raise ValueError("Unknown commit strategy: %r" % (strategy,))
+        self.strategy = strategy
+        self.within = within
+        self.wait_flush = wait_flush
+        self.wait_searcher = wait_searcher
+
+    @classmethod
+    def from_settings(cls, obj):
+        """Make a policy from the settings of a SolrIndex"""
+        return cls(obj.commit_strategy, obj.commit_within, obj.wait_flush,
+                   obj.wait_searcher)
+
+    def matches(self, obj):
+        """Does this policy have the settings of a SolrIndex?"""
+        return self._key() == (obj.commit_strategy, obj.commit_within,
+                               obj.wait_flush, obj.wait_searcher)
+
+    def _key(self):
+        return (self.strategy, self.within, self.wait_flush,
+                self.wait_searcher)
+
+    def __eq__(self, other):
+        return isinstance(other, CommitPolicy) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @property
+    def commit_within(self):
+        """The commitWithin to send with updates, or None"""
+        if self.strategy == 'within':
+            return self.within
+        return None
+
+    @property
+    def visibility_delay(self):
+        """Seconds until committed changes are searchable, or None if
+        that is up to Solr's configuration"""
+        if self.strategy == 'within':
+            return self.within / 1000.0
+        if self.strategy in ('hard', 'soft') and self.wait_searcher:
+            return 0
+        return None
+
+    def commit(self, connection):
+        """Commit the changes sent over connection, if needed"""
+        if self.strategy in ('hard', 'soft'):
+            connection.commit(
+                wait_flush=self.wait_flush, wait_searcher=self.wait_searcher,
+                soft_commit=(self.strategy == 'soft'))
+
+
+def send_changes(connection, changes, batch_size=100, commit_within=None):
+    """Send a list of (method name, argument) changes in batches"""
+    kw = {}
+    if commit_within is not None:
+        kw['commit_within'] = commit_within
+    for i in range(0, len(changes), batch_size):
+        connection.begin_batch()
+        docs = []
+        for method, arg in changes[i:i + batch_size]:
+            if method == 'add':
+                docs.append(arg)
+                continue
+            if docs:
+                connection.add_many(docs, **kw)
+                docs = []
+            getattr(connection, method)(arg, **kw)
+        if docs:
+            connection.add_many(docs, **kw)
+        connection.end_batch()
+
+
+def retriable(exc):
+    """Can sending the same changes again succeed after exc?
+
+    Solr being unreachable, overloaded or failing (5xx) is temporary.
+    A request Solr rejects (4xx) or answers with something unparsable
+    will fail the same way again.
+    """
+    if isinstance(exc, PoolTimeout):
+        return True
+    if isinstance(exc, SolrException):
+        return isinstance(exc.httpcode, int) and exc.httpcode >= 500
+    return isinstance(exc, (IOError, httplib.HTTPException))
+
+
+class UpdateDispatcher(object):
+    """Sends committed index changes to Solr from worker threads.
+
+    SolrConnectionManagers in asynchronous mode call dispatch() once the
+    ZODB transaction has committed, so the request thread does not wait
+    for Solr. All transactions for one Solr URI go to the same worker,
+    so they reach Solr in commit order. Each worker has a bounded queue:
+    when it falls behind by `queue_size` transactions, dispatch() blocks
+    until there is room. Each worker keeps its own SolrConnection per
+    Solr URI.
+
+    When sending fails in a way that may pass (see retriable()), the
+    worker sends the transaction again after `retry_delay` seconds,
+    doubling the delay up to `max_retry_delay`, and holds back the
+    later transactions of its queue until it succeeds or shutdown()
+    is called. Once a Solr URI has been failing for `max_retry_time`
+    seconds, its transactions are tried only once until one of them
+    succeeds, so the queue keeps moving for the other URIs of the
+    worker. Failures that are not retried are logged and counted in
+    `failed`.
+    """
+
+    def __init__(self, workers=2, queue_size=100,
+                 connection_factory=SolrConnection, retry_delay=1.0,
+                 max_retry_delay=60.0, max_retry_time=300.0):
+        self.workers = workers
+        self.connection_factory = connection_factory
+        self.queues = [Queue.Queue(queue_size) for i in range(workers)]
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retry_time = max_retry_time
+        self._outages = {}  # {solr_uri: time it started failing}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._lock.acquire()
+        try:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for i, queue in enumerate(self.queues):
+                thread = threading.Thread(
+                    target=self._run, args=(queue,),
+                    name='SolrIndex update %d' % i)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def queue_for(self, solr_uri):
+        """Return the queue of the worker that sends to solr_uri"""
+        return self.queues[
+            (zlib.crc32(solr_uri) & 0xffffffff) % len(self.queues)]
+
+    def dispatch(self, solr_uri, response_format, changes, batch_size=100,
+                 commit_policy=None, update_format='xml', shard_uris=()):
+        """Queue a committed transaction's changes for sending to Solr"""
+        if commit_policy is None:
+            commit_policy = CommitPolicy()
+        if not self._threads:
+            self.start()
+        self.queue_for(solr_uri).put(
+            (solr_uri, response_format, changes, batch_size,
+             commit_policy, update_format, tuple(shard_uris)))
+
+    def _run(self, queue):
+        connections = {}
+        while True:
+            job = queue.get()
+            try:
+                if job is None:
+                    break
+                self._send(job, connections)
+            except Exception:
+                # Keep the worker alive for the jobs behind this one.
+                self.failed += 1
+                log.exception("Unexpected error sending changes to Solr")
+            finally:
+                queue.task_done()
+        for c in connections.values():
+            c.close()
+
+    def _send(self, job, connections):
+        """Send a job, retrying until it is sent or cannot be"""
+        (solr_uri, response_format, changes, batch_size,
+         commit_policy, update_format, shard_uris) = job
+        key = (solr_uri, response_format, update_format, shard_uris)
+        delay = self.retry_delay
+        while True:
+            try:
+                c = connections.get(key)
+                if c is None:
+                    c = connections[key] = make_connection(
+                        solr_uri, shard_uris, self.connection_factory,
+                        response_format=response_format,
+                        update_format=update_format)
+                send_changes(c, changes, batch_size,
+                             commit_policy.commit_within)
+                commit_policy.commit(c)
+                query_cache.invalidate(
+                    solr_uri, commit_policy.visibility_delay or 0)
+            except Exception, e:
+                # Start over with a clean connection.
+                c = connections.pop(key, None)
+                if c is not None:
+                    c.close()
+                if retriable(e) and not self._stopping.isSet():
+                    now = time.time()
+                    since = self._outages.setdefault(solr_uri, now)
+                    if now - since < self.max_retry_time:
+                        self.retries += 1
+                        log.warning(
+                            "Unable to send %d changes to %s, retrying in "
+                            "%s seconds: %s", len(changes), solr_uri,
+                            delay, e)
+                        self._stopping.wait(delay)
+                        delay = min(delay * 2, self.max_retry_delay)
+                        continue
+                self.failed += 1
+                log.exception(
+                    "Unable to send %d changes to %s",
+                    len(changes), solr_uri)
+            else:
+                self._outages.pop(solr_uri, None)
+                self.sent += 1
+            return
+
+    def flush(self):
+        """Wait until all dispatched changes have been sent"""
+        if self._threads:
+            for queue in self.queues:
+                queue.join()
+
+    def shutdown(self):
+        """Send the remaining changes, then stop the workers.
+
+        Changes that fail are not retried any more.
+        """
+        self._lock.acquire()
+        try:
+            threads = self._threads
+            self._threads = []
+            self._stopping.set()
+            for queue in self.queues:
+                if threads:
+                    queue.put(None)
+            for thread in threads:
+                thread.join()
+        finally:
+            self._lock.release()
+
+
+dispatcher = UpdateDispatcher(
+    workers=int(os.environ.get('SOLR_UPDATE_WORKERS', 2)),
+    queue_size=int(os.environ.get('SOLR_UPDATE_QUEUE_SIZE', 100)),
+    max_retry_time=float(os.environ.get('SOLR_UPDATE_MAX_RETRY_TIME', 300)))
+atexit.register(dispatcher.shutdown)
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(dispatcher.shutdown)
@@ -9,7 +9,7 @@ from Products.PluginIndexes.common.util import parseIndexRequest
 from zope.interface import implements
 import re
 import time
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from DateTime.DateTime import DateTime
 
 # See: http://lucene.apache.org/java/2_4_0/queryparsersyntax.html
@@ -81,7 +81,37 @@ class BoolFieldHandler(DefaultFieldHandler):
             return 'false'
 
 
+# The time parts a rounding clears and the length of one unit
+_date_units = {
+    'second': (('microsecond',), timedelta(seconds=1)),
+    'minute': (('second', 'microsecond'), timedelta(minutes=1)),
+    'hour': (('minute', 'second', 'microsecond'), timedelta(hours=1)),
+    'day': (('hour', 'minute', 'second', 'microsecond'), timedelta(days=1)),
+    }
+
+
 class DateFieldHandler(DefaultFieldHandler):
+    """Handles date fields and date range queries.
+
+    Range queries made from DateTime() differ on every request, so Solr
+    can not reuse their filters. With rounding set to 'second',
+    'minute', 'hour' or 'day', the lower bound of a range is rounded
+    down and the upper bound up to a whole unit. With date_math also
+    set, the bounds are sent as Solr date math relative to NOW, e.g.
+    NOW/DAY-7DAY, so the filter stays the same from one unit to the
+    next.
+
+    To round the ranges of a field, register an instance as an
+    ISolrFieldHandler utility named after the field.
+    """
+
+    def __init__(self, rounding=None, date_math=False):
+        if rounding is not None and rounding not in _date_units:
+            raise ValueError("Unknown rounding: %r" % (rounding,))
+        if date_math and rounding is None:
+            raise ValueError("date_math requires a rounding")
+        self.rounding = rounding
+        self.date_math = date_math
 
     def parse_query(self, field, field_query):
         name = field.name
@@ -94,19 +124,51 @@ class DateFieldHandler(DefaultFieldHandler):
         if query_range is None:
             return super(DateFieldHandler, self).parse_query(field, field_query)
         elif query_range == 'min':
-            min_query = self.convert_one(min(record.keys))
-            return {'fq': u'%s:[%s TO *]' % (name, solr_escape(min_query))}
+            min_query = self.convert_bound(min(record.keys), False)
+            return {'fq': u'%s:[%s TO *]' % (name, min_query)}
         elif query_range == 'max':
-            max_query = self.convert_one(max(record.keys))
-            return {'fq': u'%s:[* TO %s]' % (name, solr_escape(max_query))}
+            max_query = self.convert_bound(max(record.keys), True)
+            return {'fq': u'%s:[* TO %s]' % (name, max_query)}
         elif query_range == 'min:max':
-            min_query = self.convert_one(min(record.keys))
-            max_query = self.convert_one(max(record.keys))
-            return {'fq': u'%s:[%s TO %s]' % (name, solr_escape(min_query), solr_escape(max_query))}
+            min_query = self.convert_bound(min(record.keys), False)
+            max_query = self.convert_bound(max(record.keys), True)
+            return {'fq': u'%s:[%s TO %s]' % (name, min_query, max_query)}
         else:
             raise AssertionError("Invalid range: %s" % range)
 
-    def convert_one(self, value):
+    def convert_bound(self, value, upper):
+        """Convert a range bound to an escaped Solr date or date math"""
+        if self.rounding is None:
+            return solr_escape(self.convert_one(value))
+        cleared, unit = _date_units[self.rounding]
+        dt = self.to_datetime(value)
+        rounded = dt.replace(**dict.fromkeys(cleared, 0))
+        if upper and rounded != dt:
+            rounded += unit
+        if self.date_math:
+            now = self.now().replace(**dict.fromkeys(cleared, 0))
+            count = int((rounded - now).total_seconds() //
+                        unit.total_seconds())
+            math = 'NOW/%s' % self.rounding.upper()
+            if count:
+                math += '%+d%s' % (count, self.rounding.upper())
+            return math
+        seconds = rounded.second + rounded.microsecond / 1e6
+        return solr_escape('%04d-%02d-%02dT%02d:%02d:%06.3fZ' % (
+            rounded.year, rounded.month, rounded.day, rounded.hour,
+            rounded.minute, seconds))
+
+    def now(self):
+        return datetime.utcnow()
+
+    def to_datetime(self, value):
+        """Convert a date value to a naive UTC datetime"""
+        t_tup = self.time_tuple(value)
+        seconds = t_tup[5]
+        microseconds = int(round((seconds - int(seconds)) * 1e6))
+        return datetime(*(tuple(t_tup[:5]) + (int(seconds), microseconds)))
+
+    def time_tuple(self, value):
         if isinstance(value, DateTime):
             t_tup = value.toZone('UTC').parts()
         elif isinstance(value, (float, int, long)):
@@ -121,8 +183,11 @@ class DateFieldHandler(DefaultFieldHandler):
         else:
             # can't interpret
             raise TypeError("Not a date value: %s" % repr(value))
+        return t_tup
 
-        converted = '%04d-%02d-%02dT%02d:%02d:%06.3fZ' % t_tup[:6]
+    def convert_one(self, value):
+        t_tup = self.time_tuple(value)
+        converted = '%04d-%02d-%02dT%02d:%02d:%06.3fZ' % tuple(t_tup[:6])
         return converted
 
 
@@ -150,3 +215,55 @@ class TextFieldHandler(DefaultFieldHandler):
             data_seq = [data]
         res = [self.convert_one(value) for value in data_seq]
         return [" ".join(res)]
+
+
+def _default_converter(handler):
+    convert = handler.convert
+    sub = invalid_xml_re.sub
+
+    def convert_value(value):
+        if type(value) is unicode:
+            return [sub('', value)]
+        return convert(value)
+    return convert_value
+
+
+def _bool_converter(handler):
+    convert = handler.convert
+
+    def convert_value(value):
+        if type(value) is bool:
+            return [value and 'true' or 'false']
+        return convert(value)
+    return convert_value
+
+
+def _date_converter(handler):
+    convert = handler.convert
+    convert_one = handler.convert_one
+
+    def convert_value(value):
+        if isinstance(value, DateTime):
+            return [convert_one(value)]
+        return convert(value)
+    return convert_value
+
+
+_converter_factories = {
+    DefaultFieldHandler: _default_converter,
+    BoolFieldHandler: _bool_converter,
+    DateFieldHandler: _date_converter,
+    }
+
+
+def get_converter(handler):
+    """Return a function that converts values like handler.convert().
+
+    The built-in handlers get a function with a shortcut for the most
+    common type of value. Subclasses may override convert() or
+    convert_one(), so they get their own convert().
+    """
+    factory = _converter_factories.get(type(handler))
+    if factory is None:
+        return handler.convert
+    return factory(handler)
@@ -1,12 +1,13 @@
 """SolrIndex and SolrConnectionManager"""
 import logging
 import os
+import threading
 import transaction
 
 import Globals  # import Zope 2 dependencies in order
 
 from Acquisition import aq_parent
-from BTrees.IIBTree import IIBTree, IISet
+from BTrees.IIBTree import IIBTree, IIBucket, IISet, IITreeSet
 from OFS.PropertyManager import PropertyManager
 from OFS.SimpleItem import SimpleItem
 from Products.PluginIndexes.common.util import parseIndexRequest
@@ -43,16 +44,31 @@ else:
     unregisterCriterion(ATSimpleStringCriterion)
     registerCriterion(ATSimpleStringCriterion, new_indices)
 
+from alm.solrindex.dispatcher import CommitPolicy
+from alm.solrindex.dispatcher import commit_strategies
+from alm.solrindex.dispatcher import dispatcher
+from alm.solrindex.dispatcher import send_changes
 from alm.solrindex.interfaces import ISolrConnectionManager
 from alm.solrindex.interfaces import ISolrIndex
 from alm.solrindex.interfaces import ISolrIndexingWrapper
-from alm.solrindex.schema import SolrSchema
+from alm.solrindex.lazy import LazyResult
+from alm.solrindex.parallel import query_executor
+from alm.solrindex.querycache import canonical_params
+from alm.solrindex.querycache import query_cache
+from alm.solrindex.schema import build_document
+from alm.solrindex.schema import get_schema
+from alm.solrindex.schema import is_sortable
+from alm.solrindex.shards import make_connection
 from alm.solrindex.solrpycore import SolrConnection
+from alm.solrindex.transcode import get_transcoder
 
 disable_solr = os.environ.get('DISABLE_SOLR')
 
 log = logging.getLogger(__name__)
 
+# The result sets ZCatalog passes to _apply_index as candidates
+result_set_types = (IIBTree, IIBucket, IISet, IITreeSet)
+
 
 class SolrIndex(PropertyManager, SimpleItem):
 
@@ -88,6 +104,77 @@ class SolrIndex(PropertyManager, SimpleItem):
         {'id': 'catalog_name', 'type': 'string', 'mode': 'w',
             'description':
             'The name of the catalog this index is attached to.'},
+        {'id': 'response_format', 'type': 'selection', 'mode': 'w',
+            'select_variable': 'response_formats',
+            'description':
+            'The format Solr should use for query responses: "xml" '
+            '(works with any Solr version), "json" (faster to parse) or '
+            '"javabin" (smallest, Solr 4.0+).'},
+        {'id': 'update_format', 'type': 'selection', 'mode': 'w',
+            'select_variable': 'update_formats',
+            'description':
+            'The format of the changes sent to Solr: "xml" (works with '
+            'any Solr version) or "json" (faster to build, Solr 3.1+).'},
+        {'id': 'async_updates', 'type': 'boolean', 'mode': 'w',
+            'description':
+            'Send changes to Solr from a background thread after the '
+            'transaction has committed, instead of making the request '
+            'wait for Solr.'},
+        {'id': 'commit_strategy', 'type': 'selection', 'mode': 'w',
+            'select_variable': 'commit_strategies',
+            'description':
+            'How changes are committed in Solr: "hard" (a commit after '
+            'every transaction), "soft" (a soft commit, Solr 4.0+), '
+            '"within" (Solr commits within commit_within milliseconds) '
+            'or "none" (rely on autoCommit in solrconfig.xml).'},
+        {'id': 'commit_within', 'type': 'int', 'mode': 'w',
+            'description':
+            'Milliseconds within which Solr should commit changes when '
+            'commit_strategy is "within".'},
+        {'id': 'wait_flush', 'type': 'boolean', 'mode': 'w',
+            'description':
+            'Wait for hard and soft commits to be flushed to disk.'},
+        {'id': 'wait_searcher', 'type': 'boolean', 'mode': 'w',
+            'description':
+            'Wait for hard and soft commits to become searchable.'},
+        {'id': 'query_cache_max_age', 'type': 'int', 'mode': 'w',
+            'description':
+            'Seconds to reuse the results of a query from the process-wide '
+            'query cache. 0 disables caching. Commits from this process '
+            'empty the cache; commits from others become visible after '
+            'this many seconds.'},
+        {'id': 'cursor_page_size', 'type': 'int', 'mode': 'w',
+            'description':
+            'If above 0, fetch all matching ids in pages of this many '
+            'with cursorMark deep paging (Solr 4.7+), unless the query '
+            'sets rows, start or sort. 0 sends one query and gets the '
+            'number of rows configured in Solr.'},
+        {'id': 'max_results', 'type': 'int', 'mode': 'w',
+            'description':
+            'The most ids to fetch with cursorMark paging; 0 means '
+            'no limit.'},
+        {'id': 'lazy_page_size', 'type': 'int', 'mode': 'w',
+            'description':
+            'If above 0, and no other index of the catalog takes part '
+            'in a query, fetch the matching ids in pages of this many '
+            'as the catalog needs them instead of all at once.'},
+        {'id': 'candidate_filter_size', 'type': 'int', 'mode': 'w',
+            'description':
+            'If above 0, and the catalog indexes applied before this '
+            'one narrowed a query down to at most this many records, '
+            'send their ids to Solr as a terms filter (Solr 4.10+).'},
+        {'id': 'parallel_queries', 'type': 'boolean', 'mode': 'w',
+            'description':
+            'When a catalog search queries several SolrIndexes that '
+            'have this set, send their queries to Solr at the same time '
+            'instead of one after the other.'},
+        {'id': 'shard_uris', 'type': 'lines', 'mode': 'w',
+            'description':
+            'The URIs of the Solr cores to spread the documents over, '
+            'one per line. Queries go to all of them. Leave empty to '
+            'keep all documents in the core at the Solr URI, which '
+            'otherwise defaults to the first shard and provides the '
+            'schema. Reindex after changing the number of shards.'},
         )
 
     manage_options = PropertyManager.manage_options + SimpleItem.manage_options
@@ -97,6 +184,25 @@ class SolrIndex(PropertyManager, SimpleItem):
     solr_uri_env_var = ''
     expected_encodings = ['utf-8']
     catalog_name = 'portal_catalog'
+    response_format = 'xml'
+    update_format = 'xml'
+    async_updates = False
+    commit_strategy = 'hard'
+    commit_within = 1000
+    wait_flush = True
+    wait_searcher = True
+    query_cache_max_age = 0
+    cursor_page_size = 0
+    max_results = 0
+    lazy_page_size = 0
+    candidate_filter_size = 0
+    parallel_queries = False
+    shard_uris = ()
+
+    # The choices of the selection properties
+    response_formats = ('xml', 'json', 'javabin')
+    update_formats = ('xml', 'json')
+    commit_strategies = commit_strategies
 
     def __init__(self, id, solr_uri_static='', expected_encodings=None,
                  catalog_name=None):
@@ -118,6 +224,8 @@ class SolrIndex(PropertyManager, SimpleItem):
         elif 'solr_uri' in self.__dict__:
             # b/w compat
             return self.__dict__['solr_uri']
+        elif self.shard_uris:
+            return self.shard_uris[0]
         else:
             raise ValueError("No Solr URI provided")
 
@@ -132,7 +240,7 @@ class SolrIndex(PropertyManager, SimpleItem):
         if jar is None or oid is None:
             # Not yet stored in ZODB, so use _v_temp_cm
             manager = self._v_temp_cm
-            if manager is None or manager.solr_uri != self.solr_uri:
+            if manager is None or self._manager_outdated(manager):
                 self._v_temp_cm = manager = ISolrConnectionManager(self)
 
         else:
@@ -141,12 +249,37 @@ class SolrIndex(PropertyManager, SimpleItem):
                 jar.foreign_connections = fc = {}
 
             manager = fc.get(oid)
-            if manager is None or manager.solr_uri != self.solr_uri:
+            if manager is None or self._manager_outdated(manager):
                 manager = ISolrConnectionManager(self)
                 fc[oid] = manager
 
         return manager
 
+    def _manager_outdated(self, manager):
+        """Return True if manager was set up with different settings."""
+        return (manager.solr_uri != self.solr_uri or
+                manager.response_format != self.response_format or
+                manager.update_format != self.update_format or
+                manager.shard_uris != tuple(self.shard_uris) or
+                manager.async_updates != self.async_updates or
+                not manager.commit_policy.matches(self))
+
+    def _updateProperty(self, id, value):
+        # Refuse a choice the connection manager would fail on later.
+        # An empty value (GenericSetup purges properties with one)
+        # restores the default.
+        for prop in self._properties:
+            if prop['id'] == id and prop['type'] == 'selection':
+                if not value:
+                    if id in self.__dict__:
+                        delattr(self, id)
+                    return
+                choices = getattr(self, prop['select_variable'])
+                if value not in choices:
+                    raise ValueError("%s must be one of %s, not %r" % (
+                        id, ', '.join(choices), value))
+        PropertyManager._updateProperty(self, id, value)
+
     def getIndexSourceNames(self):
         """Get a sequence of attribute names that are indexed by the index.
         """
@@ -190,29 +323,42 @@ class SolrIndex(PropertyManager, SimpleItem):
             return 0
 
         cm = self.connection_manager
-        values = {}
-        uniqueKey = cm.schema.uniqueKey
-        values[uniqueKey] = documentId
-        obj = queryAdapter(obj, ISolrIndexingWrapper, default=obj)
+        values = self.get_document(documentId, obj)
+        cm.set_changed()
+        log.debug("indexing %d", documentId)
+        cm.add(values)
+        return 1
 
-        for field in cm.schema.fields:
-            name = field.name
-            if name == uniqueKey:
-                continue
+    def get_document(self, documentId, obj):
+        """Return the Solr document for an object as a mapping.
+
+        The mapping contains the converted value of every schema field
+        the object provides, plus documentId as the unique key.
+        """
+        schema = self.connection_manager.schema
+        plan = schema.indexing_plan()
+        return build_document(documentId, schema.uniqueKey, plan,
+                              self.get_values(obj, plan))
+
+    def get_values(self, obj, plan):
+        """Return the unconverted values of the fields of an indexing plan.
+
+        Attributes are looked up on the ISolrIndexingWrapper of obj and
+        called if callable; byte strings are decoded. build_document()
+        turns the values into a document.
+        """
+        obj = queryAdapter(obj, ISolrIndexingWrapper, default=obj)
+        decode = self._decode_param
+        values = []
+        for name, convert in plan:
             value = getattr(obj, name, None)
             if callable(value):
                 value = value()
             # Decode all strings using list from `expected_encodings`
             if isinstance(value, str):
-                value = self._decode_param(value)
-            value_list = field.handler.convert(value)
-            if value_list:
-                values[name] = value_list
-
-        cm.set_changed()
-        log.debug("indexing %d", documentId)
-        cm.connection.add(**values)
-        return 1
+                value = decode(value)
+            values.append(value)
+        return values
 
     def unindex_object(self, documentId):
         """Remove the documentId from the index."""
@@ -222,11 +368,16 @@ class SolrIndex(PropertyManager, SimpleItem):
         cm = self.connection_manager
         cm.set_changed()
         log.debug("unindexing %d", documentId)
-        cm.connection.delete(documentId)
+        cm.delete(documentId)
 
-    def _apply_index(self, request, cid=''):
+    def _apply_index(self, request, resultset=None):
         """Apply query specified by request, a mapping containing the query.
 
+        resultset holds the records matched by the catalog indexes
+        applied before this one, if any. When there are no more than
+        candidate_filter_size of them, Solr only searches those. Other
+        values, such as the cid older callers pass, mean no candidates.
+
         Returns two objects on success: the resultSet containing the
         matching record numbers, and a tuple containing the names of
         the fields used.
@@ -236,6 +387,27 @@ class SolrIndex(PropertyManager, SimpleItem):
         if disable_solr:
             return None
 
+        if not isinstance(resultset, result_set_types):
+            resultset = None
+        pending = _take_started_query(request, self.getId())
+        if pending is not None:
+            # Another SolrIndex started this query for the same search.
+            query = pending.get()
+        else:
+            query = self._prepare_query(request, resultset)
+            if not isinstance(query, PreparedQuery):
+                return query
+            if self.parallel_queries:
+                self._start_sibling_queries(request, resultset)
+            query.run()
+        return self._finish_query(query)
+
+    def _prepare_query(self, request, resultset):
+        """Build the Solr query for request.
+
+        Returns a PreparedQuery, or what _apply_index should return
+        without asking Solr.
+        """
         cm = self.connection_manager
         q = []           # List of query texts to pass as "q"
         queried = []     # List of field names queried
@@ -313,16 +485,89 @@ class SolrIndex(PropertyManager, SimpleItem):
         if isinstance(solr_params['q'], list):
             solr_params['q'] = ' '.join(solr_params['q'])
 
+        if resultset is not None:
+            if not resultset:
+                return IIBTree(), queried
+            if len(resultset) <= self.candidate_filter_size:
+                self._add_candidate_filter(cm, solr_params, resultset)
+
         # Decode all strings using list from `expected_encodings`,
         # then transcode to UTF-8
+        sort_pushed_down = self._push_down_sort(cm, request, solr_params)
         transcoded_params = self._transcode_params(solr_params)
 
-        log.debug("querying: %r", solr_params)
-        response = cm.connection.query(**transcoded_params)
-        if request.has_key('solr_callback'):
+        lazy = self._use_lazy_result(request, transcoded_params)
+        # Without knowing when this process's commits become
+        # searchable, a stale result could be cached after one.
+        use_cache = (self.query_cache_max_age > 0 and not lazy and
+                     not request.has_key('solr_callback') and
+                     not transcoded_params.get('highlight') and
+                     cm.commit_policy.visibility_delay is not None)
+        if use_cache:
+            # Indexes on the same Solr can fetch different ids, and
+            # the batch decides how much of a sorted result is fetched.
+            cache_key = (self.cursor_page_size, self.max_results,
+                         sort_pushed_down and _batch_start(request),
+                         canonical_params(transcoded_params))
+            cached = query_cache.get(
+                cm.solr_uri, cache_key, self.query_cache_max_age)
+            if cached is not None:
+                return cached
+            generation = query_cache.generation(cm.solr_uri)
+
+        query = PreparedQuery(
+            request, queried, transcoded_params, cm.connection,
+            cm.schema.uniqueKey, self.cursor_page_size, self.max_results)
+        query.callback = request.get('solr_callback')
+        query.sort_pushed_down = sort_pushed_down
+        if lazy:
+            query.lazy_page_size = self.lazy_page_size
+        if use_cache:
+            query.cache_key = cache_key
+            query.generation = generation
+        return query
+
+    def _start_sibling_queries(self, request, resultset):
+        """Start the queries of the other SolrIndexes of the catalog.
+
+        Only indexes with parallel_queries set that the catalog query
+        names take part. Their _apply_index collects the query when the
+        catalog gets to them. The queries run on connections of their
+        own, since the catalog may stop before it collects them.
+        """
+        catalog = get_catalog(self, name=self.catalog_name)
+        if catalog is None:
+            return
+        _cancel_started_queries()
+        started = {}
+        for index in get_solr_indexes(catalog):
+            if (index.getId() == self.getId() or
+                    not index.parallel_queries):
+                continue
+            for name in index.getIndexQueryNames():
+                if request.has_key(name):
+                    break
+            else:
+                continue
+            query = index._prepare_query(request, resultset)
+            if isinstance(query, PreparedQuery):
+                query.connection = index.connection_manager.new_connection()
+                started[index.getId()] = query_executor.submit(query.run)
+        if started:
+            _started.queries = (request, started)
+
+    def _finish_query(self, query):
+        """Handle the response of a query that has run"""
+        request = query.request
+        queried = query.queried
+        result = query.result
+        response = query.response
+        if query.callback is not None:
             # Call a function with the Solr response object
-            callback = request['solr_callback']
-            callback(response)
+            query.callback(response)
+            uniqueKey = query.unique_key
+            for r in response:
+                result[int(r[uniqueKey])] = int(r.get('score', 0) * 1000)
 
         # Since highlighting can be either enabled by default in the Solr
         # config, or as a query parameter we just check to see if the
@@ -352,36 +597,106 @@ class SolrIndex(PropertyManager, SimpleItem):
             else:
                 log.debug("Cannot retrieve catalog '%s', highlighting unavailable",
                           self.catalog_name)
-
-        uniqueKey = cm.schema.uniqueKey
-        result = IIBTree()
-        for r in response:
-            result[int(r[uniqueKey])] = int(r.get('score', 0) * 1000)
+        elif query.cache_key is not None:
+            query_cache.set(
+                self.connection_manager.solr_uri, query.cache_key, result,
+                queried, query.generation)
 
         return result, queried
 
-    def _transcode_params(self, params):
-        transcoded_params = {}
-        for key, val in params.items():
-            enc_val = None
-            if isinstance(val, basestring):
-                enc_val = self._encode_param(val)
-            elif isinstance(val, list):
-                enc_val = []
-                for v in val:
-                    if isinstance(v, basestring):
-                        enc_val.append(self._encode_param(v))
-                    else:
-                        enc_val.append(v)
+    def _add_candidate_filter(self, cm, solr_params, resultset):
+        """Restrict the query to the records in resultset"""
+        fq = '{!terms f=%s}%s' % (
+            cm.schema.uniqueKey, ','.join(map(str, resultset.keys())))
+        v = solr_params.get('fq')
+        if v is None:
+            solr_params['fq'] = fq
+        elif isinstance(v, list):
+            solr_params['fq'] = v + [fq]
+        else:
+            solr_params['fq'] = [v, fq]
+
+    def _use_lazy_result(self, request, params):
+        """Can the result of this query be fetched page by page?
+
+        Only if the catalog uses the result as it is: no other index
+        takes part in the query and the catalog does not sort it.
+        """
+        if (self.lazy_page_size <= 0 or request.has_key('solr_callback') or
+                _sort_arg(request, 'on') or 'rows' in params or
+                'start' in params or 'sort' in params):
+            return False
+        return self._only_index(request)
+
+    def _only_index(self, request):
+        """Is this the only index of the catalog that request queries?"""
+        catalog = get_catalog(self, name=self.catalog_name)
+        if catalog is None:
+            return False
+        for index in catalog.indexes.values():
+            if index.getId() == self.getId():
+                continue
+            names = getattr(index, 'getIndexQueryNames', None)
+            if names is not None:
+                names = names()
             else:
-                enc_val = val
-            transcoded_params[key] = enc_val
-        return transcoded_params
+                names = (index.getId(),)
+            for name in names:
+                if request.has_key(name):
+                    return False
+        return True
+
+    def _push_down_sort(self, cm, request, solr_params):
+        """Let Solr sort and limit the result for the catalog.
+
+        If the catalog query has a sort_limit and sorts on an index
+        that has a field of the same name in Solr, ask Solr for only
+        that many ids, sorted on that field. Ties are broken on the
+        unique key, as the catalog breaks them on the record id. Other
+        indexes would narrow the limited result down further, so this
+        is only done when no other index takes part in the query. The
+        limit is the one the catalog uses, which a b_size overrides.
+        Fields Solr cannot sort on, such as text or multiValued fields,
+        are left to the catalog.
+        """
+        sort_on = _sort_arg(request, 'on')
+        limit = _sort_arg(request, 'limit')
+        if (not sort_on or not limit or not isinstance(sort_on, basestring) or
+                request.has_key('solr_callback') or 'rows' in solr_params or
+                'start' in solr_params or 'sort' in solr_params):
+            return False
+        for field in cm.schema.fields:
+            if field.name == sort_on:
+                break
+        else:
+            return False
+        if not is_sortable(field):
+            return False
+        if cm.shard_uris and not field.stored:
+            # The shards' results are merged on the stored values.
+            return False
+        if not self._only_index(request):
+            return False
+        order = _sort_arg(request, 'order')
+        if (isinstance(order, str) and
+                order.lower() in ('reverse', 'descending')):
+            order = 'desc'
+        else:
+            order = 'asc'
+        solr_params['sort'] = [sort_on, cm.schema.uniqueKey]
+        solr_params['sort_order'] = [order, order]
+        b_size = request.get('b_size', None)
+        if b_size is not None:
+            limit = _batch_start(request) + int(b_size)
+        solr_params['rows'] = int(limit)
+        return True
+
+    def _transcode_params(self, params):
+        return get_transcoder(self.expected_encodings).transcode_params(
+            params)
 
     def _encode_param(self, val):
-        decoded_val = self._decode_param(val)
-        # We don't want to raise a UnicodeEncodeError here
-        return decoded_val.encode('utf-8', 'replace')
+        return get_transcoder(self.expected_encodings).encode(val)
 
     def _decode_param(self, val):
         if isinstance(val, dict):
@@ -389,18 +704,7 @@ class SolrIndex(PropertyManager, SimpleItem):
         elif isinstance(val, list):
             return [self._decode_param(v) for v in val]
         elif isinstance(val, basestring):
-            decoded_val = None
-            for encoding in self.expected_encodings:
-                try:
-                    decoded_val = force_unicode(val, encoding)
-                except UnicodeDecodeError:
-                    continue
-            if decoded_val is None:
-                # Our escape hatch; if none of the expected encodings
-                # work, we fall back to UTF8 and replace characters
-                decoded_val = force_unicode(
-                    val, encoding='utf-8', errors='replace')
-            return decoded_val
+            return get_transcoder(self.expected_encodings).decode(val)
         else:
             return val
 
@@ -426,33 +730,222 @@ class SolrIndex(PropertyManager, SimpleItem):
 
         cm = self.connection_manager
         cm.set_changed()
-        cm.connection.delete_query('*:*')
+        cm.delete_query('*:*')
+
+
+# The queries SolrIndexes started for the current search of each thread:
+# (catalog query, {index id: PendingCall})
+_started = threading.local()
+
+
+def _cancel_started_queries():
+    """Cancel the queries left over from an earlier search"""
+    started = getattr(_started, 'queries', None)
+    if started is not None:
+        _started.queries = None
+        for call in started[1].values():
+            call.cancel()
+
 
+def _take_started_query(request, index_id):
+    """Return the PendingCall of a query started for request, or None"""
+    started = getattr(_started, 'queries', None)
+    if started is None:
+        return None
+    started_request, pending = started
+    if started_request is not request:
+        # Left over from an earlier search
+        _cancel_started_queries()
+        return None
+    call = pending.pop(index_id, None)
+    if not pending:
+        _started.queries = None
+    return call
+
+
+class PreparedQuery(object):
+    """A SolrIndex query that is ready to be sent to Solr.
+
+    run() only uses the connection and the settings copied here, not
+    the index, so it can run in another thread than the request.
+    Afterwards, result holds the ids and scores of the matches and
+    response the last Solr response.
+    """
+
+    callback = None
+    lazy_page_size = 0
+    sort_pushed_down = False
+    cache_key = None
+    generation = None
+
+    def __init__(self, request, queried, params, connection, unique_key,
+                 cursor_page_size=0, max_results=0):
+        self.request = request
+        self.queried = queried
+        self.params = params
+        self.connection = connection
+        self.unique_key = unique_key
+        self.cursor_page_size = cursor_page_size
+        self.max_results = max_results
+        self.result = None
+        self.response = None
+
+    def run(self):
+        log.debug("querying: %r", self.params)
+        params = self.params
+        if self.callback is not None:
+            self.result = IIBTree()
+            self.response = self.connection.query(**params)
+            return self
+        params = dict(params)
+        del params['fields']
+        if self.lazy_page_size:
+            self.result = LazyResult(self.connection, self.unique_key,
+                                     params, self.lazy_page_size)
+            self.response = self.result.response
+        else:
+            # Nobody needs the documents, so stream the ids and scores
+            # straight into the result.
+            self.result = IIBTree()
+            self.response = self._query_ids(self.result, params)
+            if self.sort_pushed_down:
+                self._finish_sorted_result(params)
+        return self
+
+    def _finish_sorted_result(self, params):
+        """Let the catalog count all matches of a sort Solr limited.
+
+        The catalog takes a batch that starts past half of the matches
+        from the end of the reversed sort, so it then gets all matches.
+        """
+        numFound = int(self.response.numFound)
+        if len(self.result) >= numFound:
+            return
+        b_start = _batch_start(self.request)
+        if b_start and b_start > numFound / 2:
+            self.result = IIBTree()
+            self.response = self._query_ids(
+                self.result, dict(params, rows=numFound))
+        else:
+            self.result = SortedResult(self.result)
+            self.result.numFound = numFound
 
-class NoRollbackSavepoint:
+    def _query_ids(self, result, params):
+        """Put the ids and scores of the matches into result.
+
+        Uses cursorMark paging if cursor_page_size is set and the query
+        does not ask for specific rows or a sort order. Returns the
+        last response, with the highlighting of all pages.
+        """
+        page_size = self.cursor_page_size
+        if (page_size <= 0 or 'rows' in params or 'start' in params or
+                'sort' in params):
+            return self.connection.query_ids(
+                unique_key=self.unique_key, result=result, **params)
+
+        # cursorMark needs a sort on the unique key.
+        params = dict(params, sort=self.unique_key, sort_order='asc')
+        cursor = '*'
+        highlighting = {}
+        while True:
+            rows = page_size
+            if self.max_results > 0:
+                rows = min(rows, self.max_results - len(result))
+            before = len(result)
+            response = self.connection.query_ids(
+                unique_key=self.unique_key, result=result, rows=rows,
+                cursorMark=cursor, **params)
+            highlighting.update(getattr(response, 'highlighting', {}))
+            next_cursor = getattr(response, 'nextCursorMark', None)
+            done = (next_cursor is None or next_cursor == cursor or
+                    len(result) - before < rows)
+            if self.max_results > 0 and len(result) >= self.max_results:
+                # Each shard of a sharded connection returns up to rows
+                # matches, so keep the first max_results unique keys.
+                for key in list(result.keys())[self.max_results:]:
+                    del result[key]
+                if not done:
+                    log.warning("Stopped fetching after %d of %s results",
+                                len(result), response.numFound)
+                break
+            if done:
+                break
+            cursor = next_cursor
+        if highlighting:
+            response.highlighting = highlighting
+        return response
+
+
+class SortedResult(IIBTree):
+    """The ids of the first matches in the order Solr sorted them.
+
+    len() is the number of matches in Solr, which the catalog uses as
+    the actual_result_count of a search.
+    """
+
+    numFound = 0
+
+    def __len__(self):
+        return self.numFound
+
+
+class Savepoint:
+    """Restores the changes a SolrConnectionManager had queued"""
 
     def __init__(self, datamanager):
         self.datamanager = datamanager
+        # _queue changes _pending in place, so keep copies.
+        self.pending = list(datamanager._pending)
+        self.positions = dict(datamanager._positions)
+        self.elided = datamanager.elided
 
     def rollback(self):
-        pass
+        dm = self.datamanager
+        dm._pending = list(self.pending)
+        dm._positions = dict(self.positions)
+        dm.elided = self.elided
 
 
 class SolrConnectionManager(object):
     implements(ISolrConnectionManager, IDataManager)
 
+    # The most changes sent to Solr in one update request
+    batch_size = 100
+
     def __init__(self, solr_index, connection_factory=SolrConnection):
         self.solr_uri = solr_index.solr_uri
+        self.response_format = solr_index.response_format
+        self.update_format = solr_index.update_format
+        self.shard_uris = tuple(solr_index.shard_uris)
+        self.async_updates = solr_index.async_updates
+        self.commit_policy = CommitPolicy.from_settings(solr_index)
         self._joined = False
+        self._pending = []  # [(method name, argument) or None]
+        self._positions = {}  # {unique key: position in _pending}
+        self.elided = 0  # Changes replaced by a later change of a document
         self._connection_factory = connection_factory
-        self._connection = connection_factory(self.solr_uri)
-        self.schema = SolrSchema(self.solr_uri)
+        self._connection = self._make_connection()
+
+    @property
+    def schema(self):
+        # Shared by all connection managers of this process
+        return get_schema(self.solr_uri)
+
+    def _make_connection(self):
+        return make_connection(
+            self.solr_uri, self.shard_uris, self._connection_factory,
+            response_format=self.response_format,
+            update_format=self.update_format)
+
+    def new_connection(self):
+        """See ISolrConnectionManager"""
+        return self._make_connection()
 
     @property
     def connection(self):
         c = self._connection
         if c is None:
-            c = self._connection_factory(self.solr_uri)
+            c = self._make_connection()
             self._connection = c
         return c
 
@@ -461,8 +954,47 @@ class SolrConnectionManager(object):
             transaction.get().join(self)
             self._joined = True
 
+    def add(self, values):
+        self._queue(values.get(self.schema.uniqueKey), ('add', values))
+
+    def delete(self, id):
+        self._queue(id, ('delete', id))
+
+    def delete_query(self, query):
+        if query == '*:*':
+            # Nothing queued before matters any more.
+            self.elided += len(filter(None, self._pending))
+            self._pending = []
+        self._positions = {}
+        self._pending.append(('delete_query', query))
+
+    def _queue(self, key, change):
+        # Only the last add or delete of a document is sent. A
+        # delete_query starts over, since it may match the document.
+        pending = self._pending
+        if key is not None:
+            pos = self._positions.get(key)
+            if pos is not None:
+                pending[pos] = None
+                self.elided += 1
+            self._positions[key] = len(pending)
+        pending.append(change)
+
+    def _take_pending(self):
+        pending = [change for change in self._pending if change is not None]
+        self._pending = []
+        self._positions = {}
+        return pending
+
+    def send_pending(self):
+        """Send the queued changes to Solr in batches of batch_size"""
+        send_changes(self.connection, self._take_pending(), self.batch_size,
+                     self.commit_policy.commit_within)
+
     def abort(self, transaction):
         try:
+            self._pending = []
+            self._positions = {}
             c = self._connection
             if c is not None:
                 self._connection = None
@@ -477,13 +1009,22 @@ class SolrConnectionManager(object):
         pass
 
     def tpc_vote(self, transaction):
-        # ensure connection is open
-        dummy = self.connection
+        if not self.async_updates:
+            self.send_pending()
 
     def tpc_finish(self, transaction):
         try:
+            if self.async_updates:
+                # The changes are final now; let a worker send them.
+                dispatcher.dispatch(
+                    self.solr_uri, self.response_format,
+                    self._take_pending(), self.batch_size,
+                    self.commit_policy, self.update_format, self.shard_uris)
+                return
             try:
-                self.connection.commit()
+                self.commit_policy.commit(self.connection)
+                query_cache.invalidate(
+                    self.solr_uri, self.commit_policy.visibility_delay or 0)
             except:
                 self.abort(transaction)
                 raise
@@ -491,13 +1032,13 @@ class SolrConnectionManager(object):
             self._joined = False
 
     def tpc_abort(self, transaction):
-        pass
+        self.abort(transaction)
 
     def sortKey(self):
         return self.solr_uri
 
     def savepoint(self, optimistic=False):
-        return NoRollbackSavepoint(self)
+        return Savepoint(self)
 
 def force_unicode(s, encoding='utf-8', errors='strict'):
     if isinstance(s, unicode):
@@ -578,6 +1119,19 @@ class HighlightingBrain(AbstractCatalogBrain):
             return results
 
 
+def _sort_arg(request, attr):
+    """Get sort-<attr> or sort_<attr> from a catalog query"""
+    value = request.get('sort-%s' % attr, None)
+    if value is None:
+        value = request.get('sort_%s' % attr, None)
+    return value
+
+
+def _batch_start(request):
+    """Get the b_start of a catalog query"""
+    return int(request.get('b_start', 0))
+
+
 def get_catalog(obj, name=None):
     if name is None:
         name = 'portal_catalog'
@@ -3,10 +3,10 @@ import Globals  # import Zope 2 dependencies in order
 
 from zope.interface import Attribute
 from zope.interface import Interface
-from Products.PluginIndexes.interfaces import IPluggableIndex
+from Products.PluginIndexes.interfaces import ILimitedResultIndex
 
 
-class ISolrIndex(IPluggableIndex):
+class ISolrIndex(ILimitedResultIndex):
     """A ZCatalog multi-index that uses Solr for storage and queries."""
     solr_uri = Attribute("The URI of the Solr server")
     connection_manager = Attribute("""
@@ -27,12 +27,30 @@ class ISolrConnectionManager(Interface):
     schema = Attribute("An ISolrSchema instance")
     solr_uri = Attribute("The URI of the Solr server")
 
+    def new_connection():
+        """Return a new connection to Solr for use in another thread.
+        """
+
     def set_changed():
         """Adds the Solr connection to the current transaction.
 
         Call this before sending change requests to Solr.
         """
 
+    def add(values):
+        """Add or replace a document when the transaction commits.
+
+        values is a mapping from field name to a list of values.
+        """
+
+    def delete(id):
+        """Delete a document by unique key when the transaction commits.
+        """
+
+    def delete_query(query):
+        """Delete the documents matching a query when the transaction commits.
+        """
+
 
 class ISolrSchema(Interface):
     """The relevant part of the schema installed in a Solr instance.
@@ -44,6 +62,14 @@ class ISolrSchema(Interface):
         """)
     fields = Attribute("A sequence of ISolrField")
 
+    def indexing_plan():
+        """Return what index_object needs to know about the fields.
+
+        Returns a tuple of (field name, converter) for each field but
+        the unique key, in schema order. A converter takes an attribute
+        value and returns what the field's handler.convert() returns.
+        """
+
 
 class ISolrField(Interface):
     """A field in Solr"""
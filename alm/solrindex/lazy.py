@@ -0,0 +1,107 @@
+
+"""A SolrIndex result set that fetches pages of ids on demand"""
+
+
+class _PageCollector(object):
+    """Collects (score, id) pairs from the id parsers in Solr's order"""
+
+    def __init__(self):
+        self.items = []
+
+    def __setitem__(self, key, value):
+        self.items.append((value, key))
+
+
+def _wants_highlighting(params):
+    """Do Solr params ask for highlighting?"""
+    return bool(params.get('highlight')) or (
+        str(params.get('hl', '')).lower() in ('on', 'true'))
+
+
+class LazyResult(object):
+    """The scored result of a query, in the order Solr ranks it.
+
+    ZCatalog only needs len() and the items of the requested batch of a
+    result that no other index touches, so pages of `page_size` ids are
+    requested when an item of that page is first needed. len() is
+    Solr's numFound.
+
+    ZCatalog sorts a scored result with byValue(), then indexes or
+    slices it. Solr already returns matches by descending score, so
+    byValue() returns the result itself. items(), keys() and values()
+    fetch everything.
+    """
+
+    def __init__(self, connection, unique_key, params, page_size,
+                 scale=1000):
+        self.connection = connection
+        self.unique_key = unique_key
+        self.params = params
+        self.page_size = page_size
+        self.scale = scale
+        self._pages = {}
+        self.response = self._fetch(0)
+        self.numFound = int(self.response.numFound)
+        self.highlighting = getattr(self.response, 'highlighting', None)
+        if self.highlighting is None and _wants_highlighting(params):
+            # Brains keep the first response's highlighting dict, so
+            # later pages must add to that one.
+            self.highlighting = self.response.highlighting = {}
+
+    def _fetch(self, page):
+        collector = _PageCollector()
+        response = self.connection.query_ids(
+            unique_key=self.unique_key, result=collector, scale=self.scale,
+            rows=self.page_size, start=page * self.page_size, **self.params)
+        self._pages[page] = collector.items
+        highlighting = getattr(response, 'highlighting', None)
+        if page and highlighting:
+            # Brains look up highlighting in the first response.
+            if self.highlighting is None:
+                self.highlighting = self.response.highlighting = {}
+            self.highlighting.update(highlighting)
+        return response
+
+    def _page(self, page):
+        items = self._pages.get(page)
+        if items is None:
+            self._fetch(page)
+            items = self._pages[page]
+        return items
+
+    def __len__(self):
+        return self.numFound
+
+    def __nonzero__(self):
+        return self.numFound > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.numFound))]
+        if index < 0:
+            index += self.numFound
+        if not 0 <= index < self.numFound:
+            raise IndexError(index)
+        page, offset = divmod(index, self.page_size)
+        items = self._page(page)
+        if offset >= len(items):
+            # Solr found fewer matches than it counted at first.
+            raise IndexError(index)
+        return items[offset]
+
+    def __iter__(self):
+        for page in range((self.numFound - 1) // self.page_size + 1):
+            for item in self._page(page):
+                yield item
+
+    def byValue(self, min):
+        return self
+
+    def items(self):
+        return [(key, score) for score, key in self]
+
+    def keys(self):
+        return [key for score, key in self]
+
+    def values(self):
+        return [score for score, key in self]
@@ -0,0 +1,128 @@
+
+"""Running the Solr queries of a catalog search concurrently"""
+
+import atexit
+import os
+import Queue
+import sys
+import threading
+
+
+class PendingCall(object):
+    """A function call submitted to a QueryExecutor.
+
+    get() returns the value of the call, or raises its exception. If
+    no worker has started the call yet, get() makes it in the calling
+    thread rather than wait for one. cancel() keeps a call that is no
+    longer needed from being made.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = False
+        self._value = None
+        self._exc_info = None
+
+    def _claim(self):
+        self._lock.acquire()
+        try:
+            if self._started:
+                return False
+            self._started = True
+            return True
+        finally:
+            self._lock.release()
+
+    def _call(self):
+        try:
+            self._value = self.func()
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def cancel(self):
+        """Keep the call from being made if no worker has started it"""
+        if self._claim():
+            self._done.set()
+
+    def get(self):
+        if self._claim():
+            self._call()
+        else:
+            self._done.wait()
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self._value
+
+
+class QueryExecutor(object):
+    """Makes function calls on a fixed number of worker threads.
+
+    SolrIndexes with parallel_queries set submit the queries of the
+    other SolrIndexes of a catalog search here, so the Solr requests
+    overlap instead of following each other.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        self._lock.acquire()
+        try:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name='SolrIndex query %d' % i)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def submit(self, func):
+        """Start calling func() and return a PendingCall"""
+        pending = PendingCall(func)
+        if not self._threads:
+            self.start()
+        self.queue.put(pending)
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self.queue.get()
+            if pending is None:
+                break
+            if pending._claim():
+                pending._call()
+
+    def shutdown(self):
+        """Stop the workers once the submitted calls have started"""
+        self._lock.acquire()
+        try:
+            threads = self._threads
+            self._threads = []
+            for thread in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+        finally:
+            self._lock.release()
+
+
+query_executor = QueryExecutor(
+    workers=int(os.environ.get('SOLR_QUERY_WORKERS', 4)))
+atexit.register(query_executor.shutdown)
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(query_executor.shutdown)
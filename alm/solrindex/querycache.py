@@ -0,0 +1,159 @@
+
+"""Process-wide cache of SolrIndex query results"""
+
+from collections import OrderedDict
+import os
+import threading
+import time
+
+# Rough size of one IIBTree item plus its share of bucket overhead
+ITEM_BYTES = 16
+ENTRY_BYTES = 256
+
+
+def canonical_params(params):
+    """Return a hashable, order-independent form of Solr params"""
+    items = []
+    for key, value in params.items():
+        if isinstance(value, (list, tuple)):
+            value = tuple(value)
+        items.append((key, value))
+    items.sort()
+    return tuple(items)
+
+
+def copy_result(result):
+    """Return a copy of a result, keeping the count of a SortedResult"""
+    copy = result.__class__(result)
+    numFound = getattr(result, 'numFound', None)
+    if numFound is not None:
+        copy.numFound = numFound
+    return copy
+
+
+class QueryCache(object):
+    """LRU cache of (result, queried) pairs, bounded in bytes.
+
+    Entries are keyed on the Solr URI and a key for the query, such
+    as the canonical query params. invalidate(solr_uri) drops every
+    entry of a Solr URI; connection managers call it when this process
+    commits changes to Solr. If the changes only become searchable some
+    seconds later, nothing is cached for that Solr URI until then. get()
+    also ignores entries older than max_age seconds, so commits made
+    by other processes become visible.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {key: (time, size, result, queried)}
+        self._generations = {}  # {solr_uri: invalidation count}
+        self._settle_times = {}  # {solr_uri: time changes are searchable}
+
+    def get(self, solr_uri, params, max_age):
+        """Return a copy of the cached (result, queried), or None"""
+        key = (solr_uri, self.generation(solr_uri), params)
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None or time.time() - entry[0] > max_age:
+                if entry is not None:
+                    self.size -= entry[1]
+                self.misses += 1
+                return None
+            # Move to the end, the most recently used position.
+            self._entries[key] = entry
+            self.hits += 1
+        finally:
+            self._lock.release()
+        # The catalog owns the result set it is given.
+        return copy_result(entry[2]), entry[3]
+
+    def generation(self, solr_uri):
+        """Return a token to pass to set() for a query about to be sent.
+
+        None while committed changes may not be searchable yet.
+        """
+        if time.time() < self._settle_times.get(solr_uri, 0):
+            return None
+        return self._generations.get(solr_uri, 0)
+
+    def set(self, solr_uri, params, result, queried, generation):
+        """Store a result unless solr_uri was invalidated since generation
+        """
+        result = copy_result(result)
+        size = ENTRY_BYTES + ITEM_BYTES * len(result.keys())
+        if size > self.max_bytes or generation is None:
+            return
+        key = (solr_uri, generation, params)
+        entry = (time.time(), size, result, tuple(queried))
+        self._lock.acquire()
+        try:
+            if generation != self._generations.get(solr_uri, 0):
+                # The result may predate a commit.
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                old = self._entries.popitem(last=False)[1]
+                self.size -= old[1]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, solr_uri, delay=0):
+        """Forget all results of solr_uri.
+
+        delay is the number of seconds until the committed changes are
+        searchable.
+        """
+        self._lock.acquire()
+        try:
+            self._generations[solr_uri] = (
+                self._generations.get(solr_uri, 0) + 1)
+            if delay:
+                self._settle_times[solr_uri] = max(
+                    self._settle_times.get(solr_uri, 0), time.time() + delay)
+            for key in self._entries.keys():
+                if key[0] == solr_uri:
+                    self.size -= self._entries.pop(key)[1]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._generations.clear()
+            self._settle_times.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            }
+
+
+query_cache = QueryCache(
+    max_bytes=int(os.environ.get('SOLR_QUERY_CACHE_BYTES', 64 * 1024 * 1024)))
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(query_cache.clear)
@@ -1,6 +1,7 @@
 
 """Parser of a Solr schema.xml"""
 
+from alm.solrindex.handlers import get_converter
 from alm.solrindex.interfaces import ISolrField
 from alm.solrindex.interfaces import ISolrFieldHandler
 from alm.solrindex.interfaces import ISolrSchema
@@ -12,7 +13,14 @@ except ImportError:
 from zope.component import getUtility
 from zope.component import queryUtility
 from zope.interface import implements
+from itertools import izip
+import hashlib
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
 import urllib2
 
 log = logging.getLogger(__name__)
@@ -23,6 +31,10 @@ class SolrSchema(object):
 
     uniqueKey = None
     defaultSearchField = None
+    etag = None           # HTTP validators of the downloaded schema.xml
+    last_modified = None
+    checked = 0           # When the schema was last downloaded or validated
+    _indexing_plan = None
 
     def __init__(self, solr_uri=None):
         self.fields = []
@@ -30,18 +42,37 @@ class SolrSchema(object):
             f = self.download_from(solr_uri)
             try:
                 self.xml_init(f)
+                self.set_validators(f)
             finally:
                 f.close()
+        self.checked = time.time()
 
-    def download_from(self, solr_uri):
-        """Get schema.xml from a running Solr instance"""
+    def download_from(self, solr_uri, etag=None, last_modified=None):
+        """Get schema.xml from a running Solr instance
+
+        If etag or last_modified are given, the request is conditional
+        and urllib2.HTTPError with code 304 is raised if the schema has
+        not changed.
+        """
         schema_uris = ('%s/admin/file/?file=schema.xml',         # solr 1.3
                        '%s/admin/get-file.jsp?file=schema.xml')  # solr 1.2
         for i, uri in enumerate(schema_uris):
             uri = uri % solr_uri
             log.debug('getting schema from %s', uri)
+            request = urllib2.Request(uri)
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
             try:
-                f = urllib2.urlopen(uri)
+                f = urllib2.urlopen(request)
+            except urllib2.HTTPError, e:
+                if e.code == 304:
+                    raise
+                if i < len(schema_uris) - 1:
+                    # try the next URI
+                    continue
+                raise
             except urllib2.URLError:
                 if i < len(schema_uris) - 1:
                     # try the next URI
@@ -49,6 +80,12 @@ class SolrSchema(object):
                 raise
             return f
 
+    def set_validators(self, f):
+        """Remember the HTTP validators of a downloaded schema.xml"""
+        info = f.info()
+        self.etag = info.get('ETag')
+        self.last_modified = info.get('Last-Modified')
+
     def xml_init(self, f):
         """Initialize this instance from a Solr schema.xml"""
         tree = parse(f)
@@ -69,6 +106,75 @@ class SolrSchema(object):
             t = types[e.attrib['type']]
             self.fields.append(SolrField(e, t))
 
+    def indexing_plan(self):
+        """See ISolrSchema"""
+        plan = self._indexing_plan
+        if plan is None:
+            plan = tuple([(field.name, get_converter(field.handler))
+                          for field in self.fields
+                          if field.name != self.uniqueKey])
+            self._indexing_plan = plan
+        return plan
+
+    def to_dict(self):
+        """Return the parsed schema as a JSON serializable dict"""
+        return {
+            'uniqueKey': self.uniqueKey,
+            'defaultSearchField': self.defaultSearchField,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'fields': [field.to_dict() for field in self.fields],
+            }
+
+    def dict_init(self, data):
+        """Initialize this instance from the output of to_dict()"""
+        self.uniqueKey = data['uniqueKey']
+        self.defaultSearchField = data['defaultSearchField']
+        self.etag = data['etag']
+        self.last_modified = data['last_modified']
+        for field_data in data['fields']:
+            field = SolrField()
+            field.dict_init(field_data)
+            self.fields.append(field)
+
+
+def build_document(documentId, uniqueKey, plan, values):
+    """Convert the values SolrIndex.get_values() returned for an indexing
+    plan into a Solr document.
+
+    Only needs the plan, so it can run in another process.
+    """
+    doc = {uniqueKey: documentId}
+    for (name, convert), value in izip(plan, values):
+        value_list = convert(value)
+        if value_list:
+            doc[name] = value_list
+    return doc
+
+
+# Field classes Solr sorts on by their single untokenized value
+sortable_classes = frozenset([
+    'StrField', 'DateField', 'TrieDateField', 'DatePointField',
+    'TrieIntField', 'TrieLongField', 'TrieFloatField', 'TrieDoubleField',
+    'IntPointField', 'LongPointField', 'FloatPointField',
+    'DoublePointField',
+    ])
+
+
+def is_sortable(field):
+    """Can Solr sort on a field of the schema?
+
+    Only indexed, single valued string, date and numeric fields sort
+    the way a catalog index does. Attributes the field does not set
+    take Solr's defaults.
+    """
+    if getattr(field, 'indexed', None) is False:
+        return False
+    if getattr(field, 'multiValued', None):
+        return False
+    java_class = getattr(field, 'java_class', None) or ''
+    return java_class.split('.')[-1] in sortable_classes
+
 
 class SolrField(object):
     implements(ISolrField)
@@ -77,7 +183,12 @@ class SolrField(object):
         'indexed', 'stored', 'required', 'multiValued',
         )
 
-    def __init__(self, elem, fieldType):
+    def __init__(self, elem=None, fieldType=None):
+        if elem is not None:
+            self.xml_init(elem, fieldType)
+
+    def xml_init(self, elem, fieldType):
+        """Initialize this field from schema.xml elements"""
         self.name = elem.attrib['name']
         self.type = elem.attrib['type']
         self.java_class = fieldType.attrib['class']
@@ -86,7 +197,29 @@ class SolrField(object):
             if value is not None:
                 value = {'true': True, 'false': False}[value.lower()]
             setattr(self, attr, value)
+        self.find_handler()
+
+    def to_dict(self):
+        data = {
+            'name': self.name,
+            'type': self.type,
+            'java_class': self.java_class,
+            }
+        for attr in self._boolean_attrs:
+            data[attr] = getattr(self, attr)
+        return data
 
+    def dict_init(self, data):
+        """Initialize this field from the output of to_dict()"""
+        self.name = data['name']
+        self.type = data['type']
+        self.java_class = data['java_class']
+        for attr in self._boolean_attrs:
+            setattr(self, attr, data.get(attr))
+        self.find_handler()
+
+    def find_handler(self):
+        """Look up the field handler by field name, then by java class"""
         handler = queryUtility(ISolrFieldHandler, name=self.name)
         if handler is None:
             handler = queryUtility(
@@ -94,3 +227,212 @@ class SolrField(object):
             if handler is None:
                 handler = getUtility(ISolrFieldHandler)
         self.handler = handler
+
+
+class SchemaCache(object):
+    """Process-wide cache of SolrSchema instances, keyed by Solr URI.
+
+    Schemas are shared by all connection managers, so schema.xml is
+    downloaded and parsed (and field handlers are looked up) once per
+    process instead of once per ZODB connection. After `ttl` seconds a
+    schema is revalidated with a conditional request; if Solr says it
+    has not changed, or Solr can not be reached, the cached schema is
+    kept.
+
+    The last good schema of each Solr URI is also written to a JSON
+    snapshot in `snapshot_dir`. A freshly started process uses the
+    snapshot and revalidates it in the background, so neither the
+    first request nor a start while Solr is down waits for Solr. If
+    `background` is false, revalidation happens in the calling thread.
+    Each Solr URI has its own lock, so a slow download only holds up
+    the threads that need the same schema.
+    """
+
+    def __init__(self, ttl=300, snapshot_dir=None, background=True):
+        self.ttl = ttl
+        self.snapshot_dir = snapshot_dir
+        self.background = background
+        self._lock = threading.Lock()
+        self._uri_locks = {}  # {solr_uri: lock}
+        self._schemas = {}
+        self._refreshing = {}  # {solr_uri: thread}
+
+    def _lock_for(self, solr_uri):
+        self._lock.acquire()
+        try:
+            lock = self._uri_locks.get(solr_uri)
+            if lock is None:
+                lock = self._uri_locks[solr_uri] = threading.Lock()
+            return lock
+        finally:
+            self._lock.release()
+
+    def get(self, solr_uri):
+        schema = self._schemas.get(solr_uri)
+        if schema is not None and time.time() - schema.checked < self.ttl:
+            return schema
+
+        lock = self._lock_for(solr_uri)
+        lock.acquire()
+        try:
+            # Another thread may have loaded it while we waited.
+            schema = self._schemas.get(solr_uri)
+            if schema is None:
+                schema = self.load_snapshot(solr_uri)
+                if schema is None:
+                    schema = SolrSchema(solr_uri)
+                    self.save_snapshot(solr_uri, schema)
+                    self._schemas[solr_uri] = schema
+                    return schema
+                self._schemas[solr_uri] = schema
+            if time.time() - schema.checked >= self.ttl:
+                if self.background:
+                    self._start_refresh(solr_uri, schema)
+                else:
+                    schema = self.refresh(solr_uri, schema)
+            return schema
+        finally:
+            lock.release()
+
+    def _start_refresh(self, solr_uri, schema):
+        thread = self._refreshing.get(solr_uri)
+        if thread is not None and thread.isAlive():
+            return
+        thread = threading.Thread(
+            target=self.refresh, args=(solr_uri, schema),
+            name='SolrSchema refresh %s' % solr_uri)
+        thread.setDaemon(True)
+        self._refreshing[solr_uri] = thread
+        thread.start()
+
+    def refresh(self, solr_uri, schema):
+        """Revalidate a cached schema and store the result"""
+        new_schema = self.revalidate(solr_uri, schema)
+        if new_schema is not schema:
+            self.save_snapshot(solr_uri, new_schema)
+        if self._schemas.get(solr_uri) is schema:
+            self._schemas[solr_uri] = new_schema
+        return new_schema
+
+    def revalidate(self, solr_uri, schema):
+        """Return schema if it is still current, else a new SolrSchema"""
+        if not solr_uri:
+            schema.checked = time.time()
+            return schema
+        try:
+            f = schema.download_from(
+                solr_uri, etag=schema.etag,
+                last_modified=schema.last_modified)
+        except urllib2.HTTPError, e:
+            if e.code != 304:
+                log.warning("Keeping the cached schema of %s: %s",
+                            solr_uri, e)
+            schema.checked = time.time()
+            return schema
+        except urllib2.URLError, e:
+            log.warning("Keeping the cached schema of %s: %s", solr_uri, e)
+            schema.checked = time.time()
+            return schema
+
+        new_schema = SolrSchema()
+        try:
+            new_schema.xml_init(f)
+            new_schema.set_validators(f)
+        finally:
+            f.close()
+        log.info("Reloaded the schema of %s", solr_uri)
+        return new_schema
+
+    def get_snapshot_dir(self):
+        """Return the directory for schema snapshots, or None
+
+        Uses the snapshot_dir attribute, the SOLR_SCHEMA_SNAPSHOT_DIR
+        environment variable or the client home of the running Zope
+        instance, whichever is set first.
+        """
+        if self.snapshot_dir:
+            return self.snapshot_dir
+        path = os.environ.get('SOLR_SCHEMA_SNAPSHOT_DIR')
+        if path:
+            return path
+        try:
+            from App.config import getConfiguration
+        except ImportError:
+            return None
+        path = getattr(getConfiguration(), 'clienthome', None)
+        if path and os.path.isdir(path):
+            return path
+        return None
+
+    def snapshot_path(self, solr_uri):
+        path = self.get_snapshot_dir()
+        if not solr_uri or not path:
+            return None
+        key = hashlib.md5(solr_uri).hexdigest()
+        return os.path.join(path, 'solrschema-%s.json' % key)
+
+    def load_snapshot(self, solr_uri):
+        """Return the snapshot of the schema of solr_uri, or None
+
+        The schema is marked as checked long ago, so it gets revalidated
+        on first use.
+        """
+        path = self.snapshot_path(solr_uri)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            f = open(path, 'rb')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            if data.get('solr_uri') != solr_uri:
+                return None
+            schema = SolrSchema()
+            schema.dict_init(data['schema'])
+        except Exception:
+            log.warning("Ignoring unreadable schema snapshot %s", path,
+                        exc_info=True)
+            return None
+        log.info("Loaded the schema of %s from %s", solr_uri, path)
+        schema.checked = 0
+        return schema
+
+    def save_snapshot(self, solr_uri, schema):
+        """Write schema to the snapshot of solr_uri"""
+        path = self.snapshot_path(solr_uri)
+        if path is None:
+            return
+        data = {'solr_uri': solr_uri, 'schema': schema.to_dict()}
+        try:
+            # Write a temporary file and rename it, so that a crash or a
+            # concurrent process never leaves a partial snapshot.
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            try:
+                json.dump(data, f)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            log.warning("Unable to write schema snapshot %s", path,
+                        exc_info=True)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._schemas.clear()
+        finally:
+            self._lock.release()
+
+
+schema_cache = SchemaCache(ttl=int(os.environ.get('SOLR_SCHEMA_TTL', 300)))
+get_schema = schema_cache.get
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(schema_cache.clear)
@@ -0,0 +1,74 @@
+"""This is a script to compare the response formats of solrpycore.
+
+It fetches the same query from a running Solr once in each response
+format (xml, json and javabin), then times how long the full parser and
+the id/score parser used by SolrIndex take to decode each response.
+"""
+
+from alm.solrindex.solrpycore import id_response_parsers
+from alm.solrindex.solrpycore import response_parsers
+from alm.solrindex.solrpycore import SolrConnection
+from optparse import OptionParser
+import time
+
+formats = ('xml', 'json', 'javabin')
+
+
+def fetch(conn, response_format, q, unique_key, rows):
+    """Get the raw response to a query in the given format."""
+    params, response_format = conn._query_params(
+        q, unique_key, None, True, None, 'asc', response_format,
+        {'rows': rows})
+    return params, conn.raw_query(**params)
+
+
+def best_time(func, repeat):
+    """Return the fastest of `repeat` runs of func, in seconds."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options] SOLR_URI')
+    parser.add_option('-q', '--query', default='*:*',
+                      help='the query to send (default: %default)')
+    parser.add_option('-k', '--unique-key', default='docid',
+                      help='the unique key field (default: %default)')
+    parser.add_option('-r', '--rows', type='int', default=10000,
+                      help='the number of rows to fetch (default: %default)')
+    parser.add_option('-n', '--repeat', type='int', default=10,
+                      help='the number of timed runs (default: %default)')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a Solr URI is required')
+
+    conn = SolrConnection(args[0])
+    print '%-8s %12s %8s %14s %14s' % (
+        'format', 'bytes', 'docs', 'full parse ms', 'id parse ms')
+    for response_format in formats:
+        params, data = fetch(
+            conn, response_format, options.query, options.unique_key,
+            options.rows)
+        parse = response_parsers[response_format]
+        parse_ids = id_response_parsers[response_format]
+        response = parse(data, params=params, connection=conn)
+
+        full = best_time(
+            lambda: parse(data, params=params, connection=conn),
+            options.repeat)
+        ids = best_time(
+            lambda: parse_ids(data, options.unique_key, {}),
+            options.repeat)
+        print '%-8s %12d %8d %14.1f %14.1f' % (
+            response_format, len(data), len(response),
+            full * 1000, ids * 1000)
+    conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,444 @@
+
+"""This is a script to rebuild a SolrIndex from its catalog.
+
+It walks the record ids of a ZCatalog, builds the Solr document of
+every cataloged object with the field handlers of the SolrIndex and
+sends the documents to Solr as batched adds over several concurrent
+connections. Solr commits periodically; after each commit the last
+record id is saved to a checkpoint file so an interrupted run can be
+resumed with the same command. A checkpoint written for another
+catalog, index or Solr URI stops the run; --clear discards the
+checkpoint and starts over.
+
+With --processes, the documents are converted and serialized by a pool
+of processes; the main process only loads the objects and reads their
+attributes. The pool is forked before the Zope application is opened,
+and each process loads the ZCML of the instance to find the field
+handlers.
+
+Example:
+
+    bin/solr_reindex -C parts/instance/etc/zope.conf /Plone/portal_catalog
+"""
+
+from alm.solrindex.schema import SolrSchema
+from alm.solrindex.schema import build_document
+from alm.solrindex.shards import ShardedConnection
+from alm.solrindex.shards import make_connection
+from alm.solrindex.solrpycore import SolrConnection
+from alm.solrindex.solrpycore import serialize_doc
+from optparse import OptionParser
+import cPickle
+import json
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
+import transaction
+
+try:
+    from plone.indexer.interfaces import IIndexableObject
+    from zope.component import queryMultiAdapter
+except ImportError:
+    IIndexableObject = None
+
+
+class CheckpointError(Exception):
+    """The checkpoint file belongs to another reindex run"""
+
+
+class Progress(object):
+    """Counts documents and bytes and formats a progress report"""
+
+    def __init__(self, total, done=0):
+        self.total = total
+        self.done = done
+        self.skipped = 0
+        self.start_done = done
+        self.start = time.time()
+
+    def report(self, bytes_sent):
+        elapsed = max(time.time() - self.start, 0.001)
+        rate = (self.done - self.start_done) / elapsed
+        left = max(self.total - self.done - self.skipped, 0)
+        if rate:
+            eta = format_seconds(left / rate)
+        else:
+            eta = '?'
+        return '%d/%d docs, %d skipped, %.1f docs/s, %.1f KB/s, ETA %s' % (
+            self.done, self.total, self.skipped, rate,
+            bytes_sent / elapsed / 1024, eta)
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def init_process():
+    """Register the field handlers of Zope in a conversion process.
+
+    Does what Zope's startup does before and after opening the database,
+    without opening it.
+    """
+    import OFS.Application
+    from Zope2.App.zcml import load_site
+    OFS.Application.import_products()
+    load_site()
+
+
+# The (setup, unique key, indexing plan, update format) of a conversion
+# process
+_builder = None
+
+
+def _get_builder(setup):
+    global _builder
+    if _builder is None or _builder[0] != setup:
+        schema_data, update_format = cPickle.loads(setup)
+        schema = SolrSchema()
+        schema.dict_init(schema_data)
+        _builder = (setup, schema.uniqueKey, schema.indexing_plan(),
+                    update_format)
+    return _builder
+
+
+def build_batch(setup, data):
+    """Convert and serialize a pickled list of (record id, values).
+
+    Runs in the processes of the conversion pool. setup is the pickled
+    schema and update format. Returns the record ids and the serialized
+    documents.
+    """
+    _, unique_key, plan, update_format = _get_builder(setup)
+    rids = []
+    docs = []
+    for rid, values in cPickle.loads(data):
+        rids.append(rid)
+        docs.append(serialize_doc(
+            build_document(rid, unique_key, plan, values), update_format))
+    return rids, docs
+
+
+class Reindexer(object):
+    """Sends the documents of all objects in a catalog to a SolrIndex.
+
+    Objects are loaded in the calling thread, since ZODB connections are
+    not thread safe. They are converted there too, unless `processes`
+    is set: then the calling thread only reads the attribute values, and
+    a pool of that many processes, or the given multiprocessing `pool`,
+    converts and serializes each batch. A batch that is not converted
+    within `batch_timeout` seconds, such as when a process died, stops
+    the run. `workers` threads, each with its own SolrConnection, send
+    batches of `batch_size` documents.
+    """
+
+    def __init__(self, catalog, index, batch_size=500, workers=4,
+                 commit_every=10000, checkpoint=None, out=sys.stdout,
+                 connection_factory=SolrConnection, processes=0, pool=None,
+                 batch_timeout=600):
+        self.catalog = catalog
+        self.index = index
+        self.batch_size = batch_size
+        self.workers = workers
+        self.commit_every = commit_every
+        self.checkpoint = checkpoint
+        self.out = out
+        self.connection_factory = connection_factory
+        self.processes = processes
+        self.pool = pool
+        self.own_pool = False
+        self.batch_timeout = batch_timeout
+        # Batches being converted by the pool wait in the queue.
+        self.queue = Queue.Queue(max(workers, processes) * 2)
+        self.connections = []
+        self.errors = []
+
+    def _make_connection(self):
+        c = make_connection(
+            self.index.solr_uri, self.index.shard_uris,
+            self.connection_factory,
+            unique_key=self.index.connection_manager.schema.uniqueKey,
+            response_format=self.index.response_format,
+            update_format=self.index.update_format)
+        self.connections.append(c)
+        return c
+
+    def _send(self, connection):
+        while True:
+            docs = self.queue.get()
+            try:
+                if docs is None:
+                    break
+                if not self.errors:
+                    self._send_batch(connection, docs)
+            except Exception, e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def _send_batch(self, connection, docs):
+        if self.pool is None:
+            # Stream the batch so the whole request body is never
+            # held in memory at once.
+            connection.add_many(docs, stream=True)
+        else:
+            # docs is the pending result of build_batch().
+            try:
+                rids, serialized = docs.get(self.batch_timeout)
+            except multiprocessing.TimeoutError:
+                raise RuntimeError(
+                    'A batch was not converted in %s seconds; did a '
+                    'conversion process die?' % self.batch_timeout)
+            if isinstance(connection, ShardedConnection):
+                connection.add_serialized(serialized, rids)
+            else:
+                connection.add_serialized(serialized)
+
+    def _prepare(self, rid, obj):
+        """Return what a batch holds for an object"""
+        if self.pool is None:
+            return self.index.get_document(rid, obj)
+        return (rid, self.index.get_values(obj, self.plan))
+
+    def _put_batch(self, docs):
+        if self.pool is not None:
+            # Pickle here, so unpicklable values raise in this thread.
+            docs = self.pool.apply_async(
+                build_batch, (self.setup, cPickle.dumps(docs, 2)))
+        self.queue.put(docs)
+
+    def _start_pool(self):
+        schema = self.index.connection_manager.schema
+        self.plan = schema.indexing_plan()
+        # The processes build the plan from the schema themselves.
+        self.setup = cPickle.dumps(
+            (schema.to_dict(), self.index.update_format), 2)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+            self.own_pool = True
+
+    def checkpoint_source(self):
+        """Return what the checkpoint must have been written for"""
+        return {
+            'catalog': '/'.join(self.catalog.getPhysicalPath()),
+            'index': self.index.getId(),
+            'solr_uri': self.index.solr_uri,
+            }
+
+    def load_checkpoint(self):
+        """Return (last record id, documents done) from the checkpoint"""
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            f = open(self.checkpoint)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            for key, value in sorted(self.checkpoint_source().items()):
+                if data.get(key) != value:
+                    raise CheckpointError(
+                        'The checkpoint %s was written for %s %r, not %r; '
+                        'remove it or use --clear' % (
+                            self.checkpoint, key, data.get(key), value))
+            return data['last_rid'], data['done']
+        return None, 0
+
+    def remove_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def save_checkpoint(self, last_rid, done):
+        if not self.checkpoint:
+            return
+        data = self.checkpoint_source()
+        data.update(last_rid=last_rid, done=done)
+        tmp = self.checkpoint + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.checkpoint)
+
+    def wrap(self, obj):
+        """Wrap obj the way Plone's catalog does before indexing"""
+        if IIndexableObject is None or IIndexableObject.providedBy(obj):
+            return obj
+        wrapper = queryMultiAdapter((obj, self.catalog), IIndexableObject)
+        if wrapper is not None:
+            return wrapper
+        return obj
+
+    def bytes_sent(self):
+        return sum([c.bytes_sent for c in self.connections])
+
+    def _release_objects(self):
+        """Let go of the objects loaded so far"""
+        transaction.abort()
+        jar = getattr(self.catalog, '_p_jar', None)
+        if jar is not None:
+            jar.cacheGC()
+
+    def _flush(self, docs, last_rid, progress):
+        """Send docs, wait for all senders, commit and save a checkpoint"""
+        if docs:
+            self._put_batch(docs)
+        self.queue.join()
+        if self.errors:
+            raise self.errors[0]
+        self.main_connection.commit()
+        self.save_checkpoint(last_rid, progress.done)
+        self.out.write(progress.report(self.bytes_sent()) + '\n')
+        self.out.flush()
+
+    def run(self, clear=False):
+        paths = self.catalog._catalog.paths
+        if clear:
+            # Start over; the documents sent so far are deleted below.
+            self.remove_checkpoint()
+        last_rid, done = self.load_checkpoint()
+        if last_rid is None:
+            rids = paths.keys()
+        else:
+            rids = paths.keys(last_rid + 1)
+            self.out.write('Resuming after record %d\n' % last_rid)
+        progress = Progress(len(paths), done)
+
+        if self.processes or self.pool is not None:
+            # Fork before starting any threads.
+            self._start_pool()
+
+        self.main_connection = self._make_connection()
+        if clear:
+            self.main_connection.delete_query('*:*')
+
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._send, args=(self._make_connection(),))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            docs = []
+            uncommitted = 0
+            for rid in rids:
+                obj = self.catalog.resolve_path(paths[rid])
+                if obj is None:
+                    progress.skipped += 1
+                    continue
+                docs.append(self._prepare(rid, self.wrap(obj)))
+                progress.done += 1
+                uncommitted += 1
+                last_rid = rid
+                if uncommitted >= self.commit_every:
+                    self._flush(docs, last_rid, progress)
+                    docs = []
+                    uncommitted = 0
+                    self._release_objects()
+                elif len(docs) >= self.batch_size:
+                    self._put_batch(docs)
+                    docs = []
+                    if self.errors:
+                        raise self.errors[0]
+                    self._release_objects()
+            self._flush(docs, last_rid, progress)
+        finally:
+            for thread in threads:
+                self.queue.put(None)
+            for thread in threads:
+                thread.join()
+            for c in self.connections:
+                c.close()
+            if self.own_pool:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+                self.own_pool = False
+
+        self.remove_checkpoint()
+        return progress
+
+
+def main():
+    parser = OptionParser(
+        usage='usage: %prog [options] -C ZOPE_CONF CATALOG_PATH')
+    parser.add_option('-C', '--config',
+                      help='the zope.conf of the Zope instance')
+    parser.add_option('-i', '--index',
+                      help='the id of the SolrIndex '
+                      '(default: the only SolrIndex of the catalog)')
+    parser.add_option('-b', '--batch-size', type='int', default=500,
+                      help='documents per add request (default: %default)')
+    parser.add_option('-w', '--workers', type='int', default=4,
+                      help='concurrent Solr connections (default: %default)')
+    parser.add_option('-p', '--processes', type='int', default=0,
+                      help='processes converting documents '
+                      '(default: convert in the main process)')
+    parser.add_option('-t', '--batch-timeout', type='int', default=600,
+                      help='seconds to wait for the conversion of a batch '
+                      '(default: %default)')
+    parser.add_option('-n', '--commit-every', type='int', default=10000,
+                      help='documents between commits (default: %default)')
+    parser.add_option('-k', '--checkpoint', default='solr_reindex.json',
+                      help='the checkpoint file (default: %default)')
+    parser.add_option('--clear', action='store_true', default=False,
+                      help='delete all documents from Solr and the '
+                      'checkpoint first')
+    options, args = parser.parse_args()
+    if len(args) != 1 or not options.config:
+        parser.error('a zope.conf and a catalog path are required')
+
+    # Every sender thread, and every query thread it fans shards out
+    # to, needs a pooled connection.
+    from alm.solrindex import solrpycore
+    from alm.solrindex.parallel import query_executor
+    solrpycore.pool_max_size = max(
+        solrpycore.pool_max_size,
+        options.workers + query_executor.workers + 1)
+
+    import Zope2
+    from alm.solrindex.index import get_solr_indexes
+    from Testing.makerequest import makerequest
+    from zope.component.hooks import setSite
+    Zope2.configure(options.config)
+    pool = None
+    if options.processes:
+        # Fork before the ZODB client starts its threads.
+        pool = multiprocessing.Pool(options.processes, init_process)
+    app = makerequest(Zope2.app())
+    catalog = app.unrestrictedTraverse(args[0])
+    site = catalog.aq_parent
+    setSite(site)
+
+    if options.index:
+        index = catalog._catalog.getIndex(options.index)
+    else:
+        indexes = get_solr_indexes(catalog._catalog)
+        if len(indexes) != 1:
+            parser.error('the catalog has %d SolrIndexes; use --index'
+                         % len(indexes))
+        index = indexes[0]
+
+    reindexer = Reindexer(
+        catalog, index, batch_size=options.batch_size,
+        workers=options.workers, commit_every=options.commit_every,
+        checkpoint=options.checkpoint, processes=options.processes,
+        pool=pool, batch_timeout=options.batch_timeout)
+    try:
+        progress = reindexer.run(clear=options.clear)
+    except CheckpointError, e:
+        parser.error(str(e))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    print 'Done: %d documents, %d objects skipped.' % (
+        progress.done, progress.skipped)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+
+"""Spreading the documents of one SolrIndex over several Solr cores"""
+
+from alm.solrindex.parallel import query_executor
+from alm.solrindex.schema import get_schema
+from alm.solrindex.solrpycore import Results
+from alm.solrindex.solrpycore import SolrConnection
+import heapq
+import json
+import zlib
+
+# The rows Solr returns when a query has a start but no rows
+default_rows = 10
+
+
+def shard_number(key, shards):
+    """Return the shard, from 0 to shards - 1, of a unique key.
+
+    The CRC-32 of the key's string form is the same in every process
+    and Python version, so a document always goes to the same shard as
+    long as the number of shards does not change.
+    """
+    return (zlib.crc32(str(key)) & 0xffffffff) % shards
+
+
+def make_connection(solr_uri, shard_uris=(),
+                    connection_factory=SolrConnection, unique_key=None, **kw):
+    """Return a connection to solr_uri, or to its shards if there are any
+    """
+    if shard_uris:
+        return ShardedConnection(shard_uris, solr_uri, unique_key,
+                                 connection_factory=connection_factory, **kw)
+    return connection_factory(solr_uri, **kw)
+
+
+def _fan_out(calls):
+    """Make calls concurrently and return their values in order"""
+    pending = [query_executor.submit(call) for call in calls[1:]]
+    first = calls[0]()
+    return [first] + [p.get() for p in pending]
+
+
+class _Collector(object):
+    """Collects (key, score) pairs from query_ids in Solr's order"""
+
+    def __init__(self):
+        self.items = []
+
+    def __setitem__(self, key, value):
+        self.items.append((key, value))
+
+
+def _sort_spec(sort, sort_order):
+    """Return the (field, descending) pairs of the sort of a query.
+
+    Without a sort, Solr sorts on the score, best first.
+    """
+    if not sort:
+        return [('score', True)]
+    if isinstance(sort, basestring):
+        sort = [sort]
+    if isinstance(sort_order, (list, tuple)):
+        orders = list(sort_order)
+    else:
+        orders = [sort_order] * len(sort)
+    return [(field, order == 'desc') for field, order in zip(sort, orders)]
+
+
+class _SortKey(object):
+    """Compares the sort values of documents the way Solr sorts them.
+
+    Documents without a value come last.
+    """
+
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __cmp__(self, other):
+        for a, b, desc in zip(self.values, other.values, self.descending):
+            if a == b:
+                continue
+            if a is None:
+                return 1
+            if b is None:
+                return -1
+            if desc:
+                return cmp(b, a)
+            return cmp(a, b)
+        return 0
+
+
+def _merge_sorted(lists, spec, values):
+    """Merge lists the shards sorted on spec into one sorted list.
+
+    values(item, field) returns the sort value of an item. Ties keep
+    the order of the shards.
+    """
+    fields = [field for field, desc in spec]
+    descending = [desc for field, desc in spec]
+    merged = heapq.merge(*[
+        [(_SortKey([values(item, field) for field in fields], descending),
+          n, i, item)
+         for i, item in enumerate(items)]
+        for n, items in enumerate(lists)])
+    return [item for key, n, i, item in merged]
+
+
+def _doc_value(doc, field):
+    value = doc.get(field)
+    if field == 'score' and value is not None:
+        value = float(value)
+    return value
+
+
+def _with_fields(fields, names):
+    """Return the fields to ask for and those added for names"""
+    if not fields:
+        # All stored fields
+        return fields, []
+    if isinstance(fields, basestring):
+        fields = fields.replace(',', ' ').split()
+    if '*' in fields:
+        return fields, []
+    added = [name for name in names
+             if name not in fields and name != 'score']
+    return list(fields) + added, added
+
+
+class ShardedConnection(object):
+    """A SolrConnection to several Solr cores that share one schema.
+
+    Adds and deletes of a document go to the shard chosen by
+    shard_number() from its unique key; other updates and commits go to
+    all shards. Queries are sent to all shards at once on the
+    query_executor threads. When a query asks for a range of rows,
+    every shard is asked for all rows up to the end of the range, their
+    matches are merged on the sort fields, or the score if there is no
+    sort, and the range is cut from the merged list. The sort fields
+    must be returned by Solr, so they must be stored. Otherwise all
+    matches are put together.
+
+    schema_uri is the core whose schema gives the unique key; it
+    defaults to the first shard. The other arguments are passed to the
+    connection_factory of every shard.
+    """
+
+    def __init__(self, shard_uris, schema_uri=None, unique_key=None,
+                 connection_factory=SolrConnection, **kw):
+        self.shard_uris = tuple(shard_uris)
+        self.schema_uri = schema_uri or self.shard_uris[0]
+        self._unique_key = unique_key
+        self.shards = [connection_factory(uri, **kw)
+                       for uri in self.shard_uris]
+
+    @property
+    def unique_key(self):
+        if self._unique_key is None:
+            self._unique_key = get_schema(self.schema_uri).uniqueKey
+        return self._unique_key
+
+    @property
+    def bytes_sent(self):
+        return sum([c.bytes_sent for c in self.shards])
+
+    def shard_for(self, key):
+        """Return the connection to the shard of a unique key"""
+        return self.shards[shard_number(key, len(self.shards))]
+
+    def _group(self, docs, keys=None):
+        """Split docs into one list per shard"""
+        if keys is None:
+            unique_key = self.unique_key
+            keys = [doc[unique_key] for doc in docs]
+        groups = [[] for c in self.shards]
+        for key, doc in zip(keys, docs):
+            groups[shard_number(key, len(groups))].append(doc)
+        return groups
+
+    def _each(self, method, *args, **kw):
+        """Call a method of every shard concurrently"""
+        return _fan_out([
+            (lambda c=c: getattr(c, method)(*args, **kw))
+            for c in self.shards])
+
+    def _grouped(self, method, groups, **kw):
+        """Call a method with the group of each shard that has one"""
+        calls = [(lambda c=c, group=group: getattr(c, method)(group, **kw))
+                 for c, group in zip(self.shards, groups) if group]
+        if calls:
+            _fan_out(calls)
+
+    # Updates
+
+    def add(self, _commit=False, **fields):
+        self.shard_for(fields[self.unique_key]).add(**fields)
+        if _commit:
+            self.commit()
+
+    def add_many(self, docs, _commit=False, commit_within=None,
+                 stream=False):
+        kw = {'stream': stream}
+        if commit_within is not None:
+            kw['commit_within'] = commit_within
+        self._grouped('add_many', self._group(list(docs)), **kw)
+        if _commit:
+            self.commit()
+
+    def add_serialized(self, docs, keys, _commit=False):
+        """Add documents serialized with serialize_doc().
+
+        keys lists the unique key of each document, in the same order.
+        """
+        self._grouped('add_serialized', self._group(docs, keys))
+        if _commit:
+            self.commit()
+
+    def delete(self, id, commit_within=None):
+        kw = {}
+        if commit_within is not None:
+            kw['commit_within'] = commit_within
+        self.shard_for(id).delete(id, **kw)
+
+    def delete_many(self, ids, commit_within=None):
+        kw = {}
+        if commit_within is not None:
+            kw['commit_within'] = commit_within
+        self._grouped('delete_many', self._group(ids, ids), **kw)
+
+    def delete_query(self, query, commit_within=None):
+        kw = {}
+        if commit_within is not None:
+            kw['commit_within'] = commit_within
+        self._each('delete_query', query, **kw)
+
+    def begin_batch(self):
+        for c in self.shards:
+            c.begin_batch()
+
+    def end_batch(self, commit=False):
+        self._each('end_batch', commit=commit)
+
+    def commit(self, *args, **kw):
+        self._each('commit', *args, **kw)
+
+    def optimize(self, *args, **kw):
+        self._each('optimize', *args, **kw)
+
+    def close(self):
+        for c in self.shards:
+            c.close()
+
+    # Queries
+
+    def query(self, q, fields=None, highlight=None, score=True, sort=None,
+              sort_order="asc", **params):
+        """Query all shards and merge their documents"""
+        kw = dict(fields=fields, highlight=highlight, score=score,
+                  sort=sort, sort_order=sort_order)
+        # For next_batch() and previous_batch()
+        batch_params = dict(params, q=q, **kw)
+        window = self._window(params)
+        added = []
+        if window is not None:
+            spec = _sort_spec(sort, sort_order)
+            names = [field for field, desc in spec]
+            kw['fields'], added = _with_fields(fields, names)
+            if 'score' in names and not score:
+                kw['score'] = True
+                added.append('score')
+        responses = self._each('query', q, **dict(params, **kw))
+        lists = [list(response) for response in responses]
+        if window is not None:
+            start, rows = window
+            docs = _merge_sorted(lists, spec, _doc_value)[start:start + rows]
+            for doc in docs:
+                for name in added:
+                    doc.pop(name, None)
+        else:
+            start = 0
+            docs = sum(lists, [])
+        response = self._merge_responses(responses, start)
+        results = Results(docs)
+        for name in ('numFound', 'start', 'maxScore'):
+            if hasattr(response, name):
+                setattr(results, name, getattr(response, name))
+        response.results = results
+        response._params = batch_params
+        response._connection = self
+        return response
+
+    def query_ids(self, q, unique_key, result, scale=1000, sort=None,
+                  **params):
+        """Query all shards and merge their ids and scores into result.
+
+        A cursorMark is a JSON list of the cursors of the shards, with
+        null for the shards that have no more matches. Each shard
+        returns up to rows matches for it, so a page can hold up to
+        rows times the number of shards.
+        """
+        cursor = params.pop('cursorMark', None)
+        if cursor is not None:
+            return self._query_ids_cursor(
+                q, unique_key, result, scale, sort, cursor, params)
+
+        window = self._window(params)
+        if window is not None and sort:
+            # The ids alone do not tell the sort order.
+            return self._query_ids_sorted(
+                q, unique_key, result, scale, sort, window, params)
+        collectors = [_Collector() for c in self.shards]
+        responses = _fan_out([
+            (lambda c=c, collector=collector: c.query_ids(
+                q, unique_key, collector, scale=scale, sort=sort,
+                **params))
+            for c, collector in zip(self.shards, collectors)])
+        lists = [collector.items for collector in collectors]
+        if window is not None:
+            # Each shard sends its best matches first.
+            start, rows = window
+            items = _merge_sorted(
+                lists, _sort_spec(None, None),
+                lambda item, field: item[1])[start:start + rows]
+        else:
+            start = 0
+            items = sum(lists, [])
+        for key, score in items:
+            result[key] = score
+        return self._merge_responses(responses, start)
+
+    def _query_ids_sorted(self, q, unique_key, result, scale, sort, window,
+                          params):
+        """query_ids() for a range of rows in a sort order"""
+        sort_order = params.pop('sort_order', 'asc')
+        spec = _sort_spec(sort, sort_order)
+        fields, added = _with_fields(
+            [unique_key], [field for field, desc in spec])
+        responses = self._each('query', q, fields=fields, score=True,
+                               sort=sort, sort_order=sort_order, **params)
+        start, rows = window
+        docs = _merge_sorted([list(response) for response in responses],
+                             spec, _doc_value)
+        for doc in docs[start:start + rows]:
+            result[int(doc[unique_key])] = int(
+                float(doc.get('score', 0)) * scale)
+        response = self._merge_responses(responses, start)
+        # Like the response of query_ids()
+        response.results = Results()
+        return response
+
+    def _query_ids_cursor(self, q, unique_key, result, scale, sort, cursor,
+                          params):
+        if cursor == '*':
+            cursors = ['*'] * len(self.shards)
+        else:
+            cursors = json.loads(cursor)
+        active = [n for n, c in enumerate(cursors) if c is not None]
+        collectors = dict([(n, _Collector()) for n in active])
+        responses = _fan_out([
+            (lambda n=n: self.shards[n].query_ids(
+                q, unique_key, collectors[n], scale=scale, sort=sort,
+                cursorMark=cursors[n], **params))
+            for n in active])
+        next_cursors = list(cursors)
+        for n, response in zip(active, responses):
+            for key, score in collectors[n].items:
+                result[key] = score
+            next_cursor = getattr(response, 'nextCursorMark', None)
+            if next_cursor is None or next_cursor == cursors[n]:
+                # No more matches in this shard
+                next_cursor = None
+            next_cursors[n] = next_cursor
+        response = self._merge_responses(responses, 0)
+        if [c for c in next_cursors if c is not None]:
+            response.nextCursorMark = json.dumps(next_cursors)
+        else:
+            # The same cursor tells the caller that all shards are done.
+            response.nextCursorMark = cursor
+        return response
+
+    def _window(self, params):
+        """Ask every shard for all rows up to the end of the window.
+
+        Returns the start and rows of the window, or None if the query
+        asks for neither.
+        """
+        start = int(params.pop('start', 0) or 0)
+        rows = params.get('rows')
+        if rows is None:
+            if not start:
+                return None
+            rows = default_rows
+        rows = int(rows)
+        params['rows'] = start + rows
+        return start, rows
+
+    def _merge_responses(self, responses, start):
+        """Combine the counts and highlighting of the shards' responses"""
+        response = responses[0]
+        num_found = 0
+        max_score = None
+        highlighting = None
+        for r in responses:
+            num_found += int(getattr(r, 'numFound', 0) or 0)
+            score = getattr(r, 'maxScore', None)
+            if score is not None:
+                max_score = max(max_score, float(score))
+            h = getattr(r, 'highlighting', None)
+            if h:
+                if highlighting is None:
+                    highlighting = {}
+                highlighting.update(h)
+        response.numFound = unicode(num_found)
+        response.start = unicode(start)
+        if max_score is not None:
+            response.maxScore = unicode(max_score)
+        if highlighting is not None:
+            response.highlighting = highlighting
+        return response
@@ -44,7 +44,14 @@ Only `url` is required,.
         https:// schemes to work. (Most pre-packaged pythons are.)
 
     persistent -- Keep a persistent HTTP connection open.
-        Defaults to true.
+        Defaults to true. Persistent HTTP connections are kept in a
+        process-wide pool per host (see HTTPConnectionPool) and shared
+        by all SolrConnections to that host; a SolrConnection only
+        holds one for the duration of a request. Pool sizes and
+        timeouts default to the SOLR_POOL_SIZE (16),
+        SOLR_POOL_IDLE_TIMEOUT (60 seconds) and SOLR_POOL_WAIT_TIMEOUT
+        (30 seconds) environment variables; pool_stats() returns the
+        usage counters of every pool.
 
     timeout -- Timeout, in seconds, for the server to response.
         By default, use the python default timeout (of none?)
@@ -54,10 +61,25 @@ Only `url` is required,.
         SSL authentication,  these should be, respectively,
         your PEM key file and certificate file
 
+    response_format -- The wire format used for /select responses:
+        'xml' (the 'standard' writer, the default), 'json' or
+        'javabin'. JSON and javabin need far less CPU to parse, and
+        javabin responses are also much smaller; the XML writer works
+        with any SOLR version. javabin needs SOLR 4.0 or later.
+
+    accept_gzip -- Ask SOLR for gzip compressed responses (the
+        default) and decompress them as they are read. SOLR only
+        compresses responses if its servlet container is set up to.
+
+    gzip_min_size -- Compress request bodies of at least this many
+        bytes with gzip. Defaults to the SOLR_GZIP_MIN_SIZE environment
+        variable, or 0, which never compresses requests. SOLR's servlet
+        container must be set up to decompress requests.
+
 Once created, a connection object has the following public methods:
 
     query (q, fields=None, highlight=None,
-           score=True, sort=None, **params)
+           score=True, sort=None, response_format=None, **params)
 
             q -- the query string.
 
@@ -78,6 +100,9 @@ Once created, a connection object has the following public methods:
 
             sort -- list of fields to sort by.
 
+            response_format -- 'xml', 'json' or 'javabin'; overrides
+                the connection's response_format for this query only.
+
             Any parameters available to SOLR 'select' calls can also be
             passed in as named parameters (e.g., fq='...', rows=20, etc).
 
@@ -98,7 +123,7 @@ Once created, a connection object has the following public methods:
             You must "commit" for the addition to be saved.
             This command honors begin_batch/end_batch.
 
-    add_many(lst)
+    add_many(lst, commit_within=None)
 
             Add a series of documents at once.  Pass in a list of
             dictionaries, where each dictionary is a mapping of document
@@ -107,24 +132,25 @@ Once created, a connection object has the following public methods:
                 add_many( [ {'id': 'foo1', 'notes': 'foo'},
                             {'id': 'foo2', 'notes': 'w00t'} ] )
 
-            You must "commit" for the addition to be saved.
+            You must "commit" for the addition to be saved, or pass
+            commit_within (in milliseconds) to let SOLR commit it.
             This command honors begin_batch/end_batch.
 
-    delete(id)
+    delete(id, commit_within=None)
 
             Delete a document by id.
 
             You must "commit" for the deletion to be saved.
             This command honors begin_batch/end_batch.
 
-    delete_many(lst)
+    delete_many(lst, commit_within=None)
 
             Delete a series of documents.  Pass in a list of ids.
 
             You must "commit" for the deletion to be saved.
             This command honors begin_batch/end_batch.
 
-    delete_query(query)
+    delete_query(query, commit_within=None)
 
             Delete any documents returned by issuing a query.
 
@@ -132,9 +158,10 @@ Once created, a connection object has the following public methods:
             This command honors begin_batch/end_batch.
 
 
-    commit(wait_flush=True, wait_searcher=True)
+    commit(wait_flush=True, wait_searcher=True, soft_commit=False)
 
-            Issue a commit command.
+            Issue a commit command. A soft commit makes changes visible
+            to searches without writing them to disk (SOLR 4.0+).
 
             This command honors begin_batch/end_batch.
 
@@ -279,14 +306,21 @@ Enter a raw query, without processing the returned HTML contents.
     >>> print c.raw_query(q='id:[* TO *]', wt='python', rows='10')
 
 """
+import os
 import sys
 import socket
 import httplib
+import threading
+import time
 import urlparse
 import codecs
 import urllib
 import datetime
+import json
+import struct
+import zlib
 from StringIO import StringIO
+from xml.parsers import expat
 from xml.sax import make_parser
 from xml.sax.handler import ContentHandler
 from xml.sax.saxutils import escape, quoteattr
@@ -318,6 +352,243 @@ class SolrException(Exception):
         return 'HTTP code=%s, reason=%s' % (self.httpcode, self.reason)
 
 
+class PoolTimeout(SolrException):
+    """ No pooled HTTP connection became available in time """
+
+
+# ===================================================================
+# Connection Pool
+# ===================================================================
+
+# Defaults for new pools. Change them before the first connection is
+# made, or set the SOLR_POOL_* environment variables. Besides the Zope
+# request threads, the query threads of alm.solrindex.parallel and the
+# update threads of alm.solrindex.dispatcher each hold a connection
+# while they talk to Solr, so the default size makes room for them.
+pool_max_size = int(os.environ.get('SOLR_POOL_SIZE', 10 +
+                    int(os.environ.get('SOLR_QUERY_WORKERS', 4)) +
+                    int(os.environ.get('SOLR_UPDATE_WORKERS', 2))))
+pool_idle_timeout = float(os.environ.get('SOLR_POOL_IDLE_TIMEOUT', 60))
+pool_wait_timeout = float(os.environ.get('SOLR_POOL_WAIT_TIMEOUT', 30))
+
+# The default gzip_min_size of new SolrConnections; 0 disables
+# compression of requests.
+default_gzip_min_size = int(os.environ.get('SOLR_GZIP_MIN_SIZE', 0))
+
+
+class HTTPConnectionPool(object):
+    """
+    A thread-safe pool of HTTP connections to one Solr host.
+
+    SolrConnections borrow a connection for each request with get() and
+    give it back with put(), so the number of sockets is bounded by
+    the number of concurrent requests rather than the number of
+    SolrConnections. At most max_size connections are open at once;
+    get() waits up to wait_timeout seconds for one to be returned, then
+    raises PoolTimeout. Connections idle for more than idle_timeout
+    seconds are closed.
+    """
+
+    def __init__(self, factory, max_size=None, idle_timeout=None,
+                 wait_timeout=None):
+        self.factory = factory
+        if max_size is None:
+            max_size = pool_max_size
+        if idle_timeout is None:
+            idle_timeout = pool_idle_timeout
+        if wait_timeout is None:
+            wait_timeout = pool_wait_timeout
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []  # [(time returned, connection)], newest last
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+        self.evicted = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.request_bytes_saved = 0
+        self.response_bytes_saved = 0
+
+    def get(self):
+        """ Borrow a connection, creating one if the pool allows """
+        self._cond.acquire()
+        try:
+            deadline = None
+            while True:
+                self._evict()
+                if self._idle:
+                    conn = self._idle.pop()[1]
+                    self.reused += 1
+                    break
+                if self.in_use < self.max_size:
+                    conn = None
+                    self.created += 1
+                    break
+                now = time.time()
+                if deadline is None:
+                    self.waits += 1
+                    deadline = now + self.wait_timeout
+                elif now >= deadline:
+                    self.timeouts += 1
+                    raise PoolTimeout(None, "No free connection after "
+                                      "%s seconds" % self.wait_timeout)
+                self._cond.wait(deadline - now)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        finally:
+            self._cond.release()
+        if conn is None:
+            try:
+                conn = self.factory()
+            except:
+                self.put(None)
+                raise
+        return conn
+
+    def put(self, conn, reuse=True):
+        """ Return a borrowed connection.
+
+        If reuse is false (or the connection is None) the connection is
+        closed instead of being kept for the next get().
+        """
+        self._cond.acquire()
+        try:
+            self.in_use -= 1
+            if conn is not None:
+                if reuse:
+                    self._idle.append((time.time(), conn))
+                else:
+                    conn.close()
+                    self.closed += 1
+            self._evict()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _evict(self):
+        # The oldest connections are at the start of the list.
+        limit = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][0] < limit:
+            self._idle.pop(0)[1].close()
+            self.evicted += 1
+
+    def count_bytes_saved(self, request, response):
+        """ Add the bytes gzip saved on a request and its response """
+        self._cond.acquire()
+        try:
+            self.request_bytes_saved += request
+            self.response_bytes_saved += response
+        finally:
+            self._cond.release()
+
+    def clear(self):
+        """ Close all idle connections """
+        self._cond.acquire()
+        try:
+            while self._idle:
+                self._idle.pop()[1].close()
+                self.closed += 1
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        """ Return a dict of counters for sizing the pool """
+        self._cond.acquire()
+        try:
+            return {
+                'max_size': self.max_size,
+                'in_use': self.in_use,
+                'idle': len(self._idle),
+                'peak_in_use': self.peak_in_use,
+                'created': self.created,
+                'reused': self.reused,
+                'closed': self.closed,
+                'evicted': self.evicted,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'request_bytes_saved': self.request_bytes_saved,
+                'response_bytes_saved': self.response_bytes_saved,
+                }
+        finally:
+            self._cond.release()
+
+
+def new_http_connection(scheme, host, timeout=None, ssl_key=None,
+                        ssl_cert=None):
+    """ Open an HTTP connection to a Solr host """
+    kwargs = {}
+
+    if timeout and _python_version >= 2.6 and _python_version < 3:
+        kwargs['timeout'] = timeout
+
+    if scheme == 'https':
+        conn = httplib.HTTPSConnection(host,
+               key_file=ssl_key, cert_file=ssl_cert, **kwargs)
+    else:
+        conn = httplib.HTTPConnection(host, **kwargs)
+
+    # Set timeout, if applicable.
+    if timeout and _python_version < 2.6:
+        conn.connect()
+        if scheme == 'http':
+            conn.sock.settimeout(timeout)
+        elif scheme == 'https':
+            conn.sock.sock.settimeout(timeout)
+    return conn
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, factory=None):
+    """ Return the process-wide pool for key, creating it if needed
+
+    key is (scheme, host, timeout, ssl_key, ssl_cert). The pool opens
+    connections with factory(), by default new_http_connection(*key).
+    """
+    pool = _pools.get(key)
+    if pool is None:
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(key)
+            if pool is None:
+                if factory is None:
+                    factory = lambda: new_http_connection(*key)
+                pool = _pools[key] = HTTPConnectionPool(factory)
+        finally:
+            _pools_lock.release()
+    return pool
+
+
+def pool_stats():
+    """ Return {'scheme://host': stats} for all connection pools """
+    res = {}
+    for key, pool in _pools.items():
+        name = '%s://%s' % key[:2]
+        if name in res:
+            # The same host with other timeout or SSL settings
+            name = '%s %r' % (name, key[2:])
+        res[name] = pool.stats()
+    return res
+
+
+def clear_pools():
+    """ Close the idle connections of all pools and forget the pools """
+    _pools_lock.acquire()
+    try:
+        for pool in _pools.values():
+            pool.clear()
+        _pools.clear()
+    finally:
+        _pools_lock.release()
+
+
 # ===================================================================
 # Connection Object
 # ===================================================================
@@ -329,12 +600,19 @@ class SolrConnection:
     (though 2.1 will likely work.)
     """
 
+    # The size of the chunks of streamed request bodies
+    chunk_size = 64 * 1024
+
     def __init__(self, url,
                  persistent=True,
                  timeout=None,
                  ssl_key=None,
                  ssl_cert=None,
-                 post_headers={}):
+                 post_headers={},
+                 response_format='xml',
+                 update_format='xml',
+                 accept_gzip=True,
+                 gzip_min_size=None):
 
         """
             url -- URI pointing to the SOLR instance. Examples:
@@ -355,6 +633,20 @@ class SolrConnection:
                 SSL authentication,  these should be, respectively,
                 your PEM key file and certificate file
 
+            response_format -- 'xml' (default), 'json' or 'javabin'.
+                The format SOLR should use when responding to queries.
+
+            update_format -- 'xml' (default) or 'json'. The format of
+                the update commands sent to SOLR. 'json' posts to
+                /update/json, which needs SOLR 3.1 or later.
+
+            accept_gzip -- Accept gzip compressed responses. Defaults
+                to true.
+
+            gzip_min_size -- Compress request bodies of at least this
+                many bytes. 0 disables compression. Defaults to the
+                SOLR_GZIP_MIN_SIZE environment variable.
+
         """
 
         self.scheme, self.host, self.path = urlparse.urlparse(url, 'http')[:3]
@@ -362,23 +654,29 @@ class SolrConnection:
 
         assert self.scheme in ('http', 'https')
 
+        if response_format not in response_parsers:
+            raise ValueError(
+                "Unknown response_format: %r" % (response_format,))
+        self.response_format = response_format
+
+        if update_format not in update_paths:
+            raise ValueError(
+                "Unknown update_format: %r" % (update_format,))
+        self.update_format = update_format
+
         self.persistent = persistent
         self.reconnects = 0
+        self.bytes_sent = 0
+        if gzip_min_size is None:
+            gzip_min_size = default_gzip_min_size
+        self.gzip_min_size = gzip_min_size
+        self.request_bytes_saved = 0
+        self.response_bytes_saved = 0
+        self._request_saved = 0
         self.timeout = timeout
         self.ssl_key = ssl_key
         self.ssl_cert = ssl_cert
 
-        kwargs = {}
-
-        if self.timeout and _python_version >= 2.6 and _python_version < 3:
-            kwargs['timeout'] = self.timeout
-
-        if self.scheme == 'https':
-            self.conn = httplib.HTTPSConnection(self.host,
-                   key_file=ssl_key, cert_file=ssl_cert, **kwargs)
-        else:
-            self.conn = httplib.HTTPConnection(self.host, **kwargs)
-
         # this is int, not bool!
         self.batch_cnt = 0
         self.response_version = 2.2
@@ -387,19 +685,24 @@ class SolrConnection:
         # Responses from Solr will always be in UTF-8
         self.decoder = codecs.getdecoder('utf-8')
 
-        # Set timeout, if applicable.
-        if self.timeout and _python_version < 2.6:
-            self.conn.connect()
-            if self.scheme == 'http':
-                self.conn.sock.settimeout(self.timeout)
-            elif self.scheme == 'https':
-                self.conn.sock.sock.settimeout(self.timeout)
+        # HTTP connections are borrowed from a pool shared by all
+        # SolrConnections to the same host for the time of a request.
+        self.pool = get_pool(
+            (self.scheme, self.host, timeout, ssl_key, ssl_cert))
+        self.conn = None
+        self._response = None
 
         self.xmlheaders = {'Content-Type': 'text/xml; charset=utf-8'}
         self.xmlheaders.update(post_headers)
         if not self.persistent:
             self.xmlheaders['Connection'] = 'close'
 
+        self.json_headers = {
+                'Content-Type': 'application/json; charset=utf-8'}
+        self.json_headers.update(post_headers)
+        if not self.persistent:
+            self.json_headers['Connection'] = 'close'
+
         self.form_headers = {
                 'Content-Type':
                 'application/x-www-form-urlencoded; charset=utf-8'}
@@ -407,11 +710,40 @@ class SolrConnection:
         if not self.persistent:
             self.form_headers['Connection'] = 'close'
 
+        if accept_gzip:
+            for headers in (self.xmlheaders, self.json_headers,
+                            self.form_headers):
+                headers['Accept-Encoding'] = 'gzip'
+
+    def _release(self):
+        """
+        Give the HTTP connection back to the pool.
+
+        The socket is kept for reuse only if the connection is
+        persistent and the last response was read completely.
+        """
+        conn = self.conn
+        if conn is None:
+            return
+        rsp = self._response
+        self.conn = None
+        self._response = None
+        reuse = self.persistent and rsp is not None and rsp.isclosed()
+        request_saved = self._request_saved
+        response_saved = getattr(rsp, 'bytes_saved', 0)
+        self._request_saved = 0
+        if request_saved or response_saved:
+            self.request_bytes_saved += request_saved
+            self.response_bytes_saved += response_saved
+            self.pool.count_bytes_saved(request_saved, response_saved)
+        self.pool.put(conn, reuse)
+
     def close(self):
-        self.conn.close()
+        self._release()
 
     def query(self, q, fields=None, highlight=None,
-              score=True, sort=None, sort_order="asc", **params):
+              score=True, sort=None, sort_order="asc", response_format=None,
+              **params):
         """
         q is the query string.
 
@@ -436,7 +768,11 @@ class SolrConnection:
 
         sort_order defaults to "asc" and specifies the order to sort the fields
         in. sort_order must be "asc" or "desc", otherwise a ValueError is
-        raised.
+        raised. sort_order can also be a list with an order for each
+        field in sort.
+
+        response_format is "xml", "json" or "javabin" and defaults to
+        the response_format of the connection.
 
         Optional parameters can also be passed in.  Many SOLR
         parameters are in a dotted notation (e.g., hl.simple.post).
@@ -446,6 +782,66 @@ class SolrConnection:
         Returns a Response instance.
         """
 
+        params, response_format = self._query_params(
+            q, fields, highlight, score, sort, sort_order, response_format,
+            params)
+        parse = response_parsers[response_format]
+
+        try:
+            rsp = self._post(self.path + '/select',
+                              urllib.urlencode(params, doseq=True),
+                              self.form_headers)
+            # If we pass in rsp directly, instead of using rsp.read(),
+            # then Persistence breaks with an internal python error.
+            data = parse(rsp.read(), params=params, connection=self)
+
+        finally:
+            self._release()
+
+        return data
+
+    def query_ids(self, q, unique_key, result, scale=1000, highlight=None,
+                  sort=None, sort_order="asc", response_format=None,
+                  **params):
+        """
+        Query for the unique keys and scores of the matching documents.
+
+        unique_key is the name of the integer unique key field.
+
+        result is a mapping. As the response streams in, this method
+        sets result[int(key)] = int(score * scale) for every matching
+        document, without building a document dict (or, for XML, any
+        parse tree) per match.
+
+        The other arguments are the same as for query(). Returns a
+        Response instance holding everything else SOLR sent (header,
+        numFound, highlighting, ...); its results list is empty.
+        """
+        params, response_format = self._query_params(
+            q, unique_key, highlight, True, sort, sort_order,
+            response_format, params)
+        parse_ids = id_response_parsers[response_format]
+
+        try:
+            rsp = self._post(self.path + '/select',
+                              urllib.urlencode(params, doseq=True),
+                              self.form_headers)
+            data = parse_ids(rsp, unique_key, result, scale)
+            data._params = params
+            data._connection = self
+
+        finally:
+            self._release()
+
+        return data
+
+    def _query_params(self, q, fields, highlight, score, sort, sort_order,
+                      response_format, params):
+        """
+        Build the parameters of a /select call.
+
+        Returns the parameters and the name of the response format.
+        """
         # Clean up optional parameters to match SOLR spec.
         params = dict([(key.replace('_', '.'), value)
                       for key, value in params.items()])
@@ -475,35 +871,44 @@ class SolrConnection:
             fields = '*'
 
         if sort:
-            if not sort_order or sort_order not in ("asc", "desc"):
-                raise ValueError("sort_order must be 'asc' or 'desc'")
-            if not isinstance(sort, basestring):
-                sort = ",".join(sort)
-            params['sort'] = "%s %s" % (sort, sort_order)
+            if isinstance(sort_order, (list, tuple)):
+                if (isinstance(sort, basestring) or
+                        len(sort) != len(sort_order)):
+                    raise ValueError("sort_order must have an order for "
+                                     "each field in sort")
+                orders = sort_order
+            else:
+                orders = [sort_order]
+                if not isinstance(sort, basestring):
+                    sort = [",".join(sort)]
+                else:
+                    sort = [sort]
+            for order in orders:
+                if not order or order not in ("asc", "desc"):
+                    raise ValueError("sort_order must be 'asc' or 'desc'")
+            params['sort'] = ",".join(["%s %s" % (field, order)
+                                       for field, order in zip(sort, orders)])
 
         if score and not 'score' in fields.replace(',', ' ').split():
             fields += ',score'
 
         params['fl'] = fields
-        params['version'] = self.response_version
-        params['wt'] = 'standard'
-
-        request = urllib.urlencode(params, doseq=True)
-
-        try:
-            rsp = self._post(self.path + '/select',
-                              request, self.form_headers)
-            # If we pass in rsp directly, instead of using rsp.read())
-            # and creating a StringIO, then Persistence breaks with
-            # an internal python error.
-            xml = StringIO(rsp.read())
-            data = parse_query_response(xml,  params=params, connection=self)
-
-        finally:
-            if not self.persistent:
-                self.close()
+        if response_format is None:
+            response_format = self.response_format
+        if response_format not in response_parsers:
+            raise ValueError(
+                "Unknown response_format: %r" % (response_format,))
+        if response_format == 'json':
+            params['wt'] = 'json'
+            # Named lists become JSON objects, like <lst> becomes a dict
+            params['json.nl'] = 'map'
+        elif response_format == 'javabin':
+            params['wt'] = 'javabin'
+        else:
+            params['version'] = self.response_version
+            params['wt'] = 'standard'
 
-        return data
+        return params, response_format
 
     def begin_batch(self):
         """
@@ -531,9 +936,10 @@ class SolrConnection:
         """
         Denote the end of a batch update.
 
-        Sends any queued commands to the backend server.
+        Sends any queued commands to the backend server in one
+        request.
 
-        If `commit` is True, then a <commit/> command is included
+        If `commit` is True, then a commit command is included
         at the end of the list of commands sent.
         """
         batch_cnt = self.batch_cnt - 1
@@ -546,28 +952,41 @@ class SolrConnection:
             return False
 
         if commit:
-            self.__batch_queue.append('<commit/>')
+            self.__batch_queue.append(self._commit_command())
 
-        return self._update("".join(self.__batch_queue))
+        if not self.__batch_queue:
+            return
+        return self._post_update(self.__batch_queue)
 
-    def delete(self, id):
+    def delete(self, id, commit_within=None):
         """
         Delete a specific document by id.
+
+        If commit_within is given, SOLR commits the deletion within
+        that many milliseconds.
         """
-        xstr = u'<delete><id>%s</id></delete>' % escape(unicode(id))
+        if self.update_format == 'json':
+            return self._update(_json_command(
+                'delete', {'id': unicode(id)}, commit_within))
+        xstr = u'<delete%s><id>%s</id></delete>' % (
+            _commit_within_attr(commit_within), escape(unicode(id)))
         return self._update(xstr)
 
-    def delete_many(self, ids):
+    def delete_many(self, ids, commit_within=None):
         """
         Delete documents using a list of IDs.
         """
-        [self.delete(id) for id in ids]
+        [self.delete(id, commit_within) for id in ids]
 
-    def delete_query(self, query):
+    def delete_query(self, query, commit_within=None):
         """
         Delete all documents returned by a query.
         """
-        xstr = u'<delete><query>%s</query></delete>' % escape(query)
+        if self.update_format == 'json':
+            return self._update(_json_command(
+                'delete', {'query': query}, commit_within))
+        xstr = u'<delete%s><query>%s</query></delete>' % (
+            _commit_within_attr(commit_within), escape(query))
         return self._update(xstr)
 
     def add(self, _commit=False, **fields):
@@ -578,38 +997,111 @@ class SolrConnection:
         Example:
             connection.add(id="mydoc", author="Me")
         """
-        lst = [u'<add>']
-        self.__add(lst, fields)
-        lst.append(u'</add>')
-        xstr = ''.join(lst)
+        if self.update_format == 'json':
+            xstr = _json_command('add', {'doc': _json_doc(fields)})
+        else:
+            lst = [u'<add>']
+            _xml_doc(lst, fields)
+            lst.append(u'</add>')
+            xstr = ''.join(lst)
         if not _commit:
             return self._update(xstr)
         else:
             self._update(xstr)
             return self.commit()
 
-    def add_many(self, docs, _commit=False):
+    def add_many(self, docs, _commit=False, commit_within=None,
+                 stream=False):
         """
         Add several documents to the SOLR server.
 
         docs -- a list of dicts, where each dict is a document to add
             to SOLR.
+
+        commit_within -- if given, SOLR commits the documents within
+            that many milliseconds.
+
+        stream -- if true, and no batch is open, serialize the documents
+            one at a time while sending them with chunked transfer
+            encoding, instead of building the whole request first.
+            docs may then be any iterable. The request is retried after
+            a connection error only if docs is a list or tuple.
         """
-        lst = [u'<add>']
-        for doc in docs:
-            self.__add(lst, doc)
-        lst.append(u'</add>')
-        xstr = ''.join(lst)
+        if stream and not self.batch_cnt:
+            fmt = self.update_format
+            retry = isinstance(docs, (list, tuple))
+            data = self._post_stream(
+                self.path + update_paths[fmt],
+                lambda: self._add_chunks(
+                    (serialize_doc(doc, fmt, commit_within)
+                     for doc in docs), commit_within),
+                self._update_headers(), retry)
+            if not _commit:
+                return data
+            return self.commit()
+
+        if self.update_format == 'json':
+            # One "add" per document; SOLR accepts repeated keys.
+            xstr = ','.join([
+                _json_command('add', {'doc': _json_doc(doc)}, commit_within)
+                for doc in docs])
+        else:
+            lst = [u'<add%s>' % _commit_within_attr(commit_within)]
+            for doc in docs:
+                _xml_doc(lst, doc)
+            lst.append(u'</add>')
+            xstr = ''.join(lst)
         if not _commit:
             return self._update(xstr)
         else:
             self._update(xstr)
             return self.commit()
 
-    def commit(self, wait_flush=True, wait_searcher=True, _optimize=False):
+    def add_serialized(self, docs, _commit=False):
+        """
+        Add documents serialized with serialize_doc() in this
+        connection's update_format, streaming them like
+        add_many(stream=True). Batches are not supported.
+
+        docs -- an iterable of byte strings. The request is retried
+            after a connection error only if docs is a list or tuple.
+        """
+        data = self._post_stream(
+            self.path + update_paths[self.update_format],
+            lambda: self._add_chunks(docs, None),
+            self._update_headers(), isinstance(docs, (list, tuple)))
+        if not _commit:
+            return data
+        return self.commit()
+
+    def commit(self, wait_flush=True, wait_searcher=True, _optimize=False,
+               soft_commit=False):
         """
         Issue a commit command to the SOLR server.
+
+        If soft_commit is true, SOLR makes the changes visible without
+        flushing them to stable storage (SOLR 4.0+).
         """
+        return self._update(self._commit_command(
+            wait_flush, wait_searcher, _optimize, soft_commit))
+
+    def _commit_command(self, wait_flush=True, wait_searcher=True,
+                        _optimize=False, soft_commit=False):
+        if _optimize:
+            name = 'optimize'
+        else:
+            name = 'commit'
+
+        if self.update_format == 'json':
+            options = {}
+            if not wait_searcher:
+                options['waitSearcher'] = False
+                if not wait_flush:
+                    options['waitFlush'] = False
+            if soft_commit:
+                options['softCommit'] = True
+            return _json_command(name, options)
+
         # just handle deviations from the default
         if not wait_searcher:
             if not wait_flush:
@@ -618,13 +1110,10 @@ class SolrConnection:
                 options = 'waitSearcher="false"'
         else:
             options = ''
+        if soft_commit:
+            options = (options + ' softCommit="true"').lstrip()
 
-        if _optimize:
-            xstr = u'<optimize %s/>' % options
-        else:
-            xstr = u'<commit %s/>' % options
-
-        return self._update(xstr)
+        return u'<%s %s/>' % (name, options)
 
     def optimize(self, wait_flush=True, wait_searcher=True, ):
         """
@@ -652,8 +1141,7 @@ class SolrConnection:
                               request, self.form_headers)
             data = rsp.read()
         finally:
-            if not self.persistent:
-                self.close()
+            self._release()
 
         return data
 
@@ -664,14 +1152,125 @@ class SolrConnection:
             self.__batch_queue.append(request)
             return
 
+        return self._post_update([request])
+
+    def _update_headers(self):
+        if self.update_format == 'json':
+            return self.json_headers
+        return self.xmlheaders
+
+    def _post_update(self, commands):
+        """Send a list of update commands in one request"""
+        commands = [c for c in commands if c]
+        if self.update_format == 'json':
+            request = '{%s}' % ','.join(commands)
+        else:
+            request = u''.join(commands)
+            if len(commands) > 1:
+                # Several commands need a root element to be well-formed.
+                request = u'<update>%s</update>' % request
+
         try:
-            rsp = self._post(self.path + '/update',
-                              request, self.xmlheaders)
+            rsp = self._post(self.path + update_paths[self.update_format],
+                              request, self._update_headers())
             data = rsp.read()
         finally:
-            if not self.persistent:
-                self.close()
+            self._release()
+        return self._check_update_response(rsp, data)
 
+    def _add_chunks(self, serialized, commit_within):
+        """Generate the UTF-8 body of an add request, document by document
+        """
+        if self.update_format == 'json':
+            yield '{'
+            sep = ''
+            for doc in serialized:
+                yield sep + doc
+                sep = ','
+            yield '}'
+        else:
+            yield (u'<add%s>' % _commit_within_attr(commit_within)).encode(
+                'UTF-8')
+            for doc in serialized:
+                yield doc
+            yield '</add>'
+
+    def _post_stream(self, url, make_chunks, headers, retry=False):
+        """POST the byte strings of make_chunks() as a chunked body.
+
+        Small strings are combined into chunks of about chunk_size
+        bytes. If retry is true, the request is sent again with a new
+        iterable from make_chunks() after a connection error.
+        """
+        attempts = retry and 2 or 1
+        try:
+            while attempts:
+                if self.conn is None:
+                    self.conn = self.pool.get()
+                try:
+                    self._send_chunked(url, make_chunks(), headers)
+                    self._response = decompress_response(
+                        self.conn.getresponse())
+                    rsp = check_response_status(self._response)
+                    break
+                except (socket.error,
+                        httplib.ImproperConnectionState,
+                        httplib.BadStatusLine):
+                    self._reconnect()
+                    attempts -= 1
+                    if not attempts:
+                        raise
+            data = rsp.read()
+        finally:
+            self._release()
+        return self._check_update_response(rsp, data)
+
+    def _send_chunked(self, url, chunks, headers):
+        conn = self.conn
+        compressor = None
+        if self.gzip_min_size:
+            # The size is not known in advance, so always compress.
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+        conn.putrequest('POST', url,
+                        skip_accept_encoding='Accept-Encoding' in headers)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        if compressor is not None:
+            conn.putheader('Content-Encoding', 'gzip')
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        self._request_saved = 0
+
+        def send(data):
+            size = len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+                self._request_saved += size - len(data)
+            if data:
+                # An empty chunk would end the body.
+                conn.send('%x\r\n%s\r\n' % (len(data), data))
+                self.bytes_sent += len(data)
+
+        buf = []
+        size = 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= self.chunk_size:
+                send(''.join(buf))
+                buf = []
+                size = 0
+        if size:
+            send(''.join(buf))
+        if compressor is not None:
+            data = compressor.flush()
+            self._request_saved -= len(data)
+            conn.send('%x\r\n%s\r\n' % (len(data), data))
+            self.bytes_sent += len(data)
+        conn.send('0\r\n\r\n')
+
+    def _check_update_response(self, rsp, data):
         # Detect old-style error response (HTTP response code
         # of 200 with a non-zero status.
         if data.startswith('<result status="') and \
@@ -684,44 +1283,16 @@ class SolrConnection:
                 raise SolrException(rsp.status, reason)
         return data
 
-    def __add(self, lst, fields):
-        lst.append(u'<doc>')
-        for field, value in fields.items():
-            # Handle multi-valued fields if values
-            # is passed in as a list/tuple
-            if not isinstance(value, (list, tuple)):
-                values = [value]
-            else:
-                values = value
-
-            for value in values:
-                # ignore values that are not defined
-                if value == None:
-                    continue
-                # Do some basic data conversion
-                if isinstance(value, datetime.date):
-                    value = datetime.datetime.combine(
-                        value,
-                        datetime.time(tzinfo=UTC()))
-                if isinstance(value, datetime.datetime):
-                    value = utc_to_string(value)
-                elif isinstance(value, bool):
-                    value = value and 'true' or 'false'
-
-                lst.append('<field name=%s>%s</field>' % (
-                    (quoteattr(field),
-                    escape(unicode(value)))))
-        lst.append('</doc>')
-
     def __repr__(self):
         return ('<SolrConnection (url=%s, '
-                'persistent=%s, post_headers=%s, reconnects=%s)>') % (
+                'persistent=%s, post_headers=%s, reconnects=%s, '
+                'response_format=%s)>') % (
             self.url, self.persistent,
-            self.xmlheaders, self.reconnects)
+            self.xmlheaders, self.reconnects, self.response_format)
 
     def _reconnect(self):
         self.reconnects += 1
-        self.close()
+        self.conn.close()
         self.conn.connect()
         if self.timeout and _python_version < 2.6:
             if self.scheme == 'http':
@@ -730,11 +1301,25 @@ class SolrConnection:
                 self.conn.sock.sock.settimeout(self.timeout)
 
     def _post(self, url, body, headers):
+        if self.conn is None:
+            self.conn = self.pool.get()
+        if isinstance(body, unicode):
+            body = body.encode('UTF-8')
+        if self.gzip_min_size and len(body) >= self.gzip_min_size:
+            compressed = gzip_compress(body)
+            if len(compressed) < len(body):
+                self._request_saved = len(body) - len(compressed)
+                body = compressed
+                headers = dict(headers)
+                headers['Content-Encoding'] = 'gzip'
         attempts = 2  # allow up to 2 attempts
         while attempts:
             try:
-                self.conn.request('POST', url, body.encode('UTF-8'), headers)
-                return check_response_status(self.conn.getresponse())
+                self.conn.request('POST', url, body, headers)
+                self._response = decompress_response(
+                    self.conn.getresponse())
+                self.bytes_sent += len(body)
+                return check_response_status(self._response)
             except (socket.error,
                     httplib.ImproperConnectionState,
                     httplib.BadStatusLine):
@@ -829,7 +1414,11 @@ class Response(object):
 def parse_query_response(data, params, connection):
     """
     Parse the XML results of a /select call.
+
+    `data` is either a file-like object or a string.
     """
+    if isinstance(data, basestring):
+        data = StringIO(data)
     parser = make_parser()
     handler = ResponseContentHandler()
     parser.setContentHandler(handler)
@@ -946,6 +1535,470 @@ class Results(list):
     pass
 
 
+# ===================================================================
+# JSON Parsing support
+# ===================================================================
+def parse_json_response(data, params, connection):
+    """
+    Parse the JSON results (wt=json, json.nl=map) of a /select call.
+
+    Builds the same Response and Results objects as the XML parser,
+    including the string-valued numFound/start/maxScore attributes.
+    Note that JSON has no date type, so date fields are returned as
+    the ISO 8601 strings SOLR sends.
+    """
+    tree = json.loads(data)
+    response = Response(connection)
+    response._params = params
+    for name, value in tree.items():
+        if name == 'responseHeader':
+            response.header = value
+        elif name == 'response':
+            results = Results(value.get('docs', ()))
+            for attr_name in ('numFound', 'start', 'maxScore'):
+                attr_value = value.get(attr_name)
+                if attr_value is not None:
+                    # The XML parser copies these from the attributes
+                    # of <result>, so they are strings there too.
+                    attr_value = unicode(attr_value)
+                    setattr(results, attr_name, attr_value)
+                    setattr(response, attr_name, attr_value)
+            response.results = results
+        else:
+            setattr(response, name, value)
+    return response
+
+
+# ===================================================================
+# Id/score streaming support
+# ===================================================================
+def parse_id_response(stream, unique_key, result, scale=1000,
+                      chunk_size=65536):
+    """
+    Parse the XML results of a /select call that only asked for the
+    unique key and score.
+
+    `stream` is a file-like object (such as an httplib response) or a
+    string. Matching documents are stored in `result` as they are read
+    (see SolrConnection.query_ids); the rest of the response is returned
+    as a Response.
+    """
+    handler = IdResponseHandler(unique_key, result, scale)
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.startElement
+    parser.EndElementHandler = handler.endElement
+    parser.CharacterDataHandler = handler.characters
+    if isinstance(stream, basestring):
+        parser.Parse(stream, True)
+    else:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            parser.Parse(chunk, False)
+        parser.Parse('', True)
+    return handler.response
+
+
+class IdResponseHandler(object):
+    """
+    Expat handler for parse_id_response.
+
+    Inside the top level <result>, only the unique key and score of
+    each <doc> are looked at. Everything else is converted the same
+    way ResponseContentHandler converts it, but without Node objects.
+    """
+    def __init__(self, unique_key, result, scale):
+        self.unique_key = unique_key
+        self.result = result
+        self.scale = scale
+        self.response = Response(None)
+        # (tag, name, chars, children) of the open elements outside
+        # of the top level <result>
+        self.stack = []
+        self.in_result = False
+        # Inside <result>: the name of the element whose text is being
+        # collected, and the values found in the current <doc>
+        self.field = None
+        self.chars = []
+        self.doc_id = None
+        self.doc_score = None
+
+    def startElement(self, tag, attrs):
+        if self.in_result:
+            name = attrs.get('name')
+            if name == self.unique_key or name == 'score':
+                self.field = name
+                self.chars = []
+            else:
+                self.field = None
+            return
+
+        if not self.stack:
+            if tag != 'response':
+                raise SolrException(
+                    "Unknown XML response from server: <%s ..." % tag)
+        elif tag == 'result' and len(self.stack) == 1:
+            self.in_result = True
+            response = self.response
+            for attr_name, value in attrs.items():
+                if attr_name != 'name':
+                    setattr(response, attr_name, value)
+            return
+
+        self.stack.append((tag, attrs.get('name'), [], []))
+
+    def characters(self, data):
+        if self.in_result:
+            if self.field is not None:
+                self.chars.append(data)
+        else:
+            self.stack[-1][2].append(data)
+
+    def endElement(self, tag):
+        if self.in_result:
+            field = self.field
+            if field is not None:
+                if field == 'score':
+                    self.doc_score = ''.join(self.chars)
+                else:
+                    self.doc_id = ''.join(self.chars)
+                self.field = None
+            elif tag == 'doc':
+                if self.doc_id is not None:
+                    score = self.doc_score
+                    if score:
+                        score = int(float(score) * self.scale)
+                    else:
+                        score = 0
+                    self.result[int(self.doc_id)] = score
+                self.doc_id = self.doc_score = None
+            elif tag == 'result':
+                self.in_result = False
+            return
+
+        tag, name, chars, children = self.stack.pop()
+        if tag == 'response':
+            response = self.response
+            for name, value in children:
+                if name == 'responseHeader':
+                    name = 'header'
+                setattr(response, name, value)
+            return
+
+        if tag in ('lst', 'doc'):
+            value = dict(children)
+        elif tag == 'arr':
+            value = [child[1] for child in children]
+        elif tag == 'result':
+            value = Results([child[1] for child in children])
+        else:
+            value = ''.join(chars)
+            if tag == 'str':
+                pass
+            elif tag == 'int':
+                value = int(value.strip())
+            elif tag == 'long':
+                value = long(value.strip())
+            elif tag in ('float', 'double'):
+                value = float(value.strip())
+            elif tag == 'bool':
+                value = value.strip().lower().startswith('t')
+            elif tag == 'date':
+                value = utc_from_string(value.strip())
+            elif tag == 'null':
+                value = None
+            else:
+                raise SolrException("Unknown tag: %s" % tag)
+        self.stack[-1][3].append((name, value))
+
+
+def parse_json_id_response(data, unique_key, result, scale=1000):
+    """
+    Parse the JSON results of a /select call that only asked for the
+    unique key and score. See parse_id_response.
+    """
+    if not isinstance(data, basestring):
+        data = data.read()
+    tree = json.loads(data)
+    response = Response(None)
+    for name, value in tree.items():
+        if name == 'responseHeader':
+            response.header = value
+        elif name == 'response':
+            for doc in value.get('docs', ()):
+                result[int(doc[unique_key])] = int(
+                    doc.get('score', 0) * scale)
+            for attr_name in ('numFound', 'start', 'maxScore'):
+                attr_value = value.get(attr_name)
+                if attr_value is not None:
+                    setattr(response, attr_name, unicode(attr_value))
+        else:
+            setattr(response, name, value)
+    return response
+
+
+# ===================================================================
+# javabin Parsing support
+# ===================================================================
+def parse_javabin_response(data, params, connection):
+    """
+    Parse the javabin results (wt=javabin) of a /select call.
+
+    Builds the same Response and Results objects as the XML parser.
+    """
+    if not isinstance(data, basestring):
+        data = data.read()
+    tree = JavaBinDecoder(data).decode()
+    response = Response(connection)
+    response._params = params
+    for name, value in tree.items():
+        if name == 'responseHeader':
+            response.header = value
+        elif name == 'response':
+            for attr_name in ('numFound', 'start', 'maxScore'):
+                attr_value = getattr(value, attr_name, None)
+                if attr_value is not None:
+                    setattr(response, attr_name, attr_value)
+            response.results = value
+        else:
+            setattr(response, name, value)
+    return response
+
+
+def parse_javabin_id_response(data, unique_key, result, scale=1000):
+    """
+    Parse the javabin results of a /select call that only asked for the
+    unique key and score. See parse_id_response.
+    """
+    response = parse_javabin_response(data, params={}, connection=None)
+    for doc in response.results:
+        result[int(doc[unique_key])] = int(doc.get('score', 0) * scale)
+    response.results = []
+    return response
+
+
+_END = object()   # Marks the end of javabin iterators
+_byte = struct.Struct('>b')
+_short = struct.Struct('>h')
+_int = struct.Struct('>i')
+_long = struct.Struct('>q')
+_float = struct.Struct('>f')
+_double = struct.Struct('>d')
+
+
+class JavaBinDecoder(object):
+    """
+    Decoder for the javabin format of SOLR's BinaryResponseWriter.
+
+    Only version 2 of the format (SOLR 4.0+) is supported. Named lists
+    and documents become dicts, document lists become Results, dates
+    become datetimes, just like in the XML parser.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.strings = []   # for EXTERN_STRING
+
+    def decode(self):
+        version = ord(self.data[0])
+        if version != 2:
+            raise SolrException(
+                "Unsupported javabin version: %d" % version)
+        self.pos = 1
+        return self.read_val()
+
+    def read_val(self):
+        tag = ord(self.data[self.pos])
+        self.pos += 1
+        # The upper 3 bits of some tags hold the type, the lower 5 bits
+        # hold the size or part of the value.
+        kind = tag >> 5
+        if kind:
+            return self._tag_readers[kind](self, tag)
+        reader = self._type_readers.get(tag)
+        if reader is None:
+            raise SolrException("Unknown javabin type: %d" % tag)
+        return reader(self)
+
+    def read_vint(self):
+        data = self.data
+        pos = self.pos
+        b = ord(data[pos])
+        pos += 1
+        value = b & 0x7f
+        shift = 7
+        while b & 0x80:
+            b = ord(data[pos])
+            pos += 1
+            value |= (b & 0x7f) << shift
+            shift += 7
+        self.pos = pos
+        return value
+
+    def read_size(self, tag):
+        size = tag & 0x1f
+        if size == 0x1f:
+            size += self.read_vint()
+        return size
+
+    def _unpack(self, st):
+        value = st.unpack_from(self.data, self.pos)[0]
+        self.pos += st.size
+        return value
+
+    def _read_bytes(self, size):
+        start = self.pos
+        self.pos = start + size
+        return self.data[start:self.pos]
+
+    # Readers for the types stored in the upper 3 bits of the tag
+
+    def read_str(self, tag):
+        return self._read_bytes(self.read_size(tag)).decode('utf-8')
+
+    def read_small_int(self, tag):
+        value = tag & 0x0f
+        if tag & 0x10:
+            value |= self.read_vint() << 4
+        return value
+
+    def read_array(self, tag):
+        read_val = self.read_val
+        return [read_val() for i in xrange(self.read_size(tag))]
+
+    def read_named_list(self, tag):
+        read_val = self.read_val
+        result = {}
+        for i in xrange(self.read_size(tag)):
+            name = read_val()
+            result[name] = read_val()
+        return result
+
+    def read_extern_string(self, tag):
+        index = self.read_size(tag)
+        if index:
+            return self.strings[index - 1]
+        value = self.read_val()
+        self.strings.append(value)
+        return value
+
+    _tag_readers = {
+        1: read_str,
+        2: read_small_int,
+        3: read_small_int,   # SLONG
+        4: read_array,
+        5: read_named_list,  # ORDERED_MAP
+        6: read_named_list,  # NAMED_LST
+        7: read_extern_string,
+        }
+
+    # Readers for the types stored in the whole tag
+
+    def read_map(self):
+        read_val = self.read_val
+        result = {}
+        for i in xrange(self.read_vint()):
+            key = read_val()
+            result[key] = read_val()
+        return result
+
+    def read_document(self):
+        tag = ord(self.data[self.pos])
+        self.pos += 1
+        read_val = self.read_val
+        doc = {}
+        for i in xrange(self.read_size(tag)):
+            name = read_val()
+            if isinstance(name, dict):
+                # A nested child document
+                doc.setdefault('_childDocuments_', []).append(name)
+                continue
+            doc[name] = read_val()
+        return doc
+
+    def read_document_list(self):
+        numFound, start, maxScore = self.read_val()
+        results = Results(self.read_val())
+        # The XML parser copies these from the attributes of <result>,
+        # so they are strings there.
+        results.numFound = unicode(numFound)
+        results.start = unicode(start)
+        if maxScore is not None:
+            results.maxScore = unicode(maxScore)
+        return results
+
+    def read_iterator(self):
+        result = []
+        read_val = self.read_val
+        while True:
+            value = read_val()
+            if value is _END:
+                return result
+            result.append(value)
+
+    def read_map_entry_iter(self):
+        result = {}
+        read_val = self.read_val
+        while True:
+            key = read_val()
+            if key is _END:
+                return result
+            result[key] = read_val()
+
+    def read_enum(self):
+        self.read_val()         # the ordinal
+        return self.read_val()  # the name
+
+    def read_date(self):
+        return _epoch + datetime.timedelta(milliseconds=self._unpack(_long))
+
+    _type_readers = {
+        0: lambda self: None,
+        1: lambda self: True,
+        2: lambda self: False,
+        3: lambda self: self._unpack(_byte),
+        4: lambda self: self._unpack(_short),
+        5: lambda self: self._unpack(_double),
+        6: lambda self: self._unpack(_int),
+        7: lambda self: self._unpack(_long),
+        8: lambda self: self._unpack(_float),
+        9: read_date,
+        10: read_map,
+        11: read_document,
+        12: read_document_list,
+        13: lambda self: self._read_bytes(self.read_vint()),
+        14: read_iterator,
+        15: lambda self: _END,
+        17: read_map_entry_iter,
+        18: read_enum,
+        19: lambda self: (self.read_val(), self.read_val()),
+        }
+
+
+# Maps each response_format to the function that parses it
+response_parsers = {
+    'xml': parse_query_response,
+    'json': parse_json_response,
+    'javabin': parse_javabin_response,
+    }
+
+# Maps each response_format to the function that parses id/score
+# responses for SolrConnection.query_ids
+id_response_parsers = {
+    'xml': parse_id_response,
+    'json': parse_json_id_response,
+    'javabin': parse_javabin_id_response,
+    }
+
+# Maps each update_format to the path SolrConnection posts updates to
+update_paths = {
+    'xml': '/update',
+    'json': '/update/json',
+    }
+
+
 class Node(object):
     """
     A temporary object used in XML processing. Not seen by end user.
@@ -972,6 +2025,153 @@ class Node(object):
 # ===================================================================
 # Misc utils
 # ===================================================================
+def _convert_value(value):
+    """Convert dates and booleans to their SOLR representation"""
+    if isinstance(value, datetime.date):
+        value = datetime.datetime.combine(
+            value,
+            datetime.time(tzinfo=UTC()))
+    if isinstance(value, datetime.datetime):
+        value = utc_to_string(value)
+    elif isinstance(value, bool):
+        value = value and 'true' or 'false'
+    return value
+
+
+def _xml_doc(lst, fields):
+    """Append the XML of a document to lst"""
+    lst.append(u'<doc>')
+    for field, value in fields.items():
+        # Handle multi-valued fields if values
+        # is passed in as a list/tuple
+        if not isinstance(value, (list, tuple)):
+            values = [value]
+        else:
+            values = value
+
+        for value in values:
+            # ignore values that are not defined
+            if value == None:
+                continue
+            # Do some basic data conversion
+            value = _convert_value(value)
+
+            lst.append('<field name=%s>%s</field>' % (
+                (quoteattr(field),
+                escape(unicode(value)))))
+    lst.append('</doc>')
+
+
+def serialize_doc(fields, update_format='xml', commit_within=None):
+    """Return one document of an add request as a UTF-8 byte string.
+
+    SolrConnection.add_serialized() sends documents serialized in its
+    update_format. commit_within only applies to the JSON format; XML
+    has it on the enclosing <add>.
+    """
+    if update_format == 'json':
+        return _json_command('add', {'doc': _json_doc(fields)}, commit_within)
+    lst = []
+    _xml_doc(lst, fields)
+    return u''.join(lst).encode('UTF-8')
+
+
+def _json_doc(fields):
+    """Return a document as a dict that json.dumps() can serialize"""
+    doc = {}
+    for field, value in fields.items():
+        if isinstance(value, (list, tuple)):
+            values = [_json_value(v) for v in value if v is not None]
+            if values:
+                doc[field] = values
+        elif value is not None:
+            doc[field] = _json_value(value)
+    return doc
+
+
+def _json_value(value):
+    value = _convert_value(value)
+    if isinstance(value, (basestring, int, long, float)):
+        return value
+    return unicode(value)
+
+
+def _json_command(name, body, commit_within=None):
+    """Return one '"name": {...}' member of a JSON update request.
+
+    The result is an ASCII byte string, so it needs no further encoding.
+    """
+    if commit_within is not None:
+        body['commitWithin'] = commit_within
+    return '"%s":%s' % (name, json.dumps(body, separators=(',', ':')))
+
+
+def _commit_within_attr(commit_within):
+    if commit_within is None:
+        return u''
+    return u' commitWithin="%d"' % commit_within
+
+
+def gzip_compress(data, level=6):
+    """ Return data compressed in the gzip format """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipResponse(object):
+    """
+    Decompresses a gzip encoded HTTP response as it is read.
+
+    bytes_saved is the number of bytes decompression has added so far.
+    """
+
+    chunk_size = 16384
+
+    def __init__(self, response):
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.bytes_saved = 0
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = ''
+        self._done = False
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def isclosed(self):
+        return self.response.isclosed()
+
+    def _decompress(self, data):
+        if data:
+            res = self._decompressor.decompress(data)
+        else:
+            res = self._decompressor.flush()
+            self._done = True
+        self.bytes_saved += len(res) - len(data)
+        self._buffer += res
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self._done:
+                self._decompress(self.response.read())
+            data, self._buffer = self._buffer, ''
+            return data
+        while len(self._buffer) < size and not self._done:
+            self._decompress(self.response.read(self.chunk_size))
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+
+def decompress_response(response):
+    """ Wrap response in a GzipResponse if it is gzip encoded """
+    encoding = response.getheader('content-encoding', '')
+    if encoding.lower() == 'gzip':
+        return GzipResponse(response)
+    return response
+
+
 def check_response_status(response):
     if response.status != 200:
         ex = SolrException(response.status, response.reason)
@@ -1002,6 +2202,7 @@ class UTC(datetime.tzinfo):
 
 
 utc = UTC()
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=utc)
 
 
 def utc_to_string(value):
@@ -0,0 +1,321 @@
+import unittest
+
+
+class SendChangesTests(unittest.TestCase):
+
+    def _callFUT(self, connection, changes, batch_size=100):
+        from alm.solrindex.dispatcher import send_changes
+        return send_changes(connection, changes, batch_size)
+
+    def test_keeps_order(self):
+        c = DummySolrConnection()
+        self._callFUT(c, [('add', {'docid': 1}), ('delete', 2),
+                          ('add', {'docid': 3}), ('delete_query', 'q')])
+        self.assertEqual(c.batches, [[
+            ('add_many', [{'docid': 1}]),
+            ('delete', 2),
+            ('add_many', [{'docid': 3}]),
+            ('delete_query', 'q'),
+            ]])
+
+    def test_batch_size(self):
+        c = DummySolrConnection()
+        self._callFUT(c, [('delete', 1), ('delete', 2), ('delete', 3)], 2)
+        self.assertEqual(c.batches, [
+            [('delete', 1), ('delete', 2)],
+            [('delete', 3)],
+            ])
+
+    def test_commit_within(self):
+        from alm.solrindex.dispatcher import send_changes
+        c = DummySolrConnection()
+        send_changes(c, [('add', {'docid': 1})], commit_within=500)
+        self.assertEqual(c.commit_within, 500)
+
+
+class CommitPolicyTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from alm.solrindex.dispatcher import CommitPolicy
+        return CommitPolicy(*args, **kw)
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, self._makeOne, 'sometimes')
+
+    def test_hard(self):
+        c = DummySolrConnection()
+        policy = self._makeOne('hard', wait_searcher=False)
+        self.assertEqual(policy.commit_within, None)
+        policy.commit(c)
+        self.assertEqual(c.commit_args, {
+            'wait_flush': True, 'wait_searcher': False,
+            'soft_commit': False})
+
+    def test_soft(self):
+        c = DummySolrConnection()
+        self._makeOne('soft').commit(c)
+        self.assertEqual(c.commit_args['soft_commit'], True)
+
+    def test_within(self):
+        c = DummySolrConnection()
+        policy = self._makeOne('within', within=250)
+        self.assertEqual(policy.commit_within, 250)
+        policy.commit(c)
+        self.assertEqual(c.commits, 0)
+
+    def test_none(self):
+        c = DummySolrConnection()
+        policy = self._makeOne('none')
+        self.assertEqual(policy.commit_within, None)
+        policy.commit(c)
+        self.assertEqual(c.commits, 0)
+
+    def test_visibility_delay(self):
+        self.assertEqual(self._makeOne('hard').visibility_delay, 0)
+        self.assertEqual(self._makeOne('soft').visibility_delay, 0)
+        self.assertEqual(
+            self._makeOne('hard', wait_searcher=False).visibility_delay, None)
+        self.assertEqual(
+            self._makeOne('within', within=1500).visibility_delay, 1.5)
+        self.assertEqual(self._makeOne('none').visibility_delay, None)
+
+    def test_matches(self):
+        class DummySolrIndex:
+            commit_strategy = 'soft'
+            commit_within = 1000
+            wait_flush = True
+            wait_searcher = True
+        index = DummySolrIndex()
+        policy = self._makeOne('soft')
+        self.assert_(policy.matches(index))
+        index.wait_searcher = False
+        self.failIf(policy.matches(index))
+
+    def test_equality(self):
+        self.assertEqual(self._makeOne('soft'), self._makeOne('soft'))
+        self.assertNotEqual(self._makeOne('soft'), self._makeOne('hard'))
+        self.assertNotEqual(self._makeOne('within', within=1),
+                            self._makeOne('within', within=2))
+
+
+class UpdateDispatcherTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from alm.solrindex.dispatcher import UpdateDispatcher
+        return UpdateDispatcher
+
+    def _makeOne(self, workers=2, retry_delay=0.001, **kw):
+        self.connections = []
+        self.arrived = []
+
+        def connection_factory(solr_uri, response_format, update_format):
+            if solr_uri == 'bad uri':
+                raise ValueError(solr_uri)
+            c = DummySolrConnection(solr_uri, self.arrived)
+            self.connections.append(c)
+            return c
+        return self._getTargetClass()(
+            workers=workers, queue_size=2,
+            connection_factory=connection_factory, retry_delay=retry_delay,
+            **kw)
+
+    def test_dispatch_and_flush(self):
+        d = self._makeOne()
+        try:
+            for i in range(5):
+                d.dispatch('http://a', 'xml', [('delete', i)])
+            d.flush()
+            self.assertEqual(d.sent, 5)
+            deleted = []
+            commits = 0
+            for c in self.connections:
+                deleted.extend(c.deleted)
+                commits += c.commits
+            self.assertEqual(sorted(deleted), range(5))
+            self.assertEqual(commits, 5)
+            # At most one connection per worker and Solr URI
+            self.assert_(len(self.connections) <= 2)
+        finally:
+            d.shutdown()
+
+    def test_dispatch_to_shards(self):
+        from alm.solrindex.parallel import query_executor
+        from alm.solrindex.shards import shard_number
+        self.addCleanup(query_executor.shutdown)
+        d = self._makeOne(workers=1)
+        d.dispatch('http://a', 'xml', [('delete', i) for i in range(6)],
+                   shard_uris=('http://b', 'http://c'))
+        d.shutdown()
+        self.assertEqual(d.sent, 1)
+        self.assertEqual([c.uri for c in self.connections],
+                         ['http://b', 'http://c'])
+        for n, c in enumerate(self.connections):
+            self.assertEqual(c.deleted, [i for i in range(6)
+                                         if shard_number(i, 2) == n])
+            self.assertEqual(c.commits, 1)
+
+    def test_shutdown_drains_queue(self):
+        d = self._makeOne(workers=1)
+        d.dispatch('http://a', 'xml', [('delete', 1)])
+        d.dispatch('http://b', 'xml', [('delete', 2)])
+        d.shutdown()
+        self.assertEqual(d.sent, 2)
+        self.assertEqual([c.uri for c in self.connections],
+                         ['http://a', 'http://b'])
+        self.assert_(self.connections[0].closed)
+
+    def test_same_uri_keeps_commit_order(self):
+        d = self._makeOne(workers=4)
+        try:
+            # The first transaction is slow to send, but the delete of
+            # the second must not overtake its add.
+            d.dispatch('http://a', 'xml',
+                       [('slow', 0.05), ('add', {'docid': 1})])
+            d.dispatch('http://a', 'xml', [('delete', 1)])
+            d.flush()
+            self.assertEqual(self.arrived, [('add', [1]), ('delete', 1)])
+        finally:
+            d.shutdown()
+
+    def test_uris_are_spread_over_workers(self):
+        d = self._makeOne(workers=4)
+        queues = set([id(d.queue_for('http://host%d/solr' % i))
+                      for i in range(20)])
+        self.assert_(len(queues) > 1)
+        self.assert_(d.queue_for('http://a') is d.queue_for('http://a'))
+
+    def test_temporary_failure_is_retried(self):
+        d = self._makeOne(workers=1)
+        state = {'failures': 2}
+        d.dispatch('http://a', 'xml', [('flaky', state), ('delete', 1)])
+        d.dispatch('http://a', 'xml', [('delete', 2)])
+        d.flush()
+        d.shutdown()
+        self.assertEqual(d.retries, 2)
+        self.assertEqual(d.failed, 0)
+        self.assertEqual(d.sent, 2)
+        self.assertEqual(self.arrived, [('delete', 1), ('delete', 2)])
+        # A new connection for each attempt
+        self.assertEqual(len(self.connections), 3)
+
+    def test_shutdown_stops_retrying(self):
+        import time
+        d = self._makeOne(workers=1, retry_delay=30)
+        d.dispatch('http://a', 'xml', [('flaky', {'failures': 100})])
+        while not d.retries:
+            time.sleep(0.001)
+        d.shutdown()
+        self.assertEqual(d.failed, 1)
+        self.assertEqual(d.sent, 0)
+
+    def test_retries_stop_after_max_retry_time(self):
+        d = self._makeOne(workers=1, max_retry_time=0.05)
+        d.dispatch('http://a', 'xml', [('flaky', {'failures': 10000})])
+        d.dispatch('http://a', 'xml', [('flaky', {'failures': 1})])
+        d.dispatch('http://b', 'xml', [('delete', 1)])
+        d.flush()
+        retries = d.retries
+        self.assertEqual(d.failed, 2)
+        self.assertEqual(d.sent, 1)
+        # Solr is back, so the next failure is retried again.
+        d.dispatch('http://a', 'xml', [('delete', 2)])
+        d.dispatch('http://a', 'xml', [('flaky', {'failures': 1})])
+        d.flush()
+        d.shutdown()
+        self.assertEqual(d.sent, 3)
+        self.assertEqual(d.retries, retries + 1)
+
+    def test_connection_error_does_not_stop_worker(self):
+        d = self._makeOne(workers=1)
+        d.dispatch('bad uri', 'xml', [('delete', 1)])
+        d.dispatch('http://a', 'xml', [('delete', 2)])
+        d.shutdown()
+        self.assertEqual(d.failed, 1)
+        self.assertEqual(d.sent, 1)
+
+    def test_unexpected_error_does_not_stop_worker(self):
+        d = self._makeOne(workers=1)
+        d.start()
+        d.queue_for('http://a').put(('http://a',))
+        d.dispatch('http://a', 'xml', [('delete', 2)])
+        d.shutdown()
+        self.assertEqual(d.failed, 1)
+        self.assertEqual(d.sent, 1)
+
+    def test_rejected_update_is_not_retried(self):
+        from alm.solrindex.solrpycore import SolrException
+        d = self._makeOne(workers=1)
+        d.dispatch('http://a', 'xml',
+                   [('fail', SolrException(400, 'Bad Request'))])
+        d.shutdown()
+        self.assertEqual(d.retries, 0)
+        self.assertEqual(d.failed, 1)
+
+    def test_failure_is_logged(self):
+        d = self._makeOne(workers=1)
+        d.dispatch('http://a', 'xml', [('fail', None)])
+        d.dispatch('http://a', 'xml', [('delete', 1)])
+        d.shutdown()
+        self.assertEqual(d.failed, 1)
+        self.assertEqual(d.sent, 1)
+        # The failed connection was replaced.
+        self.assertEqual(len(self.connections), 2)
+        self.assert_(self.connections[0].closed)
+
+
+class DummySolrConnection:
+
+    closed = False
+
+    def __init__(self, uri=None, arrived=None):
+        self.uri = uri
+        if arrived is None:
+            arrived = []
+        self.arrived = arrived
+        self.batches = []
+        self.batch = None
+        self.deleted = []
+        self.commits = 0
+
+    def begin_batch(self):
+        self.batch = []
+
+    def end_batch(self, commit=False):
+        self.batches.append(self.batch)
+        self.batch = None
+
+    def add_many(self, docs, commit_within=None):
+        self.batch.append(('add_many', docs))
+        self.arrived.append(('add', [doc['docid'] for doc in docs]))
+        self.commit_within = commit_within
+
+    def delete(self, id, commit_within=None):
+        self.batch.append(('delete', id))
+        self.arrived.append(('delete', id))
+        self.deleted.append(id)
+        self.commit_within = commit_within
+
+    def delete_query(self, q, commit_within=None):
+        self.batch.append(('delete_query', q))
+        self.commit_within = commit_within
+
+    def fail(self, exc):
+        if exc is None:
+            exc = ValueError('Unparsable response')
+        raise exc
+
+    def flaky(self, state):
+        if state['failures']:
+            state['failures'] -= 1
+            raise IOError('Connection refused')
+
+    def slow(self, seconds):
+        import time
+        time.sleep(seconds)
+
+    def commit(self, **kw):
+        self.commits += 1
+        self.commit_args = kw
+
+    def close(self):
+        self.closed = True
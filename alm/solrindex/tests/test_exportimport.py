@@ -13,6 +13,20 @@ _SOLRINDEX_XML = """\
   <element value="utf-8"/>
  </property>
  <property name="catalog_name">portal_catalog</property>
+ <property name="response_format">xml</property>
+ <property name="update_format">xml</property>
+ <property name="async_updates">False</property>
+ <property name="commit_strategy">hard</property>
+ <property name="commit_within">1000</property>
+ <property name="wait_flush">True</property>
+ <property name="wait_searcher">True</property>
+ <property name="query_cache_max_age">0</property>
+ <property name="cursor_page_size">0</property>
+ <property name="max_results">0</property>
+ <property name="lazy_page_size">0</property>
+ <property name="candidate_filter_size">0</property>
+ <property name="parallel_queries">False</property>
+ <property name="shard_uris"/>
 </index>
 """ % _SOLR_URI
 
@@ -235,6 +235,44 @@ class DateFieldHandlerTests(unittest.TestCase):
         self.assertEqual(query, {
             'fq': r'dummyfield:[2015\-12\-04T00\:00\:00.000Z TO 2015\-12\-05T00\:00\:00.000Z]'})
 
+    def test_parse_query_range_rounding(self):
+        from DateTime.DateTime import DateTime
+        field = DummyField()
+        handler = self._getTargetClass()(rounding='minute')
+        t1 = DateTime('2026-10-18 09:13:21.455 UTC')
+        t2 = DateTime('2026-10-18 10:15:00 UTC')
+        query = handler.parse_query(field, {'query': t1, 'range': 'min'})
+        self.assertEqual(
+            query, {'fq': r'dummyfield:[2026\-10\-18T09\:13\:00.000Z TO *]'})
+        query = handler.parse_query(field, {'query': t1, 'range': 'max'})
+        self.assertEqual(
+            query, {'fq': r'dummyfield:[* TO 2026\-10\-18T09\:14\:00.000Z]'})
+        query = handler.parse_query(
+            field, {'query': [t1, t2], 'range': 'min:max'})
+        self.assertEqual(query, {'fq': r'dummyfield:['
+            r'2026\-10\-18T09\:13\:00.000Z TO 2026\-10\-18T10\:15\:00.000Z]'})
+
+    def test_parse_query_range_date_math(self):
+        import datetime
+        from DateTime.DateTime import DateTime
+        field = DummyField()
+        handler = self._getTargetClass()(rounding='day', date_math=True)
+        handler.now = lambda: datetime.datetime(2026, 10, 18, 9, 13, 21)
+        query = handler.parse_query(
+            field, {'query': DateTime('2026-10-18 09:13:21 UTC'),
+                    'range': 'max'})
+        self.assertEqual(query, {'fq': u'dummyfield:[* TO NOW/DAY+1DAY]'})
+        query = handler.parse_query(
+            field, {'query': [DateTime('2026-10-11 12:00 UTC'),
+                              DateTime('2026-10-18 00:00 UTC')],
+                    'range': 'min:max'})
+        self.assertEqual(
+            query, {'fq': u'dummyfield:[NOW/DAY-7DAY TO NOW/DAY]'})
+
+    def test_invalid_rounding(self):
+        self.assertRaises(ValueError, self._getTargetClass(), rounding='week')
+        self.assertRaises(ValueError, self._getTargetClass(), date_math=True)
+
 
 class TextFieldHandlerTests(unittest.TestCase):
 
@@ -271,5 +309,45 @@ class TextFieldHandlerTests(unittest.TestCase):
             {'q': u'+dummyfield:((fun OR play) +with Solr^4)'})
 
 
+class GetConverterTests(unittest.TestCase):
+
+    def _callFUT(self, handler):
+        from alm.solrindex.handlers import get_converter
+        return get_converter(handler)
+
+    def _assertConvertsLikeHandler(self, handler, values):
+        convert = self._callFUT(handler)
+        for value in values:
+            self.assertEqual(convert(value), handler.convert(value))
+
+    def test_default(self):
+        from alm.solrindex.handlers import DefaultFieldHandler
+        self._assertConvertsLikeHandler(DefaultFieldHandler(), [
+            None, u'abc', u'a\x00b', 'caf\xc3\xa9', 5, [u'a', 'b'], ()])
+
+    def test_bool(self):
+        from alm.solrindex.handlers import BoolFieldHandler
+        self._assertConvertsLikeHandler(BoolFieldHandler(), [
+            None, True, False, 0, 'x', [True, False]])
+
+    def test_date(self):
+        import datetime
+        from DateTime.DateTime import DateTime
+        from alm.solrindex.handlers import DateFieldHandler
+        self._assertConvertsLikeHandler(DateFieldHandler(), [
+            None, DateTime('2009-09-08 11:51:34.000 UTC'),
+            datetime.date(2009, 9, 8), [datetime.date(2009, 9, 8)]])
+
+    def test_subclass(self):
+        from alm.solrindex.handlers import DefaultFieldHandler
+
+        class UpperFieldHandler(DefaultFieldHandler):
+            def convert_one(self, value):
+                return value.upper()
+        handler = UpperFieldHandler()
+        self.assertEqual(self._callFUT(handler), handler.convert)
+        self.assertEqual(self._callFUT(handler)(u'a'), [u'A'])
+
+
 class DummyField:
     name = 'dummyfield'
@@ -1,3 +1,4 @@
+from Acquisition import Implicit
 import unittest
 from zope.testing.cleanup import cleanUp
 
@@ -70,6 +71,13 @@ class SolrIndexTests(unittest.TestCase):
         self.assertEqual(cm.connection.added,
             [{'f1': ['a'], 'f2': ['b'], 'docid': 2}])
 
+    def test_get_values(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        plan = index.connection_manager.schema.indexing_plan()
+        self.assertEqual(index.get_values(DummyIndexableObject(), plan),
+                         [u'a', u'b'])
+
     def test_unindex_object(self):
         self._registerConnectionManager()
         index = self._makeOne('id', 'someuri')
@@ -105,6 +113,58 @@ class SolrIndexTests(unittest.TestCase):
         self.assertEqual(cm.connection.queries, [
             {'q': "f1:somequery", 'fields': 'docid'}])
 
+    def test__apply_index_query_cache(self):
+        from alm.solrindex.querycache import query_cache
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.query_cache_max_age = 60
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 5, 'score': 0.25}],
+                                 [{'docid': 6}]]
+        result1, queried1 = index._apply_index({'f1': 'somequery'})
+        result1[7] = 0  # The catalog may change its result set.
+        result2, queried2 = index._apply_index({'f1': 'somequery'})
+        self.assertEqual(len(cm.connection.queries), 1)
+        self.assertEqual(dict(result2.items()), {5: 250})
+        self.assertEqual(list(queried2), ['f1'])
+        query_cache.invalidate('someuri')
+        result3, queried3 = index._apply_index({'f1': 'somequery'})
+        self.assertEqual(len(cm.connection.queries), 2)
+        self.assertEqual(dict(result3.items()), {6: 0})
+
+    def test__apply_index_query_cache_per_limits(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.query_cache_max_age = 60
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 5}], [{'docid': 6}]]
+        index._apply_index({'f1': 'somequery'})
+        # Another index on the same Solr with other limits
+        index.max_results = 1
+        result, queried = index._apply_index({'f1': 'somequery'})
+        self.assertEqual(len(cm.connection.queries), 2)
+        self.assertEqual(list(result.keys()), [6])
+
+    def test__apply_index_query_cache_unknown_visibility(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.query_cache_max_age = 60
+        index.commit_strategy = 'none'
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 5}], [{'docid': 5}]]
+        index._apply_index({'f1': 'somequery'})
+        index._apply_index({'f1': 'somequery'})
+        self.assertEqual(len(cm.connection.queries), 2)
+
+    def test__apply_index_query_cache_disabled(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 5}], [{'docid': 5}]]
+        index._apply_index({'f1': 'somequery'})
+        index._apply_index({'f1': 'somequery'})
+        self.assertEqual(len(cm.connection.queries), 2)
+
     def test__apply_index_no_matching_fields(self):
         self._registerConnectionManager()
         index = self._makeOne('id', 'someuri')
@@ -215,6 +275,390 @@ class SolrIndexTests(unittest.TestCase):
         self.assertEqual(cm.connection.queries, [
             {'q': 'f1:someuri', 'fields': 'docid', 'highlight': [f2.name]}])
 
+    def test__apply_index_cursor_paging(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.cursor_page_size = 2
+        cm = index.connection_manager
+        cm.connection.results = [
+            DummyPage([{'docid': 1}, {'docid': 2}], 'AoE1', {'1': 'a'}),
+            DummyPage([{'docid': 3}, {'docid': 4}], 'AoE2', {'3': 'b'}),
+            DummyPage([{'docid': 5}], 'AoE3'),
+            ]
+        result, queried = index._apply_index({'f1': 'somequery'})
+        self.assertEqual(list(result.keys()), [1, 2, 3, 4, 5])
+        self.assertEqual(
+            [(q['cursorMark'], q['rows'], q['sort'], q['sort_order'])
+             for q in cm.connection.queries],
+            [('*', 2, 'docid', 'asc'), ('AoE1', 2, 'docid', 'asc'),
+             ('AoE2', 2, 'docid', 'asc')])
+
+    def test__apply_index_cursor_paging_last_page(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.cursor_page_size = 2
+        cm = index.connection_manager
+        cm.connection.results = [
+            DummyPage([{'docid': 1}, {'docid': 2}], 'AoE1'),
+            DummyPage([], 'AoE1'),
+            ]
+        result, queried = index._apply_index({'f1': 'somequery'})
+        self.assertEqual(list(result.keys()), [1, 2])
+        self.assertEqual(len(cm.connection.queries), 2)
+
+    def test__apply_index_cursor_paging_max_results(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.cursor_page_size = 2
+        index.max_results = 3
+        cm = index.connection_manager
+        cm.connection.results = [
+            DummyPage([{'docid': 1}, {'docid': 2}], 'AoE1'),
+            DummyPage([{'docid': 3}], 'AoE2'),
+            ]
+        result, queried = index._apply_index({'f1': 'somequery'})
+        self.assertEqual(list(result.keys()), [1, 2, 3])
+        self.assertEqual([q['rows'] for q in cm.connection.queries], [2, 1])
+
+    def test__apply_index_cursor_paging_max_results_sharded(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.cursor_page_size = 2
+        index.max_results = 3
+        cm = index.connection_manager
+        # Two shards return up to rows each.
+        cm.connection.results = [
+            DummyPage([{'docid': 1}, {'docid': 4}, {'docid': 2},
+                       {'docid': 5}], '[1]'),
+            DummyPage([], '[1]'),
+            ]
+        result, queried = index._apply_index({'f1': 'somequery'})
+        self.assertEqual(list(result.keys()), [1, 2, 4])
+        self.assertEqual(len(cm.connection.queries), 1)
+
+    def test__apply_index_cursor_paging_explicit_rows(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.cursor_page_size = 2
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 1}]]
+        request = {'f1': 'somequery', 'solr_params': {'rows': 10}}
+        index._apply_index(request)
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid', 'rows': 10}])
+
+    def _wrapInSite(self, index, *other_indexes):
+        catalog = DummyCatalog()
+        catalog.indexes[index.getId()] = index
+        for other in other_indexes:
+            catalog.indexes[other.getId()] = other
+        site = DummySite()
+        site.portal_catalog = DummyCatalogTool(catalog)
+        return index.__of__(site)
+
+    def _makeSiblings(self, parallel=True):
+        self._registerConnectionManager()
+        first = self._makeOne('id', 'someuri')
+        files = self._makeOne('files', 'otheruri')
+        first.parallel_queries = files.parallel_queries = parallel
+        catalog = DummyCatalog()
+        catalog.indexes['id'] = first
+        catalog.indexes['files'] = files
+        site = DummySite()
+        site.portal_catalog = DummyCatalogTool(catalog)
+        return first.__of__(site), files.__of__(site)
+
+    def test__apply_index_parallel_queries(self):
+        import threading
+        first, files = self._makeSiblings()
+        started = threading.Event()
+        overlapped = []
+
+        def files_query_ids(*args, **kw):
+            started.set()
+            return DummySolrConnection.query_ids(
+                files.connection_manager.connection, *args, **kw)
+
+        def first_query_ids(*args, **kw):
+            # Wait until the other query is running.
+            overlapped.append(started.wait(5))
+            return DummySolrConnection.query_ids(
+                first.connection_manager.connection, *args, **kw)
+        first.connection_manager.connection.query_ids = first_query_ids
+        files.connection_manager.connection.query_ids = files_query_ids
+        first.connection_manager.connection.results = [[{'docid': 1}]]
+        files.connection_manager.connection.results = [[{'docid': 2}]]
+
+        request = {'f1': 'somequery', 'id': 'x', 'files': 'x'}
+        result, queried = first._apply_index(request)
+        self.assertEqual(overlapped, [True])
+        self.assertEqual(list(result.keys()), [1])
+        result, queried = files._apply_index(request, result)
+        self.assertEqual(list(result.keys()), [2])
+        self.assertEqual(queried, ['f1'])
+        self.assertEqual(len(files.connection_manager.connection.queries), 1)
+
+    def test__apply_index_parallel_queries_off(self):
+        first, files = self._makeSiblings(parallel=False)
+        first.connection_manager.connection.results = [[{'docid': 1}]]
+        request = {'f1': 'somequery', 'id': 'x', 'files': 'x'}
+        first._apply_index(request)
+        self.assertEqual(files.connection_manager.connection.queries, [])
+
+    def test__apply_index_parallel_only_queried_indexes(self):
+        first, files = self._makeSiblings()
+        executor = self._replaceExecutor()
+        first.connection_manager.connection.results = [[{'docid': 1}]]
+        first._apply_index({'f1': 'somequery', 'id': 'x'})
+        self.assertEqual(executor.submitted, [])
+
+    def test__apply_index_parallel_query_error(self):
+        first, files = self._makeSiblings()
+        first.connection_manager.connection.results = [[{'docid': 1}]]
+        # files has no results, so its query fails.
+        request = {'f1': 'somequery', 'id': 'x', 'files': 'x'}
+        first._apply_index(request)
+        self.assertRaises(IndexError, files._apply_index, request)
+
+    def test__apply_index_started_for_other_request(self):
+        first, files = self._makeSiblings()
+        executor = self._replaceExecutor()
+        first.connection_manager.connection.results = [[{'docid': 1}]]
+        files.connection_manager.connection.results = [[{'docid': 3}]]
+        first._apply_index({'f1': 'somequery', 'id': 'x', 'files': 'x'})
+        # A new search cancels the query left over from the earlier one.
+        result, queried = files._apply_index({'f1': 'other', 'files': 'x'})
+        self.assertEqual(list(result.keys()), [3])
+        self.assertEqual(executor.submitted[0]._started, True)
+        self.assertEqual(len(files.connection_manager.connection.queries), 1)
+
+    def test__apply_index_parallel_query_connection(self):
+        first, files = self._makeSiblings()
+        executor = self._replaceExecutor()
+        files_cm = files.connection_manager
+        files_cm.new_connection = lambda: DummySolrConnection('worker')
+        first.connection_manager.connection.results = [[{'docid': 1}]]
+        first._apply_index({'f1': 'somequery', 'id': 'x', 'files': 'x'})
+        # The worker does not share the connection of the request.
+        query = executor.submitted[0].func.im_self
+        self.assertEqual(query.connection.uri, 'worker')
+
+    def _replaceExecutor(self):
+        from alm.solrindex import index
+        executor = DummyQueryExecutor()
+        original = index.query_executor
+        index.query_executor = executor
+
+        def restore():
+            index.query_executor = original
+            index._cancel_started_queries()
+        self.addCleanup(restore)
+        return executor
+
+    def test__apply_index_lazy(self):
+        from alm.solrindex.lazy import LazyResult
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.lazy_page_size = 2
+        index = self._wrapInSite(index, DummyIndex('path'))
+        cm = index.connection_manager
+        cm.connection.results = [
+            DummyPage([{'docid': 4, 'score': 2}, {'docid': 1, 'score': 1}],
+                      None),
+            DummyPage([{'docid': 3, 'score': 0.5}], None),
+            ]
+        result, queried = index._apply_index({'f1': 'somequery'})
+        self.assertTrue(isinstance(result, LazyResult))
+        self.assertEqual(queried, ['f1'])
+        self.assertEqual(len(result), 5)
+        self.assertEqual(result[1], (1000, 1))
+        self.assertEqual(len(cm.connection.queries), 1)
+        self.assertEqual(result[2], (500, 3))
+        self.assertEqual(
+            [(q['rows'], q['start']) for q in cm.connection.queries],
+            [(2, 0), (2, 2)])
+
+    def test__apply_index_lazy_with_other_index(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.lazy_page_size = 2
+        index = self._wrapInSite(index, DummyIndex('path'))
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 1}, {'docid': 2}]]
+        result, queried = index._apply_index(
+            {'f1': 'somequery', 'path': '/plone'})
+        self.assertEqual(list(result.keys()), [1, 2])
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid'}])
+
+    def test__apply_index_lazy_sorted(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.lazy_page_size = 2
+        index = self._wrapInSite(index)
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 1}, {'docid': 2}]]
+        result, queried = index._apply_index(
+            {'f1': 'somequery', 'sort_on': 'id'})
+        self.assertEqual(list(result.keys()), [1, 2])
+        self.assertFalse('rows' in cm.connection.queries[0])
+
+    def test__apply_index_sort_push_down(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index = self._wrapInSite(index, DummyIndex('path'), DummyIndex('f2'))
+        cm = index.connection_manager
+        cm.connection.results = [
+            DummyPage([{'docid': 3}, {'docid': 1}], None)]
+        request = {'f1': 'somequery', 'sort_on': 'f2',
+                   'sort_order': 'reverse', 'sort_limit': 2}
+        result, queried = index._apply_index(request)
+        self.assertEqual(list(result.keys()), [1, 3])
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid', 'rows': 2,
+             'sort': ['f2', 'docid'], 'sort_order': ['desc', 'desc']}])
+        # The catalog reports all matches as actual_result_count.
+        self.assertEqual(len(result), 5)
+
+    def test__apply_index_sort_push_down_batch(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index = self._wrapInSite(index, DummyIndex('f2'))
+        cm = index.connection_manager
+        cm.connection.results = [DummyPage([{'docid': 3}], None)]
+        result, queried = index._apply_index(
+            {'f1': 'somequery', 'sort_on': 'f2', 'sort_limit': 10,
+             'b_start': 1, 'b_size': 1})
+        # The catalog limits to b_start + b_size.
+        self.assertEqual(cm.connection.queries[0]['rows'], 2)
+        self.assertEqual(len(result), 5)
+
+    def test__apply_index_sort_push_down_batch_from_end(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index = self._wrapInSite(index, DummyIndex('f2'))
+        cm = index.connection_manager
+        docs = [{'docid': docid} for docid in range(1, 6)]
+        cm.connection.results = [DummyPage(docs[:4], None),
+                                 DummyPage(docs, None)]
+        result, queried = index._apply_index(
+            {'f1': 'somequery', 'sort_on': 'f2', 'sort_limit': 4,
+             'b_start': 3, 'b_size': 1})
+        # The catalog sorts the batch from the end, so it gets all
+        # matches.
+        self.assertEqual([q['rows'] for q in cm.connection.queries], [4, 5])
+        self.assertEqual(list(result.keys()), [1, 2, 3, 4, 5])
+        self.assertEqual(len(result), 5)
+
+    def test__apply_index_sort_push_down_needs_limit(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index = self._wrapInSite(index, DummyIndex('f2'))
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 3}]]
+        index._apply_index({'f1': 'somequery', 'sort_on': 'f2'})
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid'}])
+
+    def test__apply_index_sort_push_down_unknown_field(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index = self._wrapInSite(index, DummyIndex('modified'))
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 3}]]
+        index._apply_index(
+            {'f1': 'somequery', 'sort_on': 'modified', 'sort_limit': 2})
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid'}])
+
+    def test__apply_index_sort_push_down_needs_sortable_field(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index = self._wrapInSite(index, DummyIndex('f2'))
+        cm = index.connection_manager
+        f2 = cm.schema.fields[1]
+        request = {'f1': 'somequery', 'sort_on': 'f2', 'sort_limit': 2}
+        for attr, value in (('java_class', 'solr.TextField'),
+                            ('multiValued', True), ('indexed', False)):
+            f2.java_class = 'solr.StrField'
+            f2.multiValued = False
+            f2.indexed = True
+            setattr(f2, attr, value)
+            cm.connection.results = [[{'docid': 3}]]
+            index._apply_index(request)
+            self.failIf('sort' in cm.connection.queries[-1], attr)
+
+    def test__apply_index_sort_push_down_sharded_needs_stored(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.shard_uris = ('http://a/solr', 'http://b/solr')
+        index = self._wrapInSite(index, DummyIndex('f2'))
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 3}], DummyPage([], None)]
+        request = {'f1': 'somequery', 'sort_on': 'f2', 'sort_limit': 2}
+        index._apply_index(request)
+        self.failIf('sort' in cm.connection.queries[0])
+        cm.schema.fields[1].stored = True
+        index._apply_index(request)
+        self.assertEqual(cm.connection.queries[1]['sort'], ['f2', 'docid'])
+
+    def test__apply_index_sort_push_down_with_other_index(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index = self._wrapInSite(index, DummyIndex('path'), DummyIndex('f2'))
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 3}]]
+        index._apply_index({'f1': 'somequery', 'path': '/plone',
+                            'sort_on': 'f2', 'sort_limit': 2})
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid'}])
+
+    def test__apply_index_candidate_filter(self):
+        from BTrees.IIBTree import IISet
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.candidate_filter_size = 3
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 2}]]
+        request = {'f1': 'somequery', 'solr_params': {'fq': 'f2:x'}}
+        result, queried = index._apply_index(request, IISet([1, 2, 7]))
+        self.assertEqual(list(result.keys()), [2])
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid',
+             'fq': ['f2:x', '{!terms f=docid}1,2,7']}])
+        self.assertEqual(request['solr_params'], {'fq': 'f2:x'})
+
+    def test__apply_index_candidate_filter_too_many(self):
+        from BTrees.IIBTree import IISet
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        index.candidate_filter_size = 2
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 2}]]
+        index._apply_index({'f1': 'somequery'}, IISet([1, 2, 7]))
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid'}])
+
+    def test__apply_index_empty_candidates(self):
+        from BTrees.IIBTree import IISet
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        cm = index.connection_manager
+        result, queried = index._apply_index({'f1': 'somequery'}, IISet())
+        self.assertEqual(len(result), 0)
+        self.assertEqual(queried, ['f1'])
+        self.assertEqual(cm.connection.queries, [])
+
+    def test__apply_index_legacy_cid(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        cm = index.connection_manager
+        cm.connection.results = [[{'docid': 5}]]
+        result, queried = index._apply_index({'f1': 'somequery'}, '')
+        self.assertEqual(list(result.keys()), [5])
+        self.assertEqual(cm.connection.queries, [
+            {'q': 'f1:somequery', 'fields': 'docid'}])
+
     def test_indexSize(self):
         self._registerConnectionManager()
         index = self._makeOne('id', 'someuri')
@@ -241,6 +685,67 @@ class SolrIndexTests(unittest.TestCase):
         cm2 = index.connection_manager
         self.assertFalse(cm1 is cm2)
 
+    def test_change_async_updates(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        cm1 = index.connection_manager
+        index.async_updates = True
+        cm2 = index.connection_manager
+        self.assertFalse(cm1 is cm2)
+        self.assertTrue(cm2.async_updates)
+
+    def test_change_update_format(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        cm1 = index.connection_manager
+        index.update_format = 'json'
+        cm2 = index.connection_manager
+        self.assertFalse(cm1 is cm2)
+        self.assertEqual(cm2.update_format, 'json')
+
+    def test_change_shard_uris(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        cm1 = index.connection_manager
+        index.shard_uris = ['shard1', 'shard2']
+        cm2 = index.connection_manager
+        self.assertFalse(cm1 is cm2)
+        self.assertEqual(cm2.shard_uris, ('shard1', 'shard2'))
+
+    def test_change_selection_property(self):
+        index = self._makeOne('id', 'someuri')
+        index.manage_changeProperties(commit_strategy='soft',
+                                      response_format='json')
+        self.assertEqual(index.commit_strategy, 'soft')
+        self.assertEqual(index.response_format, 'json')
+        self.assertRaises(ValueError, index.manage_changeProperties,
+                          commit_strategy='sfot')
+        self.assertRaises(ValueError, index.manage_changeProperties,
+                          update_format='javabin')
+        self.assertEqual(index.commit_strategy, 'soft')
+        # Empty restores the default
+        index.manage_changeProperties(response_format='')
+        self.assertEqual(index.response_format, 'xml')
+
+    def test_change_commit_strategy(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        cm1 = index.connection_manager
+        self.assert_(index.connection_manager is cm1)
+        index.commit_strategy = 'soft'
+        cm2 = index.connection_manager
+        self.assertFalse(cm1 is cm2)
+        self.assertEqual(cm2.commit_policy.strategy, 'soft')
+
+    def test_change_response_format(self):
+        self._registerConnectionManager()
+        index = self._makeOne('id', 'someuri')
+        cm1 = index.connection_manager
+        index.response_format = 'json'
+        cm2 = index.connection_manager
+        self.assertFalse(cm1 is cm2)
+        self.assertEqual(cm2.response_format, 'json')
+
     def test_get_solr_connection_from_zodb(self):
         self._registerConnectionManager()
         index = self._makeOne('id', 'someuri')
@@ -269,6 +774,11 @@ class SolrIndexTests(unittest.TestCase):
         index.__dict__['solr_uri'] = 'bw-compat-uri'
         self.assertEqual(index.solr_uri, 'bw-compat-uri')
 
+    def test_get_solr_uri_from_shards(self):
+        index = self._makeOne('id', '')
+        index.shard_uris = ('shard1', 'shard2')
+        self.assertEqual(index.solr_uri, 'shard1')
+
     def test_no_solr_uri_specified(self):
         index = self._makeOne('id', '')
         self.assertRaises(ValueError, getattr, index, 'solr_uri')
@@ -286,9 +796,18 @@ class SolrConnectionManagerTests(unittest.TestCase):
         from alm.solrindex.index import SolrConnectionManager
         return SolrConnectionManager
 
-    def _makeOne(self, uri=''):
+    def _makeOne(self, uri='', response_format='xml', async_updates=False,
+                 commit_strategy='hard', shard_uris=()):
         class DummySolrIndex:
             solr_uri = uri
+            update_format = 'xml'
+            commit_within = 1000
+            wait_flush = True
+            wait_searcher = False
+        DummySolrIndex.response_format = response_format
+        DummySolrIndex.async_updates = async_updates
+        DummySolrIndex.commit_strategy = commit_strategy
+        DummySolrIndex.shard_uris = shard_uris
         obj = self._getTargetClass()(DummySolrIndex(), DummySolrConnection)
         return obj
 
@@ -309,6 +828,23 @@ class SolrConnectionManagerTests(unittest.TestCase):
         self.assert_(c is not None)
         self.assert_(obj.connection is c)
 
+    def test_connection_response_format(self):
+        obj = self._makeOne(response_format='json')
+        self.assertEqual(obj.connection.response_format, 'json')
+        obj.abort(None)
+        self.assertEqual(obj.connection.response_format, 'json')
+
+    def test_sharded_connection(self):
+        from alm.solrindex.shards import ShardedConnection
+        obj = self._makeOne(uri='schemauri', response_format='json',
+                            shard_uris=['shard1', 'shard2'])
+        c = obj.connection
+        self.assert_(isinstance(c, ShardedConnection))
+        self.assertEqual(c.schema_uri, 'schemauri')
+        self.assertEqual([shard.uri for shard in c.shards],
+                         ['shard1', 'shard2'])
+        self.assertEqual(c.shards[0].response_format, 'json')
+
     def test_set_changed(self):
         obj = self._makeOne()
         self.assertFalse(obj._joined)
@@ -329,6 +865,180 @@ class SolrConnectionManagerTests(unittest.TestCase):
         self.assertFalse(obj._joined)
         self.assertEqual(obj._connection.commits, 1)
 
+    def test_changes_are_sent_on_vote(self):
+        obj = self._makeOne()
+        obj.set_changed()
+        obj.add({'docid': 1})
+        obj.delete(2)
+        obj.add({'docid': 3})
+        obj.add({'docid': 4})
+        obj.delete_query('title:x')
+        self.assertEqual(obj.connection.batches, [])
+        obj.tpc_vote(None)
+        self.assertEqual(obj.connection.batches, [[
+            ('add_many', [{'docid': 1}]),
+            ('delete', 2),
+            ('add_many', [{'docid': 3}, {'docid': 4}]),
+            ('delete_query', 'title:x'),
+            ]])
+        obj.tpc_finish(None)
+        self.assertEqual(obj._connection.commits, 1)
+        self.assertEqual(obj._pending, [])
+
+    def test_changes_are_coalesced(self):
+        obj = self._makeOne()
+        obj.set_changed()
+        obj.add({None: 1, 'title': 'a'})
+        obj.add({None: 2})
+        obj.add({None: 1, 'title': 'b'})
+        obj.delete(2)
+        obj.delete(3)
+        obj.delete_query('title:c')
+        obj.add({None: 3})
+        obj.tpc_vote(None)
+        self.assertEqual(obj.connection.batches, [[
+            ('add_many', [{None: 1, 'title': 'b'}]),
+            ('delete', 2),
+            ('delete', 3),
+            ('delete_query', 'title:c'),
+            ('add_many', [{None: 3}]),
+            ]])
+        self.assertEqual(obj.elided, 2)
+
+    def test_delete_all_elides_earlier_changes(self):
+        obj = self._makeOne()
+        obj.set_changed()
+        obj.add({None: 1})
+        obj.delete(2)
+        obj.delete_query('*:*')
+        obj.add({None: 1})
+        obj.tpc_vote(None)
+        self.assertEqual(obj.connection.batches, [[
+            ('delete_query', '*:*'),
+            ('add_many', [{None: 1}]),
+            ]])
+        self.assertEqual(obj.elided, 2)
+
+    def test_savepoint_rollback(self):
+        obj = self._makeOne()
+        obj.set_changed()
+        obj.add({None: 1})
+        sp = obj.savepoint()
+        obj.add({None: 1, 'title': 'b'})
+        obj.delete_query('*:*')
+        sp.rollback()
+        obj.delete(2)
+        sp.rollback()
+        self.assertEqual(obj.elided, 0)
+        obj.add({None: 1, 'title': 'c'})
+        obj.tpc_vote(None)
+        self.assertEqual(obj.connection.batches, [[
+            ('add_many', [{None: 1, 'title': 'c'}]),
+            ]])
+        self.assertEqual(obj.elided, 1)
+
+    def test_changes_are_sent_in_batches(self):
+        obj = self._makeOne()
+        obj.batch_size = 2
+        obj.set_changed()
+        for docid in range(5):
+            obj.add({'docid': docid})
+        obj.tpc_vote(None)
+        self.assertEqual(obj.connection.batches, [
+            [('add_many', [{'docid': 0}, {'docid': 1}])],
+            [('add_many', [{'docid': 2}, {'docid': 3}])],
+            [('add_many', [{'docid': 4}])],
+            ])
+
+    def test_abort_drops_changes(self):
+        obj = self._makeOne()
+        obj.set_changed()
+        obj.add({'docid': 1})
+        obj.abort(None)
+        obj.set_changed()
+        obj.tpc_vote(None)
+        self.assertEqual(obj.connection.batches, [])
+
+    def test_tpc_abort(self):
+        obj = self._makeOne()
+        obj.set_changed()
+        obj.add({'docid': 1})
+        obj.tpc_abort(None)
+        self.assertFalse(obj._joined)
+        self.assertEqual(obj._pending, [])
+
+    def test_commit_hard(self):
+        obj = self._makeOne()
+        obj.set_changed()
+        obj.delete(1)
+        obj.tpc_vote(None)
+        obj.tpc_finish(None)
+        c = obj.connection
+        self.assertEqual(c.commit_within, None)
+        self.assertEqual(c.commits, 1)
+        self.assertEqual(c.commit_args, {
+            'wait_flush': True, 'wait_searcher': False,
+            'soft_commit': False})
+
+    def test_commit_invalidates_query_cache(self):
+        from alm.solrindex.querycache import query_cache
+        obj = self._makeOne(uri='http://localhost:8983/solr')
+        generation = query_cache.generation(obj.solr_uri)
+        obj.set_changed()
+        obj.tpc_vote(None)
+        obj.tpc_finish(None)
+        self.assertNotEqual(query_cache.generation(obj.solr_uri), generation)
+
+    def test_commit_soft(self):
+        obj = self._makeOne(commit_strategy='soft')
+        obj.set_changed()
+        obj.tpc_vote(None)
+        obj.tpc_finish(None)
+        self.assertEqual(obj.connection.commits, 1)
+        self.assertEqual(obj.connection.commit_args['soft_commit'], True)
+
+    def test_commit_within(self):
+        obj = self._makeOne(commit_strategy='within')
+        obj.set_changed()
+        obj.add({None: 1})
+        obj.delete(2)
+        obj.tpc_vote(None)
+        obj.tpc_finish(None)
+        self.assertEqual(obj.connection.commit_within, 1000)
+        self.assertEqual(obj.connection.commits, 0)
+
+    def test_commit_none(self):
+        obj = self._makeOne(commit_strategy='none')
+        obj.set_changed()
+        obj.delete(2)
+        obj.tpc_vote(None)
+        obj.tpc_finish(None)
+        self.assertEqual(obj.connection.commit_within, None)
+        self.assertEqual(obj.connection.commits, 0)
+
+    def test_unknown_commit_strategy(self):
+        self.assertRaises(ValueError, self._makeOne, commit_strategy='x')
+
+    def test_async_updates(self):
+        from alm.solrindex.dispatcher import dispatcher
+        old_factory = dispatcher.connection_factory
+        dispatcher.connection_factory = DummySolrConnection
+        try:
+            obj = self._makeOne(uri='http://localhost:8983/solr',
+                                async_updates=True)
+            obj.set_changed()
+            obj.delete(1)
+            obj.tpc_vote(None)
+            self.assertEqual(obj.connection.batches, [])
+            obj.tpc_finish(None)
+            self.assertFalse(obj._joined)
+            self.assertEqual(obj.connection.commits, 0)
+            dispatcher.flush()
+            self.assertEqual(dispatcher.sent, 1)
+        finally:
+            dispatcher.shutdown()
+            dispatcher.connection_factory = old_factory
+
     def test_commit_after_abort(self):
         obj = self._makeOne()
         obj.abort(None)
@@ -350,40 +1060,88 @@ class DummyConnectionManager:
         self.schema = DummySchema()
         self.connection = DummySolrConnection()
         self.changed = False
-        self.solr_uri = 'someuri'
+        self.solr_uri = index.solr_uri
+        self.response_format = index.response_format
+        self.update_format = index.update_format
+        self.shard_uris = tuple(index.shard_uris)
+        self.async_updates = index.async_updates
+        from alm.solrindex.dispatcher import CommitPolicy
+        self.commit_policy = CommitPolicy.from_settings(index)
+
+    def new_connection(self):
+        return self.connection
 
     def set_changed(self):
         self.changed = True
 
+    def add(self, values):
+        self.connection.add(**values)
+
+    def delete(self, id):
+        self.connection.delete(id)
+
+    def delete_query(self, query):
+        self.connection.delete_query(query)
+
 
 class DummySolrConnection:
-    def __init__(self, uri=None):
+    def __init__(self, uri=None, response_format='xml', update_format='xml'):
         self.uri = uri
+        self.response_format = response_format
         self.queries = []
         self.results = []
         self.added = []
         self.deleted = []
         self.delete_queries = []
         self.commits = 0
+        self.batches = []
+        self.batch = None
 
     def query(self, **args):
         self.queries.append(args)
         return self.results.pop(0)
 
+    def query_ids(self, unique_key, result, scale=1000, **args):
+        args['fields'] = unique_key
+        self.queries.append(args)
+        response = self.results.pop(0)
+        for r in response:
+            result[int(r[unique_key])] = int(r.get('score', 0) * scale)
+        return response
+
     def add(self, **args):
         self.added.append(args)
 
-    def delete(self, id):
+    def add_many(self, docs, commit_within=None):
+        self.batch.append(('add_many', docs))
+        self.added.extend(docs)
+        self.commit_within = commit_within
+
+    def delete(self, id, commit_within=None):
+        if self.batch is not None:
+            self.batch.append(('delete', id))
         self.deleted.append(id)
+        self.commit_within = commit_within
 
-    def delete_query(self, q):
+    def delete_query(self, q, commit_within=None):
+        if self.batch is not None:
+            self.batch.append(('delete_query', q))
         self.delete_queries.append(q)
+        self.commit_within = commit_within
+
+    def begin_batch(self):
+        self.batch = []
+
+    def end_batch(self):
+        self.batches.append(self.batch)
+        self.batch = None
 
     def close(self):
         pass
 
-    def commit(self):
+    def commit(self, **kw):
         self.commits += 1
+        self.commit_args = kw
 
 
 class DummySchema:
@@ -394,15 +1152,35 @@ class DummySchema:
         for name in ('f1', 'f2'):
             self.fields.append(DummyField(name))
 
+    def indexing_plan(self):
+        return tuple([(field.name, field.handler.convert)
+                      for field in self.fields])
+
 
 class DummyField:
     def __init__(self, name):
         self.name = name
         self.stored = False
+        self.indexed = True
+        self.multiValued = False
+        self.java_class = 'solr.StrField'
         self.handler = DummyFieldHandler()
         self.type = 'dummy'
 
 
+class DummyQueryExecutor:
+    """Keeps the submitted calls without making them"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, func):
+        from alm.solrindex.parallel import PendingCall
+        pending = PendingCall(func)
+        self.submitted.append(pending)
+        return pending
+
+
 class DummyFieldHandler:
     def parse_query(self, field, field_query):
         return {'q': '%s:%s' % (field.name, field_query)}
@@ -411,6 +1189,42 @@ class DummyFieldHandler:
         return [value]
 
 
+class DummyPage(list):
+    numFound = '5'
+
+    def __init__(self, docs, nextCursorMark, highlighting=None):
+        list.__init__(self, docs)
+        self.nextCursorMark = nextCursorMark
+        if highlighting is not None:
+            self.highlighting = highlighting
+
+
+class DummySite(Implicit):
+    pass
+
+
+class DummyCatalogTool(Implicit):
+    def __init__(self, catalog):
+        self._catalog = catalog
+
+
+class DummyCatalog:
+
+    def __init__(self):
+        self.indexes = {}
+
+    def getIndex(self, name):
+        return self.indexes[name]
+
+
+class DummyIndex:
+    def __init__(self, id):
+        self.id = id
+
+    def getId(self):
+        return self.id
+
+
 class DummySolrResult:
     def __init__(self, numFound):
         self.numFound = numFound
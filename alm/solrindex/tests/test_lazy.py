@@ -0,0 +1,115 @@
+import unittest
+
+
+class LazyResultTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from alm.solrindex.lazy import LazyResult
+        return LazyResult
+
+    def _makeOne(self, pages, num_found=None, page_size=2):
+        connection = DummyConnection(pages, num_found)
+        result = self._getTargetClass()(
+            connection, 'docid', {'q': 'x'}, page_size)
+        return result, connection
+
+    def test_first_page_only(self):
+        result, connection = self._makeOne([[(1, 0.5), (2, 0.25)]], 5)
+        self.assertEqual(len(result), 5)
+        self.assertTrue(result)
+        self.assertEqual(result[0], (500, 1))
+        self.assertEqual(result[1], (250, 2))
+        self.assertEqual(connection.queries, [
+            {'q': 'x', 'unique_key': 'docid', 'scale': 1000,
+             'rows': 2, 'start': 0}])
+
+    def test_later_page_on_demand(self):
+        result, connection = self._makeOne(
+            [[(1, 3), (2, 2)], [(3, 1)]], 3)
+        self.assertEqual(result[-1], (1000, 3))
+        self.assertEqual(result[2], (1000, 3))
+        self.assertEqual([q['start'] for q in connection.queries], [0, 2])
+
+    def test_slice(self):
+        result, connection = self._makeOne(
+            [[(1, 3), (2, 2)], [(3, 1), (4, 0)]], 4)
+        self.assertEqual(result[1:3], [(2000, 2), (1000, 3)])
+        self.assertEqual(result[10:12], [])
+
+    def test_out_of_range(self):
+        result, connection = self._makeOne([[(1, 3)]], 1)
+        self.assertRaises(IndexError, result.__getitem__, 1)
+        self.assertRaises(IndexError, result.__getitem__, -2)
+
+    def test_fewer_matches_than_counted(self):
+        result, connection = self._makeOne([[(1, 3), (2, 2)], []], 3)
+        self.assertRaises(IndexError, result.__getitem__, 2)
+
+    def test_empty(self):
+        result, connection = self._makeOne([[]], 0)
+        self.assertEqual(len(result), 0)
+        self.assertFalse(result)
+        self.assertEqual(list(result), [])
+
+    def test_byValue(self):
+        result, connection = self._makeOne([[(1, 3)]], 1)
+        self.assertTrue(result.byValue(0) is result)
+
+    def test_items_fetches_everything(self):
+        result, connection = self._makeOne(
+            [[(1, 3), (2, 2)], [(3, 1)]], 3)
+        self.assertEqual(result.items(), [(1, 3000), (2, 2000), (3, 1000)])
+        self.assertEqual(result.keys(), [1, 2, 3])
+        self.assertEqual(result.values(), [3000, 2000, 1000])
+        self.assertEqual(len(connection.queries), 2)
+
+    def test_highlighting_of_later_pages(self):
+        connection = DummyConnection([[(1, 3), (2, 2)], [(3, 1)]], 3)
+        connection.highlighting = [{'1': 'a'}, {'3': 'c'}]
+        result = self._getTargetClass()(connection, 'docid', {}, 2)
+        result[2]
+        self.assertEqual(result.response.highlighting,
+                         {'1': 'a', '3': 'c'})
+
+
+    def test_highlighting_when_first_page_has_none(self):
+        connection = DummyConnection([[(1, 3), (2, 2)], [(3, 1)]], 3)
+        connection.highlighting = [None, {'3': 'c'}]
+        result = self._getTargetClass()(
+            connection, 'docid', {'highlight': ['f1']}, 2)
+        # What the brains get from the first response
+        highlighting = result.response.highlighting
+        self.assertEqual(highlighting, {})
+        result[2]
+        self.assertEqual(highlighting, {'3': 'c'})
+
+    def test_no_highlighting_asked(self):
+        result, connection = self._makeOne([[(1, 3)]], 1)
+        self.failIf(hasattr(result.response, 'highlighting'))
+
+
+class DummyConnection:
+
+    def __init__(self, pages, num_found):
+        self.pages = list(pages)
+        self.num_found = num_found
+        self.queries = []
+        self.highlighting = None
+
+    def query_ids(self, unique_key, result, scale=1000, **params):
+        query = dict(params, unique_key=unique_key, scale=scale)
+        self.queries.append(query)
+        for id, score in self.pages.pop(0):
+            result[id] = int(score * scale)
+        response = DummyResponse(self.num_found)
+        if self.highlighting:
+            highlighting = self.highlighting.pop(0)
+            if highlighting is not None:
+                response.highlighting = highlighting
+        return response
+
+
+class DummyResponse:
+
+    def __init__(self, numFound):
+        self.numFound = str(numFound)
@@ -0,0 +1,67 @@
+import unittest
+
+
+class QueryExecutorTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from alm.solrindex.parallel import QueryExecutor
+        return QueryExecutor
+
+    def _makeOne(self, workers=2):
+        executor = self._getTargetClass()(workers)
+        self.addCleanup(executor.shutdown)
+        return executor
+
+    def test_submit(self):
+        executor = self._makeOne()
+        pending = executor.submit(lambda: 42)
+        self.assertEqual(pending.get(), 42)
+        self.assertEqual(len(executor._threads), 2)
+
+    def test_exception(self):
+        executor = self._makeOne()
+        pending = executor.submit(lambda: {}['missing'])
+        self.assertRaises(KeyError, pending.get)
+
+    def test_get_calls_when_no_worker_has(self):
+        import threading
+        executor = self._makeOne(workers=1)
+        busy = threading.Event()
+        release = threading.Event()
+
+        def block():
+            busy.set()
+            release.wait(5)
+        executor.submit(block)
+        busy.wait(5)
+        calls = []
+        pending = executor.submit(lambda: calls.append(
+            threading.currentThread()))
+        pending.get()
+        release.set()
+        self.assertEqual(calls, [threading.currentThread()])
+
+    def test_cancel(self):
+        import threading
+        executor = self._makeOne(workers=1)
+        busy = threading.Event()
+        release = threading.Event()
+
+        def block():
+            busy.set()
+            release.wait(5)
+        executor.submit(block)
+        busy.wait(5)
+        calls = []
+        pending = executor.submit(lambda: calls.append(1))
+        pending.cancel()
+        release.set()
+        executor.submit(lambda: None).get()
+        self.assertEqual(calls, [])
+        self.assertEqual(pending.get(), None)
+
+    def test_shutdown(self):
+        executor = self._makeOne()
+        executor.submit(lambda: None).get()
+        executor.shutdown()
+        self.assertEqual(executor._threads, [])
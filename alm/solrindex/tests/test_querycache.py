@@ -0,0 +1,109 @@
+import unittest
+
+
+class CanonicalParamsTests(unittest.TestCase):
+
+    def test_order_independent(self):
+        from alm.solrindex.querycache import canonical_params
+        a = canonical_params({'q': 'x', 'fq': ['a', 'b'], 'rows': 10})
+        b = canonical_params({'rows': 10, 'fq': ['a', 'b'], 'q': 'x'})
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertNotEqual(
+            a, canonical_params({'q': 'x', 'fq': ['b', 'a'], 'rows': 10}))
+
+
+class QueryCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from alm.solrindex.querycache import QueryCache
+        return QueryCache
+
+    def _makeOne(self, max_bytes=10000):
+        return self._getTargetClass()(max_bytes=max_bytes)
+
+    def _result(self, *ids):
+        from BTrees.IIBTree import IIBTree
+        return IIBTree([(id, 0) for id in ids])
+
+    def test_get_set(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('uri', 'k', 60), None)
+        gen = cache.generation('uri')
+        cache.set('uri', 'k', self._result(1, 2), ['f'], gen)
+        result, queried = cache.get('uri', 'k', 60)
+        self.assertEqual(list(result.keys()), [1, 2])
+        self.assertEqual(queried, ('f',))
+        self.assertEqual(cache.get('other', 'k', 60), None)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_get_keeps_sorted_result_count(self):
+        from alm.solrindex.index import SortedResult
+        cache = self._makeOne()
+        result = SortedResult(self._result(1, 2))
+        result.numFound = 10
+        cache.set('uri', 'k', result, [], 0)
+        cached, queried = cache.get('uri', 'k', 60)
+        self.assert_(isinstance(cached, SortedResult))
+        self.assertEqual(list(cached.keys()), [1, 2])
+        self.assertEqual(len(cached), 10)
+        self.assertEqual(cache.size, 256 + 2 * 16)
+
+    def test_get_returns_copy(self):
+        cache = self._makeOne()
+        cache.set('uri', 'k', self._result(1), [], 0)
+        cache.get('uri', 'k', 60)[0][2] = 0
+        self.assertEqual(list(cache.get('uri', 'k', 60)[0].keys()), [1])
+
+    def test_max_age(self):
+        cache = self._makeOne()
+        cache.set('uri', 'k', self._result(1), [], 0)
+        self.assertEqual(cache.get('uri', 'k', -1), None)
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_invalidate(self):
+        cache = self._makeOne()
+        gen = cache.generation('uri')
+        cache.set('uri', 'k', self._result(1), [], gen)
+        cache.set('other', 'k', self._result(1), [], 0)
+        cache.invalidate('uri')
+        self.assertEqual(cache.get('uri', 'k', 60), None)
+        self.assertNotEqual(cache.get('other', 'k', 60), None)
+        # A result of a query sent before the invalidation is dropped.
+        cache.set('uri', 'k', self._result(1), [], gen)
+        self.assertEqual(cache.get('uri', 'k', 60), None)
+
+    def test_invalidate_with_delay(self):
+        import time
+        cache = self._makeOne()
+        cache.invalidate('uri', delay=60)
+        # The changes may not be searchable yet.
+        gen = cache.generation('uri')
+        self.assertEqual(gen, None)
+        cache.set('uri', 'k', self._result(1), [], gen)
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertNotEqual(cache.generation('other'), None)
+        cache._settle_times['uri'] = time.time() - 1
+        self.assertEqual(cache.generation('uri'), 1)
+
+    def test_lru_eviction(self):
+        from alm.solrindex.querycache import ENTRY_BYTES, ITEM_BYTES
+        cache = self._makeOne(max_bytes=2 * (ENTRY_BYTES + ITEM_BYTES))
+        cache.set('uri', 'a', self._result(1), [], 0)
+        cache.set('uri', 'b', self._result(2), [], 0)
+        cache.get('uri', 'a', 60)
+        cache.set('uri', 'c', self._result(3), [], 0)
+        self.assertNotEqual(cache.get('uri', 'a', 60), None)
+        self.assertEqual(cache.get('uri', 'b', 60), None)
+        self.assertNotEqual(cache.get('uri', 'c', 60), None)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.size, cache.max_bytes)
+
+    def test_too_large(self):
+        cache = self._makeOne(max_bytes=10)
+        cache.set('uri', 'a', self._result(1), [], 0)
+        self.assertEqual(cache.stats()['entries'], 0)
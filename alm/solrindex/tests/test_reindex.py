@@ -0,0 +1,352 @@
+import unittest
+
+
+class ReindexerTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from zope.component import provideUtility
+        from zope.testing.cleanup import cleanUp
+        from alm.solrindex.interfaces import ISolrFieldHandler
+        cleanUp()
+        # The conversion processes look up the handler of the schema.
+        provideUtility(DummyFieldHandler(), ISolrFieldHandler, name='fail')
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        from zope.testing.cleanup import cleanUp
+        cleanUp()
+        shutil.rmtree(self.dir)
+
+    def _getTargetClass(self):
+        from alm.solrindex.scripts.reindex import Reindexer
+        return Reindexer
+
+    def _makeOne(self, catalog, checkpoint=None, **kw):
+        import os
+        from StringIO import StringIO
+        self.connections = []
+        if checkpoint:
+            checkpoint = os.path.join(self.dir, checkpoint)
+
+        def connection_factory(solr_uri, response_format, update_format):
+            c = DummySolrConnection(solr_uri)
+            self.connections.append(c)
+            return c
+        return self._getTargetClass()(
+            catalog, DummySolrIndex(), checkpoint=checkpoint, out=StringIO(),
+            connection_factory=connection_factory, **kw)
+
+    def _added(self):
+        added = []
+        for c in self.connections:
+            for docs in c.added:
+                added.extend(docs)
+        return sorted(self._ids(added))
+
+    def _ids(self, docs):
+        from xml.dom.minidom import parseString
+        ids = []
+        for doc in docs:
+            if isinstance(doc, str):
+                # Serialized by a conversion process
+                doc = {'docid': int(parseString(doc).documentElement
+                                    .firstChild.firstChild.data)}
+            ids.append(doc['docid'])
+        return ids
+
+    def test_run(self):
+        catalog = DummyCatalog(range(1, 8), missing=[4])
+        reindexer = self._makeOne(catalog, batch_size=2, workers=2,
+                                  commit_every=4)
+        progress = reindexer.run(clear=True)
+        self.assertEqual(progress.done, 6)
+        self.assertEqual(progress.skipped, 1)
+        self.assertEqual(self._added(), [1, 2, 3, 5, 6, 7])
+        main = self.connections[0]
+        self.assertEqual(main.delete_queries, ['*:*'])
+        # One commit after 4 documents, one at the end
+        self.assertEqual(main.commits, 2)
+        for docs in sum([c.added for c in self.connections], []):
+            self.assert_(len(docs) <= 2)
+        self.assert_('6/7 docs, 1 skipped' in reindexer.out.getvalue())
+        self.assertEqual(reindexer.bytes_sent(), 60)
+
+    def test_resume_from_checkpoint(self):
+        import os
+        catalog = DummyCatalog(range(1, 6))
+        reindexer = self._makeOne(catalog, checkpoint='cp.json')
+        reindexer.save_checkpoint(3, 3)
+        progress = reindexer.run()
+        self.assertEqual(self._added(), [4, 5])
+        self.assertEqual(progress.done, 5)
+        self.assertEqual(self.connections[0].delete_queries, [])
+        # The checkpoint is removed after a complete run.
+        self.assertFalse(os.path.exists(reindexer.checkpoint))
+
+    def test_clear_discards_checkpoint(self):
+        import os
+        catalog = DummyCatalog(range(1, 6))
+        reindexer = self._makeOne(catalog, checkpoint='cp.json')
+        reindexer.save_checkpoint(3, 3)
+        progress = reindexer.run(clear=True)
+        self.assertEqual(self._added(), [1, 2, 3, 4, 5])
+        self.assertEqual(progress.done, 5)
+        self.assertEqual(self.connections[0].delete_queries, ['*:*'])
+        self.assertFalse(os.path.exists(reindexer.checkpoint))
+
+    def test_checkpoint_of_other_index_stops_run(self):
+        import os
+        from alm.solrindex.scripts.reindex import CheckpointError
+        catalog = DummyCatalog(range(1, 6))
+        reindexer = self._makeOne(catalog, checkpoint='cp.json')
+        reindexer.save_checkpoint(3, 3)
+        reindexer.index.solr_uri = 'http://otherhost:8983/solr'
+        self.assertRaises(CheckpointError, reindexer.run)
+        self.assertEqual(self.connections, [])
+        # The checkpoint is kept for the run it belongs to.
+        self.assert_(os.path.exists(reindexer.checkpoint))
+
+    def test_checkpoint_after_commit(self):
+        import os
+        catalog = DummyCatalog(range(1, 6))
+        reindexer = self._makeOne(catalog, checkpoint='cp.json',
+                                  batch_size=1, commit_every=2)
+        reindexer.index.fail_at = 5
+        self.assertRaises(ValueError, reindexer.run)
+        self.assert_(os.path.exists(reindexer.checkpoint))
+        self.assertEqual(reindexer.load_checkpoint(), (4, 4))
+
+    def test_cache_gc_after_commit(self):
+        catalog = DummyCatalog(range(1, 6))
+        catalog._p_jar = DummyJar()
+        reindexer = self._makeOne(catalog, batch_size=100, commit_every=2)
+        reindexer.run()
+        # After the commits at 2 and 4 documents
+        self.assertEqual(catalog._p_jar.gcs, 2)
+
+    def test_run_with_processes(self):
+        catalog = DummyCatalog(range(1, 8), missing=[4])
+        reindexer = self._makeOne(catalog, batch_size=2, workers=2,
+                                  commit_every=4, processes=2)
+        progress = reindexer.run()
+        self.assertEqual(progress.done, 6)
+        self.assertEqual(self._added(), [1, 2, 3, 5, 6, 7])
+        for c in self.connections:
+            for docs in c.added:
+                self.assert_(len(docs) <= 2)
+        self.assertEqual(self.connections[0].commits, 2)
+        self.assertEqual(reindexer.pool, None)
+
+    def test_run_with_shards(self):
+        from alm.solrindex.parallel import query_executor
+        from alm.solrindex.shards import shard_number
+        self.addCleanup(query_executor.shutdown)
+        for processes in (0, 1):
+            catalog = DummyCatalog(range(1, 11))
+            reindexer = self._makeOne(catalog, batch_size=3, workers=1,
+                                      processes=processes)
+            reindexer.index.shard_uris = ('http://a/solr', 'http://b/solr')
+            reindexer.run(clear=True)
+            self.assertEqual(self._added(), range(1, 11))
+            shards = dict([(uri, n) for n, uri in
+                           enumerate(reindexer.index.shard_uris)])
+            # The main connection clears all shards.
+            self.assertEqual([c.delete_queries for c in self.connections[:2]],
+                             [['*:*'], ['*:*']])
+            for c in self.connections:
+                for docs in c.added:
+                    for rid in self._ids(docs):
+                        self.assertEqual(shard_number(rid, 2), shards[c.uri])
+
+    def test_conversion_error_stops_run(self):
+        catalog = DummyCatalog(range(1, 6))
+        reindexer = self._makeOne(catalog, batch_size=1, workers=1,
+                                  processes=1)
+        reindexer.index.fail_at = 3
+        self.assertRaises(ValueError, reindexer.run)
+
+    def test_run_with_given_pool(self):
+        import multiprocessing
+        pool = multiprocessing.Pool(1)
+        self.addCleanup(pool.terminate)
+        catalog = DummyCatalog(range(1, 4))
+        reindexer = self._makeOne(catalog, batch_size=2, workers=1,
+                                  pool=pool)
+        reindexer.run()
+        self.assertEqual(self._added(), [1, 2, 3])
+        # The caller terminates its pool.
+        self.assert_(reindexer.pool is pool)
+        self.assertEqual(pool.apply(max, (1, 2)), 2)
+
+    def test_conversion_timeout_stops_run(self):
+        catalog = DummyCatalog(range(1, 4))
+        reindexer = self._makeOne(catalog, batch_size=1, workers=1,
+                                  pool=DummyPool(), batch_timeout=5)
+        self.assertRaises(RuntimeError, reindexer.run)
+        self.assertEqual(reindexer.pool.timeouts, [5])
+
+    def test_send_error_stops_run(self):
+        catalog = DummyCatalog(range(1, 6))
+        reindexer = self._makeOne(catalog, batch_size=1, workers=1)
+        reindexer.connection_factory = lambda *args, **kw: (
+            FailingSolrConnection())
+        self.assertRaises(IOError, reindexer.run)
+
+
+class ProgressTests(unittest.TestCase):
+
+    def test_report(self):
+        from alm.solrindex.scripts.reindex import Progress
+        progress = Progress(total=300, done=100)
+        progress.start -= 10
+        progress.done = 200
+        self.assertEqual(progress.report(20480),
+                         '200/300 docs, 0 skipped, 10.0 docs/s, '
+                         '2.0 KB/s, ETA 0:00:10')
+
+
+class DummyCatalog:
+
+    def __init__(self, rids, missing=()):
+        from BTrees.IOBTree import IOBTree
+        self._catalog = self
+        self.paths = IOBTree()
+        for rid in rids:
+            self.paths[rid] = '/site/doc%d' % rid
+        self.missing = missing
+
+    def getPhysicalPath(self):
+        return ('', 'site', 'portal_catalog')
+
+    def resolve_path(self, path):
+        rid = int(path[len('/site/doc'):])
+        if rid in self.missing:
+            return None
+        return DummyObject(rid)
+
+
+class DummyJar:
+
+    gcs = 0
+
+    def cacheGC(self):
+        self.gcs += 1
+
+
+class DummyObject:
+
+    def __init__(self, rid):
+        self.rid = rid
+
+
+class DummySolrIndex:
+
+    solr_uri = 'http://localhost:8983/solr'
+    response_format = 'xml'
+    update_format = 'xml'
+    shard_uris = ()
+
+    def __init__(self):
+        self.connection_manager = DummyConnectionManager()
+
+    def getId(self):
+        return 'solr'
+
+    def get_document(self, documentId, obj):
+        if documentId == getattr(self, 'fail_at', None):
+            raise ValueError(documentId)
+        return {'docid': obj.rid}
+
+    def get_values(self, obj, plan):
+        # Fails in the conversion process
+        return [obj.rid == getattr(self, 'fail_at', None)]
+
+
+def _fail(value):
+    if value:
+        raise ValueError(value)
+
+
+class DummyConnectionManager:
+
+    def __init__(self):
+        self.schema = DummySchema()
+
+
+class DummySchema:
+
+    uniqueKey = 'docid'
+
+    def indexing_plan(self):
+        return (('fail', _fail),)
+
+    def to_dict(self):
+        return {'uniqueKey': 'docid', 'defaultSearchField': None,
+                'etag': None, 'last_modified': None,
+                'fields': [{'name': 'fail', 'type': 'boolean',
+                            'java_class': 'solr.BoolField'}]}
+
+
+class DummyFieldHandler:
+
+    def convert(self, value):
+        _fail(value)
+        return []
+
+
+class DummyPool:
+
+    def __init__(self):
+        self.timeouts = []
+
+    def apply_async(self, func, args):
+        return DummyAsyncResult(self)
+
+
+class DummyAsyncResult:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get(self, timeout=None):
+        import multiprocessing
+        self.pool.timeouts.append(timeout)
+        raise multiprocessing.TimeoutError()
+
+
+class DummySolrConnection:
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.added = []
+        self.delete_queries = []
+        self.commits = 0
+        self.bytes_sent = 0
+
+    def add_many(self, docs, stream=False):
+        self.stream = stream
+        self.added.append(docs)
+        self.bytes_sent += 10 * len(docs)
+
+    def add_serialized(self, docs):
+        self.added.append(docs)
+
+    def delete_query(self, q):
+        self.delete_queries.append(q)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        pass
+
+
+class FailingSolrConnection(DummySolrConnection):
+
+    def __init__(self):
+        DummySolrConnection.__init__(self, None)
+
+    def add_many(self, docs, stream=False):
+        raise IOError('Solr is down')
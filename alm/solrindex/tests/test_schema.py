@@ -97,6 +97,211 @@ class SolrSchemaTests(unittest.TestCase):
         self.assertEqual(schema.fields[4].required, False)
         self.assertEqual(schema.fields[4].multiValued, True)
 
+    def test_indexing_plan(self):
+        import os
+        from alm.solrindex.handlers import BoolFieldHandler
+        from alm.solrindex.handlers import DefaultFieldHandler
+        from alm.solrindex.interfaces import ISolrFieldHandler
+        from zope.component import getGlobalSiteManager
+        gsm = getGlobalSiteManager()
+        gsm.registerUtility(DefaultFieldHandler(), ISolrFieldHandler)
+        gsm.registerUtility(
+            BoolFieldHandler(), ISolrFieldHandler, name='solr.BoolField')
+
+        schema = self._makeOne()
+        fn = os.path.join(os.path.dirname(__file__), 'schema.xml')
+        f = open(fn, 'r')
+        schema.xml_init(f)
+        f.close()
+        plan = schema.indexing_plan()
+        self.assertTrue(schema.indexing_plan() is plan)
+        names = [name for name, convert in plan]
+        self.assertEqual(names[:2], ['Title', 'physicalPath'])
+        self.assertFalse('docid' in names)
+        self.assertEqual(len(plan), len(schema.fields) - 1)
+        converters = dict(plan)
+        self.assertEqual(converters['Title'](u'a\x00b'), [u'ab'])
+        self.assertEqual(converters['is_folderish'](True), ['true'])
+
+
+class BuildDocumentTests(unittest.TestCase):
+
+    def test_build_document(self):
+        from alm.solrindex.schema import build_document
+        plan = (('a', lambda v: v and [v.upper()]),
+                ('b', lambda v: v and [v]))
+        self.assertEqual(build_document(5, 'docid', plan, ['x', None]),
+                         {'docid': 5, 'a': ['X']})
+
+
+class IsSortableTests(unittest.TestCase):
+
+    def _callFUT(self, java_class, **attrs):
+        from alm.solrindex.schema import is_sortable
+        field = DummyField()
+        field.java_class = java_class
+        for name, value in attrs.items():
+            setattr(field, name, value)
+        return is_sortable(field)
+
+    def test_sortable(self):
+        self.assert_(self._callFUT('solr.StrField'))
+        self.assert_(self._callFUT('org.apache.solr.schema.TrieDateField',
+                                   indexed=True, multiValued=False))
+        self.assert_(self._callFUT('solr.IntPointField'))
+
+    def test_not_sortable(self):
+        self.failIf(self._callFUT('solr.TextField'))
+        self.failIf(self._callFUT('solr.StrField', multiValued=True))
+        self.failIf(self._callFUT('solr.StrField', indexed=False))
+
+
+class SchemaCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        from alm.solrindex.interfaces import ISolrFieldHandler
+        from zope.component import getGlobalSiteManager
+        cleanUp()
+        getGlobalSiteManager().registerUtility(
+            DummyFieldHandler(), ISolrFieldHandler)
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'admin', 'file'))
+        self._writeSchema('<schema><uniqueKey>docid</uniqueKey></schema>')
+        self.solr_uri = 'file://%s' % self.dir.replace(os.sep, '/')
+        self.snapshot_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+        shutil.rmtree(self.snapshot_dir)
+        cleanUp()
+
+    def _writeSchema(self, content):
+        import os
+        fn = os.path.join(self.dir, 'admin', 'file', '?file=schema.xml')
+        f = open(fn, 'w')
+        f.write(content)
+        f.close()
+
+    def _makeOne(self, ttl=300, background=False):
+        from alm.solrindex.schema import SchemaCache
+        return SchemaCache(ttl=ttl, snapshot_dir=self.snapshot_dir,
+                           background=background)
+
+    def test_get_shares_schema(self):
+        cache = self._makeOne()
+        schema = cache.get(self.solr_uri)
+        self.assertEqual(schema.uniqueKey, 'docid')
+        self._writeSchema('<schema><uniqueKey>id</uniqueKey></schema>')
+        self.assert_(cache.get(self.solr_uri) is schema)
+
+    def test_get_does_not_wait_for_other_uris(self):
+        cache = self._makeOne()
+        lock = cache._lock_for('http://otherhost:8983/solr')
+        self.assert_(cache._lock_for('http://otherhost:8983/solr') is lock)
+        # A download of another schema in progress
+        lock.acquire()
+        try:
+            schema = cache.get(self.solr_uri)
+        finally:
+            lock.release()
+        self.assertEqual(schema.uniqueKey, 'docid')
+
+    def test_get_reloads_changed_schema_after_ttl(self):
+        cache = self._makeOne(ttl=0)
+        schema = cache.get(self.solr_uri)
+        self._writeSchema('<schema><uniqueKey>id</uniqueKey></schema>')
+        schema2 = cache.get(self.solr_uri)
+        self.assertFalse(schema2 is schema)
+        self.assertEqual(schema2.uniqueKey, 'id')
+
+    def test_get_keeps_schema_when_not_modified(self):
+        import urllib2
+        cache = self._makeOne(ttl=0)
+        schema = cache.get(self.solr_uri)
+        schema.etag = '"abc"'
+        requests = []
+
+        def download_from(solr_uri, etag=None, last_modified=None):
+            requests.append(etag)
+            raise urllib2.HTTPError(solr_uri, 304, 'Not Modified', {}, None)
+        schema.download_from = download_from
+        self.assert_(cache.get(self.solr_uri) is schema)
+        self.assertEqual(requests, ['"abc"'])
+
+    def test_get_keeps_schema_when_solr_is_down(self):
+        import urllib2
+        cache = self._makeOne(ttl=0)
+        schema = cache.get(self.solr_uri)
+
+        def download_from(solr_uri, etag=None, last_modified=None):
+            raise urllib2.URLError('Connection refused')
+        schema.download_from = download_from
+        self.assert_(cache.get(self.solr_uri) is schema)
+
+    def test_get_uses_snapshot_when_solr_is_down(self):
+        import urllib2
+        from alm.solrindex.schema import SolrSchema
+        self._writeSchema(
+            '<schema><uniqueKey>docid</uniqueKey>'
+            '<types><fieldType name="int" class="solr.IntField"/></types>'
+            '<fields><field name="docid" type="int" stored="true"/></fields>'
+            '</schema>')
+        self._makeOne().get(self.solr_uri)
+
+        cache = self._makeOne()
+        old_download_from = SolrSchema.download_from.im_func
+
+        def download_from(self, solr_uri, etag=None, last_modified=None):
+            raise urllib2.URLError('Connection refused')
+        SolrSchema.download_from = download_from
+        try:
+            schema = cache.get(self.solr_uri)
+        finally:
+            SolrSchema.download_from = old_download_from
+        self.assertEqual(schema.uniqueKey, 'docid')
+        self.assertEqual(len(schema.fields), 1)
+        field = schema.fields[0]
+        self.assertEqual(field.name, 'docid')
+        self.assertEqual(field.java_class, 'solr.IntField')
+        self.assertEqual(field.stored, True)
+        self.assertEqual(field.indexed, None)
+        self.assert_(isinstance(field.handler, DummyFieldHandler))
+
+    def test_get_refreshes_snapshot_in_background(self):
+        self._makeOne().get(self.solr_uri)
+        self._writeSchema('<schema><uniqueKey>id</uniqueKey></schema>')
+
+        cache = self._makeOne(background=True)
+        schema = cache.get(self.solr_uri)
+        self.assertEqual(schema.uniqueKey, 'docid')
+        cache._refreshing[self.solr_uri].join()
+        self.assertEqual(cache.get(self.solr_uri).uniqueKey, 'id')
+        # The snapshot was updated too.
+        self.assertEqual(self._makeOne().load_snapshot(
+            self.solr_uri).uniqueKey, 'id')
+
+    def test_ignores_unreadable_snapshot(self):
+        cache = self._makeOne()
+        f = open(cache.snapshot_path(self.solr_uri), 'w')
+        f.write('{')
+        f.close()
+        self.assertEqual(cache.load_snapshot(self.solr_uri), None)
+        self.assertEqual(cache.get(self.solr_uri).uniqueKey, 'docid')
+
+    def test_clear(self):
+        cache = self._makeOne()
+        schema = cache.get(self.solr_uri)
+        cache.clear()
+        self.assertFalse(cache.get(self.solr_uri) is schema)
+
 
 class DummyFieldHandler:
     pass
+
+
+class DummyField:
+    indexed = None
+    multiValued = None
@@ -0,0 +1,356 @@
+from zope.testing.cleanup import cleanUp
+import unittest
+
+
+class ShardNumberTests(unittest.TestCase):
+
+    def _callFUT(self, key, shards):
+        from alm.solrindex.shards import shard_number
+        return shard_number(key, shards)
+
+    def test_stable(self):
+        # The same in every process, so these must never change.
+        self.assertEqual([self._callFUT(key, 3) for key in range(1, 11)],
+                         [2, 1, 1, 1, 1, 1, 0, 2, 0, 0])
+        self.assertEqual(self._callFUT(5, 3), self._callFUT('5', 3))
+
+    def test_spread(self):
+        counts = [0, 0, 0, 0]
+        for key in range(1000):
+            counts[self._callFUT(key, 4)] += 1
+        for count in counts:
+            self.assert_(200 < count < 300, counts)
+
+
+class MakeConnectionTests(unittest.TestCase):
+
+    def _callFUT(self, *args, **kw):
+        from alm.solrindex.shards import make_connection
+        return make_connection(*args, **kw)
+
+    def test_without_shards(self):
+        c = self._callFUT('http://a/solr', (), DummySolrConnection,
+                          response_format='json')
+        self.assertEqual(c.uri, 'http://a/solr')
+        self.assertEqual(c.kw, {'response_format': 'json'})
+
+    def test_with_shards(self):
+        from alm.solrindex.shards import ShardedConnection
+        c = self._callFUT('http://a/solr', ('http://b/solr', 'http://c/solr'),
+                          DummySolrConnection, unique_key='docid',
+                          response_format='json')
+        self.assert_(isinstance(c, ShardedConnection))
+        self.assertEqual(c.schema_uri, 'http://a/solr')
+        self.assertEqual(c.unique_key, 'docid')
+        self.assertEqual([s.uri for s in c.shards],
+                         ['http://b/solr', 'http://c/solr'])
+        self.assertEqual(c.shards[0].kw, {'response_format': 'json'})
+
+
+class ShardedConnectionTests(unittest.TestCase):
+
+    def setUp(self):
+        cleanUp()
+
+    def tearDown(self):
+        cleanUp()
+
+    def _getTargetClass(self):
+        from alm.solrindex.shards import ShardedConnection
+        return ShardedConnection
+
+    def _makeOne(self, shards=3):
+        uris = ['http://localhost:898%d/solr' % n for n in range(shards)]
+        return self._getTargetClass()(
+            uris, unique_key='docid', connection_factory=DummySolrConnection)
+
+    def _keys(self, c, shard, count):
+        """Return count keys that go to a shard"""
+        from alm.solrindex.shards import shard_number
+        keys = []
+        key = 0
+        while len(keys) < count:
+            key += 1
+            if shard_number(key, len(c.shards)) == shard:
+                keys.append(key)
+        return keys
+
+    def test_schema_uri_defaults_to_first_shard(self):
+        c = self._makeOne()
+        self.assertEqual(c.schema_uri, 'http://localhost:8980/solr')
+
+    def test_add_and_delete_go_to_one_shard(self):
+        from alm.solrindex.shards import shard_number
+        c = self._makeOne()
+        for key in range(1, 7):
+            c.add(docid=key)
+        c.delete(5, commit_within=1000)
+        for n, shard in enumerate(c.shards):
+            keys = [doc['docid'] for doc in shard.added]
+            self.assertEqual(keys, [key for key in range(1, 7)
+                                    if shard_number(key, 3) == n])
+        self.assertEqual(c.shard_for(5).deleted, [5])
+        self.assertEqual(c.shard_for(5).commit_within, 1000)
+
+    def test_add_many_groups_by_shard(self):
+        c = self._makeOne()
+        docs = [{'docid': key} for key in range(1, 7)]
+        c.add_many(docs, stream=True)
+        self.assertEqual(
+            sorted(sum([shard.added for shard in c.shards], [])), docs)
+        for shard in c.shards:
+            for doc in shard.added:
+                self.assert_(c.shard_for(doc['docid']) is shard)
+                self.assertEqual(shard.stream, True)
+
+    def test_add_many_skips_shards_without_docs(self):
+        c = self._makeOne()
+        keys = self._keys(c, 1, 2)
+        c.add_many([{'docid': key} for key in keys])
+        self.assertEqual([len(shard.calls) for shard in c.shards], [0, 1, 0])
+
+    def test_add_serialized_uses_keys(self):
+        c = self._makeOne()
+        keys = self._keys(c, 2, 1) + self._keys(c, 0, 1)
+        c.add_serialized(['<doc 1/>', '<doc 2/>'], keys)
+        self.assertEqual(c.shards[2].added, ['<doc 1/>'])
+        self.assertEqual(c.shards[0].added, ['<doc 2/>'])
+
+    def test_delete_query_and_commit_go_to_all_shards(self):
+        c = self._makeOne()
+        c.delete_query('*:*')
+        c.commit(wait_searcher=False)
+        for shard in c.shards:
+            self.assertEqual(shard.delete_queries, ['*:*'])
+            self.assertEqual(shard.commits, [{'wait_searcher': False}])
+
+    def test_query_ids_merges_by_score(self):
+        c = self._makeOne()
+        c.shards[0].matches = [(1, 900), (2, 500), (3, 100)]
+        c.shards[1].matches = [(4, 800), (5, 700)]
+        c.shards[2].matches = [(6, 600)]
+        result = {}
+        response = c.query_ids(q='x', unique_key='docid', result=result,
+                               rows=2, start=1)
+        # Every shard is asked for the first start + rows matches.
+        for shard in c.shards:
+            self.assertEqual(shard.queries[0]['rows'], 3)
+            self.failIf('start' in shard.queries[0])
+        self.assertEqual(result, {4: 800, 5: 700})
+        self.assertEqual(response.numFound, u'6')
+        self.assertEqual(response.start, u'1')
+        self.assertEqual(response.maxScore, u'0.9')
+
+    def test_query_ids_sorted_and_paged(self):
+        c = self._makeOne()
+        c.shards[0].matches = [(1, 900), (2, 500), (3, 100)]
+        c.shards[0].values = {1: {'title': u'e'}, 2: {'title': u'c'},
+                              3: {'title': u'a'}}
+        c.shards[1].matches = [(4, 800), (5, 700)]
+        c.shards[1].values = {4: {'title': u'd'}, 5: {'title': u'b'}}
+        result = {}
+        response = c.query_ids(q='x', unique_key='docid', result=result,
+                               sort=['title'], sort_order='desc', rows=2,
+                               start=1)
+        # e [d c] b a
+        self.assertEqual(result, {4: 800, 2: 500})
+        self.assertEqual(response.numFound, u'5')
+        self.assertEqual(response.start, u'1')
+        self.assertEqual(list(response), [])
+        for shard in c.shards:
+            self.assertEqual(shard.queries[0]['rows'], 3)
+            self.assertEqual(shard.queries[0]['fields'], ['docid', 'title'])
+            self.failIf('start' in shard.queries[0])
+
+    def test_query_ids_with_sort_without_rows(self):
+        c = self._makeOne()
+        c.shards[0].matches = [(1, 900), (2, 500)]
+        c.shards[1].matches = [(4, 800)]
+        result = {}
+        c.query_ids(q='x', unique_key='docid', result=result,
+                    sort=['modified'])
+        self.assertEqual(sorted(result), [1, 2, 4])
+
+    def test_query_ids_without_rows(self):
+        c = self._makeOne()
+        c.shards[0].matches = [(1, 900)]
+        c.shards[2].matches = [(6, 600)]
+        result = {}
+        response = c.query_ids(q='x', unique_key='docid', result=result)
+        self.assertEqual(result, {1: 900, 6: 600})
+        self.assertEqual(response.numFound, u'2')
+
+    def test_query_ids_cursor(self):
+        import json
+        c = self._makeOne(shards=2)
+        c.shards[0].matches = [(1, 0), (2, 0), (3, 0)]
+        c.shards[1].matches = [(4, 0)]
+        result = {}
+        cursor = '*'
+        cursors = []
+        while True:
+            response = c.query_ids(q='x', unique_key='docid', result=result,
+                                   rows=2, cursorMark=cursor)
+            if response.nextCursorMark == cursor:
+                break
+            cursor = response.nextCursorMark
+            cursors.append(json.loads(cursor))
+        self.assertEqual(sorted(result), [1, 2, 3, 4])
+        self.assertEqual(cursors, [[u'2', u'4'], [u'3', None]])
+        # A shard is not asked again once it has no more matches.
+        self.assertEqual([q['cursorMark'] for q in c.shards[0].queries],
+                         ['*', '2', '3'])
+        self.assertEqual([q['cursorMark'] for q in c.shards[1].queries],
+                         ['*', '4'])
+
+    def test_query_merges_documents_and_highlighting(self):
+        c = self._makeOne(shards=2)
+        c.shards[0].matches = [(1, 900), (2, 500)]
+        c.shards[0].highlighting = {'1': {'text': ['a']}}
+        c.shards[1].matches = [(3, 700)]
+        c.shards[1].highlighting = {'3': {'text': ['b']}}
+        response = c.query('x', rows=2, highlight=['text'])
+        self.assertEqual([doc['docid'] for doc in response], [1, 3])
+        self.assertEqual(response.results.numFound, u'3')
+        self.assertEqual(sorted(response.highlighting), ['1', '3'])
+        self.assertEqual(response._params['rows'], 2)
+        self.assert_(response._connection is c)
+
+    def test_query_sorted_and_paged(self):
+        c = self._makeOne(shards=2)
+        c.shards[0].matches = [(1, 0), (2, 0), (3, 0)]
+        c.shards[0].values = {1: {'title': u'a'}, 2: {'title': u'c'},
+                              3: {}}
+        c.shards[1].matches = [(4, 0), (5, 0)]
+        c.shards[1].values = {4: {'title': u'b'}, 5: {'title': u'd'}}
+        response = c.query('x', fields=['docid'], sort='title', rows=3,
+                           start=1)
+        # a [b c d] and 3 without a title last
+        self.assertEqual([doc['docid'] for doc in response], [4, 2, 5])
+        # The title was only asked for to merge the shards.
+        self.assertEqual(list(response)[0], {'docid': 4, 'score': 0.0})
+        self.assertEqual(response.results.start, u'1')
+        for shard in c.shards:
+            self.assertEqual(shard.queries[0]['rows'], 4)
+            self.assertEqual(shard.queries[0]['fields'], ['docid', 'title'])
+
+    def test_query_sort_orders(self):
+        c = self._makeOne(shards=2)
+        c.shards[0].matches = [(1, 0), (2, 0)]
+        c.shards[0].values = {1: {'a': 1, 'b': 1}, 2: {'a': 2, 'b': 5}}
+        c.shards[1].matches = [(3, 0), (4, 0)]
+        c.shards[1].values = {3: {'a': 1, 'b': 0}, 4: {'a': 2, 'b': 6}}
+        response = c.query('x', sort=['a', 'b'], sort_order=['asc', 'desc'],
+                           rows=4)
+        self.assertEqual([doc['docid'] for doc in response], [1, 3, 4, 2])
+
+    def test_query_start_without_rows(self):
+        from alm.solrindex.shards import default_rows
+        c = self._makeOne(shards=2)
+        c.shards[0].matches = [(n, 1000 - n) for n in range(1, 30, 2)]
+        c.shards[1].matches = [(n, 1000 - n) for n in range(2, 30, 2)]
+        response = c.query('*:*', start=20)
+        self.assertEqual([doc['docid'] for doc in response],
+                         range(21, 30))
+        self.assertEqual(c.shards[0].queries[0]['rows'], 20 + default_rows)
+        self.assertEqual(response.results.start, u'20')
+
+    def test_query_count(self):
+        c = self._makeOne()
+        c.shards[0].matches = [(1, 0), (2, 0)]
+        c.shards[2].matches = [(6, 0)]
+        response = c.query(q='*:*', rows='0')
+        self.assertEqual(int(response.numFound), 3)
+        self.assertEqual(list(response), [])
+
+    def test_bytes_sent(self):
+        c = self._makeOne()
+        for n, shard in enumerate(c.shards):
+            shard.bytes_sent = n
+        self.assertEqual(c.bytes_sent, 3)
+
+
+class DummySolrConnection:
+
+    def __init__(self, uri, **kw):
+        self.uri = uri
+        self.kw = kw
+        self.matches = []
+        self.values = {}
+        self.highlighting = None
+        self.calls = []
+        self.queries = []
+        self.added = []
+        self.deleted = []
+        self.delete_queries = []
+        self.commits = []
+        self.bytes_sent = 0
+
+    def add(self, **fields):
+        self.added.append(fields)
+
+    def add_many(self, docs, stream=False):
+        self.calls.append('add_many')
+        self.added.extend(docs)
+        self.stream = stream
+
+    def add_serialized(self, docs):
+        self.added.extend(docs)
+
+    def delete(self, id, commit_within=None):
+        self.deleted.append(id)
+        self.commit_within = commit_within
+
+    def delete_query(self, q):
+        self.delete_queries.append(q)
+
+    def commit(self, **kw):
+        self.commits.append(kw)
+
+    def _matches(self, params):
+        """Return the page of matches and the response"""
+        self.queries.append(params)
+        matches = self.matches
+        cursor = params.get('cursorMark')
+        if cursor is not None and cursor != '*':
+            matches = [m for m in matches if m[0] > int(cursor)]
+        if params.get('rows') is not None:
+            matches = matches[:int(params['rows'])]
+        response = DummyResponse()
+        response.numFound = unicode(len(self.matches))
+        if self.matches:
+            response.maxScore = unicode(self.matches[0][1] / 1000.0)
+        if self.highlighting:
+            response.highlighting = self.highlighting
+        if cursor is not None:
+            if matches:
+                response.nextCursorMark = str(matches[-1][0])
+            else:
+                response.nextCursorMark = cursor
+        return matches, response
+
+    def query_ids(self, q, unique_key, result, scale=1000, sort=None,
+                  **params):
+        matches, response = self._matches(params)
+        for key, score in matches:
+            result[key] = score
+        return response
+
+    def query(self, q, fields=None, highlight=None, score=True, sort=None,
+              sort_order='asc', **params):
+        # The matches are in the order of the sort.
+        matches, response = self._matches(dict(params, fields=fields))
+        response.results = []
+        for key, score in matches:
+            doc = {'docid': key, 'score': score / 1000.0}
+            doc.update(self.values.get(key, {}))
+            response.results.append(doc)
+        return response
+
+
+class DummyResponse:
+
+    results = ()
+
+    def __iter__(self):
+        return iter(self.results)
@@ -0,0 +1,862 @@
+import unittest
+
+
+_XML_RESPONSE = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<response>
+<lst name="responseHeader"><int name="status">0</int>\
+<int name="QTime">3</int>\
+<lst name="params"><str name="q">*:*</str></lst></lst>
+<result name="response" numFound="12" start="0" maxScore="1.5">
+<doc><float name="score">1.5</float><int name="docid">5</int></doc>
+<doc><float name="score">0.25</float><int name="docid">7</int>\
+<arr name="Subject"><str>a</str><str>\xc3\xbc</str></arr></doc>
+</result>
+<lst name="highlighting"><lst name="5">\
+<arr name="Title"><str>&lt;em&gt;x&lt;/em&gt;</str></arr></lst></lst>
+</response>
+"""
+
+_JSON_RESPONSE = """\
+{"responseHeader": {"status": 0, "QTime": 3, "params": {"q": "*:*"}},
+ "response": {"numFound": 12, "start": 0, "maxScore": 1.5, "docs": [
+    {"score": 1.5, "docid": 5},
+    {"score": 0.25, "docid": 7, "Subject": ["a", "\\u00fc"]}]},
+ "highlighting": {"5": {"Title": ["<em>x</em>"]}}}
+"""
+
+
+
+def _vint(n):
+    out = []
+    while n > 0x7f:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+
+def _sized(kind, size):
+    if size < 0x1f:
+        return chr(kind | size)
+    return chr(kind | 0x1f) + _vint(size - 0x1f)
+
+
+def _jb_str(s):
+    b = s.encode('utf-8')
+    return _sized(0x20, len(b)) + b
+
+
+def _jb_sint(n):
+    if n < 0x10:
+        return chr(0x40 | n)
+    return chr(0x40 | 0x10 | (n & 0x0f)) + _vint(n >> 4)
+
+
+def _jb_slong(n):
+    return chr(0x60 | n)
+
+
+def _jb_float(f):
+    import struct
+    return '\x08' + struct.pack('>f', f)
+
+
+def _jb_arr(*items):
+    return _sized(0x80, len(items)) + ''.join(items)
+
+
+def _jb_map(kind, *pairs):
+    return _sized(kind, len(pairs)) + ''.join(k + v for k, v in pairs)
+
+
+def _jb_doc(*pairs):
+    return '\x0b' + _jb_map(0xa0, *pairs)
+
+
+_JAVABIN_RESPONSE = '\x02' + _jb_map(
+    0xc0,
+    (_jb_str(u'responseHeader'), _jb_map(
+        0xa0,
+        (_jb_str(u'status'), _jb_sint(0)),
+        (_jb_str(u'QTime'), _jb_sint(3)),
+        (_jb_str(u'params'), _jb_map(0xa0, (_jb_str(u'q'), _jb_str(u'*:*')))),
+        )),
+    (_jb_str(u'response'), '\x0c' + _jb_arr(
+        _jb_slong(12), _jb_slong(0), _jb_float(1.5)) + _jb_arr(
+        # Field names are sent as extern strings: the first use
+        # defines them, later uses refer to them by index.
+        _jb_doc(('\xe0' + _jb_str(u'score'), _jb_float(1.5)),
+                ('\xe0' + _jb_str(u'docid'), '\x06\x00\x00\x00\x05')),
+        _jb_doc(('\xe1', _jb_float(0.25)),
+                ('\xe2', _jb_sint(7)),
+                ('\xe0' + _jb_str(u'Subject'),
+                 _jb_arr(_jb_str(u'a'), _jb_str(u'\xfc')))),
+        )),
+    (_jb_str(u'highlighting'), _jb_map(
+        0xc0,
+        (_jb_str(u'5'), _jb_map(
+            0xa0,
+            (_jb_str(u'Title'), _jb_arr(_jb_str(u'<em>x</em>'))))),
+        )),
+    )
+
+
+class SolrConnectionTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from alm.solrindex.solrpycore import SolrConnection
+        return SolrConnection
+
+    def _makeOne(self, **kw):
+        return self._getTargetClass()('http://localhost:8983/solr', **kw)
+
+    def test_default_response_format(self):
+        conn = self._makeOne()
+        self.assertEqual(conn.response_format, 'xml')
+
+    def test_unknown_response_format(self):
+        self.assertRaises(ValueError, self._makeOne, response_format='csv')
+
+    def test_query_json(self):
+        conn = self._makeOne(response_format='json')
+        posted = []
+
+        def _post(url, body, headers):
+            posted.append(body)
+            return DummyHTTPResponse(_JSON_RESPONSE)
+        conn._post = _post
+        response = conn.query('*:*', fields='docid')
+        self.assertEqual(len(response), 2)
+        self.assert_('wt=json' in posted[0])
+        self.assert_('json.nl=map' in posted[0])
+
+    def test_query_response_format_override(self):
+        conn = self._makeOne(response_format='json')
+        posted = []
+
+        def _post(url, body, headers):
+            posted.append(body)
+            return DummyHTTPResponse(_XML_RESPONSE)
+        conn._post = _post
+        response = conn.query('*:*', fields='docid', response_format='xml')
+        self.assertEqual(len(response), 2)
+        self.assert_('wt=standard' in posted[0])
+
+    def test_query_params_sort(self):
+        conn = self._makeOne()
+        params, fmt = conn._query_params(
+            '*:*', 'docid', None, False, ['a', 'b'], 'desc', None, {})
+        self.assertEqual(params['sort'], 'a,b desc')
+
+    def test_query_params_sort_order_per_field(self):
+        conn = self._makeOne()
+        params, fmt = conn._query_params(
+            '*:*', 'docid', None, False, ['a', 'b'], ['desc', 'asc'],
+            None, {})
+        self.assertEqual(params['sort'], 'a desc,b asc')
+        self.assertRaises(
+            ValueError, conn._query_params, '*:*', 'docid', None, False,
+            ['a', 'b'], ['desc'], None, {})
+        self.assertRaises(
+            ValueError, conn._query_params, '*:*', 'docid', None, False,
+            ['a'], ['up'], None, {})
+
+    def test_batch_with_several_commands(self):
+        conn = self._makeOne()
+        posted = []
+
+        def _post(url, body, headers):
+            posted.append(body)
+            return DummyHTTPResponse('<response/>')
+        conn._post = _post
+        conn.begin_batch()
+        conn.add_many([{'docid': 1}])
+        conn.delete(2)
+        self.assertEqual(posted, [])
+        conn.end_batch()
+        self.assertEqual(posted, [
+            '<update><add><doc><field name="docid">1</field></doc></add>'
+            '<delete><id>2</id></delete></update>'])
+
+    def test_batch_with_one_command(self):
+        conn = self._makeOne()
+        posted = []
+
+        def _post(url, body, headers):
+            posted.append(body)
+            return DummyHTTPResponse('<response/>')
+        conn._post = _post
+        conn.begin_batch()
+        conn.delete(2)
+        conn.end_batch()
+        self.assertEqual(posted, ['<delete><id>2</id></delete>'])
+
+    def _posted(self, conn):
+        posted = []
+
+        def _post(url, body, headers):
+            posted.append(body)
+            return DummyHTTPResponse('<response/>')
+        conn._post = _post
+        return posted
+
+    def test_commit_options(self):
+        conn = self._makeOne()
+        posted = self._posted(conn)
+        conn.commit()
+        conn.commit(wait_searcher=False)
+        conn.commit(wait_flush=False, wait_searcher=False, soft_commit=True)
+        self.assertEqual(posted, [
+            '<commit />',
+            '<commit waitSearcher="false"/>',
+            '<commit waitFlush="false" waitSearcher="false" '
+            'softCommit="true"/>',
+            ])
+
+    def test_commit_within(self):
+        conn = self._makeOne()
+        posted = self._posted(conn)
+        conn.add_many([{'docid': 1}], commit_within=500)
+        conn.delete(2, commit_within=500)
+        conn.delete_query('*:*', commit_within=500)
+        self.assertEqual(posted, [
+            '<add commitWithin="500"><doc><field name="docid">1</field>'
+            '</doc></add>',
+            '<delete commitWithin="500"><id>2</id></delete>',
+            '<delete commitWithin="500"><query>*:*</query></delete>',
+            ])
+
+    def test_unknown_update_format(self):
+        self.assertRaises(ValueError, self._makeOne, update_format='csv')
+
+    def _postedJSON(self, conn):
+        posted = []
+
+        def _post(url, body, headers):
+            self.assertEqual(url, '/solr/update/json')
+            self.assertEqual(headers['Content-Type'],
+                             'application/json; charset=utf-8')
+            self.assertTrue(isinstance(body, str))
+            posted.append(_parse_json_update(body))
+            return DummyHTTPResponse('{}')
+        conn._post = _post
+        return posted
+
+    def test_json_add_many(self):
+        import datetime
+        conn = self._makeOne(update_format='json')
+        posted = self._postedJSON(conn)
+        conn.add_many([
+            {'docid': 1, 'title': [u'\xfcber', None], 'flag': True,
+             'day': datetime.date(2009, 9, 8), 'empty': None},
+            {'docid': 2}], commit_within=500)
+        self.assertEqual(posted, [[
+            ('add', {'doc': {'docid': 1, 'title': [u'\xfcber'],
+                             'flag': 'true', 'day': '2009-09-08T00:00:00Z'},
+                     'commitWithin': 500}),
+            ('add', {'doc': {'docid': 2}, 'commitWithin': 500}),
+            ]])
+
+    def test_json_batch(self):
+        conn = self._makeOne(update_format='json')
+        posted = self._postedJSON(conn)
+        conn.begin_batch()
+        conn.add(docid=1)
+        conn.delete(2)
+        conn.delete_query('*:*', commit_within=500)
+        conn.add_many([])
+        conn.end_batch(commit=True)
+        self.assertEqual(posted, [[
+            ('add', {'doc': {'docid': 1}}),
+            ('delete', {'id': '2'}),
+            ('delete', {'query': '*:*', 'commitWithin': 500}),
+            ('commit', {}),
+            ]])
+
+    def test_json_commit_options(self):
+        conn = self._makeOne(update_format='json')
+        posted = self._postedJSON(conn)
+        conn.commit(wait_flush=False, wait_searcher=False, soft_commit=True)
+        conn.optimize()
+        self.assertEqual(posted, [
+            [('commit', {'waitFlush': False, 'waitSearcher': False,
+                         'softCommit': True})],
+            [('optimize', {})],
+            ])
+
+    def _streaming(self, conn, fail=0):
+        http = DummyStreamingHTTPConnection(fail)
+        conn.pool = DummyPool(http)
+        return http
+
+    def test_stream_add_many(self):
+        conn = self._makeOne()
+        conn.chunk_size = 100
+        http = self._streaming(conn)
+        docs = iter([{'docid': 1}, {'docid': 2}, {'title': u'\xfcber'}])
+        conn.add_many(docs, commit_within=500, stream=True)
+        self.assertEqual(http.requests, [('POST', '/solr/update')])
+        self.assertEqual(http.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(http.headers['Content-Type'],
+                         'text/xml; charset=utf-8')
+        self.assertEqual(len(http.chunks), 2)
+        self.assertEqual(
+            ''.join(http.chunks),
+            '<add commitWithin="500"><doc><field name="docid">1</field>'
+            '</doc><doc><field name="docid">2</field></doc>'
+            '<doc><field name="title">\xc3\xbcber</field></doc></add>')
+        self.assertEqual(http.sent[-1], '0\r\n\r\n')
+        self.assertEqual(conn.bytes_sent, len(''.join(http.chunks)))
+        self.assertEqual(conn.conn, None)
+
+    def test_stream_add_many_json(self):
+        conn = self._makeOne(update_format='json')
+        http = self._streaming(conn)
+        conn.add_many([{'docid': 1}, {'docid': 2}], stream=True)
+        self.assertEqual(http.requests, [('POST', '/solr/update/json')])
+        self.assertEqual(_parse_json_update(''.join(http.chunks)), [
+            ('add', {'doc': {'docid': 1}}),
+            ('add', {'doc': {'docid': 2}}),
+            ])
+
+    def test_stream_retries_list(self):
+        conn = self._makeOne()
+        http = self._streaming(conn, fail=1)
+        conn.add_many([{'docid': 1}], stream=True)
+        self.assertEqual(len(http.requests), 2)
+        self.assertEqual(conn.reconnects, 1)
+
+    def test_stream_does_not_retry_iterator(self):
+        import socket
+        conn = self._makeOne()
+        self._streaming(conn, fail=1)
+        self.assertRaises(socket.error, conn.add_many,
+                          iter([{'docid': 1}]), stream=True)
+        self.assertEqual(conn.conn, None)
+
+    def test_stream_in_batch_is_queued(self):
+        conn = self._makeOne()
+        posted = self._posted(conn)
+        conn.begin_batch()
+        conn.add_many([{'docid': 1}], stream=True)
+        conn.end_batch()
+        self.assertEqual(posted, [
+            '<add><doc><field name="docid">1</field></doc></add>'])
+
+
+    def test_serialize_doc(self):
+        from alm.solrindex.solrpycore import serialize_doc
+        self.assertEqual(
+            serialize_doc({'title': [u'\xfcber', None]}),
+            '<doc><field name="title">\xc3\xbcber</field></doc>')
+        self.assertEqual(
+            serialize_doc({'docid': 1}, 'json', commit_within=500),
+            '"add":{"doc":{"docid":1},"commitWithin":500}')
+
+    def test_add_serialized(self):
+        from alm.solrindex.solrpycore import serialize_doc
+        conn = self._makeOne(update_format='json')
+        http = self._streaming(conn, fail=1)
+        conn.add_serialized([serialize_doc({'docid': 1}, 'json'),
+                             serialize_doc({'docid': 2}, 'json')])
+        # Lists are sent again after a connection error.
+        self.assertEqual(len(http.requests), 2)
+        self.assertEqual(_parse_json_update(http.body()), [
+            ('add', {'doc': {'docid': 1}}),
+            ('add', {'doc': {'docid': 2}}),
+            ])
+
+    def test_stream_gzip(self):
+        conn = self._makeOne(gzip_min_size=1)
+        http = self._streaming(conn)
+        docs = [{'docid': i, 'title': u'gzip ' * 20} for i in range(50)]
+        conn.add_many(docs, stream=True)
+        self.assertEqual(http.headers['Content-Encoding'], 'gzip')
+        body = http.body()
+        self.assertTrue(body.startswith('<add><doc>'))
+        self.assertEqual(conn.bytes_sent, len(''.join(http.chunks)))
+        self.assertEqual(conn.request_bytes_saved,
+                         len(body) - conn.bytes_sent)
+
+    def test_accept_gzip(self):
+        conn = self._makeOne()
+        self.assertEqual(conn.form_headers['Accept-Encoding'], 'gzip')
+        self.assertEqual(conn.xmlheaders['Accept-Encoding'], 'gzip')
+        conn = self._makeOne(accept_gzip=False)
+        self.assertFalse('Accept-Encoding' in conn.form_headers)
+
+    def _gzipHTTP(self, conn, data):
+        from alm.solrindex.solrpycore import gzip_compress
+        http = GzipHTTPConnection(gzip_compress(data))
+        conn.pool = DummyPool(http)
+        return http
+
+    def test_gzip_request_over_min_size(self):
+        import zlib
+        conn = self._makeOne(gzip_min_size=100)
+        http = self._gzipHTTP(conn, '<response/>')
+        conn.raw_query(q='x')
+        self.assertFalse('Content-Encoding' in http.sent_headers)
+        conn.raw_query(q='x' * 200)
+        self.assertEqual(http.sent_headers['Content-Encoding'], 'gzip')
+        body = zlib.decompress(http.sent_body, 16 + zlib.MAX_WBITS)
+        self.assertEqual(body, 'q=' + 'x' * 200)
+        self.assertEqual(conn.request_bytes_saved,
+                         len(body) - len(http.sent_body))
+        self.assertEqual(conn.pool.request_bytes_saved,
+                         conn.request_bytes_saved)
+
+    def test_gzip_request_disabled(self):
+        conn = self._makeOne(gzip_min_size=0)
+        http = self._gzipHTTP(conn, '<response/>')
+        conn.raw_query(q='x' * 200)
+        self.assertFalse('Content-Encoding' in http.sent_headers)
+        self.assertEqual(conn.request_bytes_saved, 0)
+
+    def test_gzip_raw_query_response(self):
+        data = '<response>%s</response>' % ('<str>x</str>' * 100)
+        conn = self._makeOne()
+        http = self._gzipHTTP(conn, data)
+        self.assertEqual(conn.raw_query(q='x'), data)
+        self.assertEqual(conn.response_bytes_saved,
+                         len(data) - len(http.compressed))
+        self.assertEqual(conn.pool.response_bytes_saved,
+                         conn.response_bytes_saved)
+
+    def test_gzip_query_ids_response(self):
+        from alm.solrindex.solrpycore import GzipResponse
+        conn = self._makeOne()
+        self._gzipHTTP(conn, _XML_RESPONSE)
+        chunk_size = GzipResponse.chunk_size
+        GzipResponse.chunk_size = 10
+        try:
+            result = {}
+            response = conn.query_ids('*:*', 'docid', result)
+        finally:
+            GzipResponse.chunk_size = chunk_size
+        self.assertEqual(sorted(result.keys()), [5, 7])
+        self.assertEqual(response.numFound, u'12')
+        self.assertTrue(conn.response_bytes_saved)
+
+    def test_gzip_error_response(self):
+        from alm.solrindex.solrpycore import SolrException
+        conn = self._makeOne()
+        http = self._gzipHTTP(conn, 'broken')
+        http.status = 500
+        try:
+            conn.raw_query(q='x')
+        except SolrException, e:
+            self.assertEqual(e.body, 'broken')
+        else:
+            self.fail('no SolrException')
+
+
+def _parse_json_update(body):
+    """Parse a JSON update request into a list of (command, dict)"""
+    import json
+    commands = []
+    for name, value in json.loads(body, object_pairs_hook=lambda p: p):
+        value = dict(value)
+        if 'doc' in value:
+            value['doc'] = dict(value['doc'])
+        commands.append((name, value))
+    return commands
+
+
+class ParseResponseTests(unittest.TestCase):
+
+    def _parse_xml(self):
+        from alm.solrindex.solrpycore import parse_query_response
+        return parse_query_response(_XML_RESPONSE, params={}, connection=None)
+
+    def _parse_json(self):
+        from alm.solrindex.solrpycore import parse_json_response
+        return parse_json_response(_JSON_RESPONSE, params={}, connection=None)
+
+    def _check(self, response):
+        from alm.solrindex.solrpycore import Results
+        self.assertEqual(response.header['QTime'], 3)
+        self.assertEqual(response.header['params'], {'q': u'*:*'})
+        self.assert_(isinstance(response.results, Results))
+        self.assertEqual(list(response), [
+            {'score': 1.5, 'docid': 5},
+            {'score': 0.25, 'docid': 7, 'Subject': [u'a', u'\xfc']},
+            ])
+        self.assertEqual(response.numFound, u'12')
+        self.assertEqual(response.results.numFound, u'12')
+        self.assertEqual(response.results.start, u'0')
+        self.assertEqual(response.maxScore, u'1.5')
+        self.assertEqual(response.highlighting,
+                         {u'5': {u'Title': [u'<em>x</em>']}})
+
+    def test_xml(self):
+        self._check(self._parse_xml())
+
+    def test_json(self):
+        self._check(self._parse_json())
+
+    def test_javabin(self):
+        from alm.solrindex.solrpycore import parse_javabin_response
+        self._check(parse_javabin_response(
+            _JAVABIN_RESPONSE, params={}, connection=None))
+
+
+class JavaBinDecoderTests(unittest.TestCase):
+
+    def _decode(self, data):
+        from alm.solrindex.solrpycore import JavaBinDecoder
+        return JavaBinDecoder('\x02' + data).decode()
+
+    def test_scalars(self):
+        self.assertEqual(self._decode('\x00'), None)
+        self.assertEqual(self._decode('\x01'), True)
+        self.assertEqual(self._decode('\x02'), False)
+        self.assertEqual(self._decode('\x03\xff'), -1)
+        self.assertEqual(self._decode('\x04\x01\x00'), 256)
+        self.assertEqual(self._decode('\x06\xff\xff\xff\xfe'), -2)
+        self.assertEqual(self._decode('\x07' + '\x00' * 7 + '\x09'), 9)
+        self.assertEqual(self._decode(_jb_float(0.5)), 0.5)
+
+    def test_small_int_with_vint(self):
+        self.assertEqual(self._decode(_jb_sint(1000)), 1000)
+
+    def test_long_string(self):
+        s = u'x' * 1000
+        self.assertEqual(self._decode(_jb_str(s)), s)
+
+    def test_date(self):
+        import datetime
+        from alm.solrindex.solrpycore import utc
+        ms = 1234567890123
+        value = self._decode('\x09' + __import__('struct').pack('>q', ms))
+        self.assertEqual(value, datetime.datetime(
+            2009, 2, 13, 23, 31, 30, 123000, utc))
+
+    def test_iterator_and_map(self):
+        self.assertEqual(
+            self._decode('\x0e' + _jb_sint(1) + _jb_sint(2) + '\x0f'),
+            [1, 2])
+        self.assertEqual(
+            self._decode('\x0a' + _vint(1) + _jb_str(u'k') + _jb_sint(1)),
+            {u'k': 1})
+
+    def test_unsupported_version(self):
+        from alm.solrindex.solrpycore import JavaBinDecoder
+        from alm.solrindex.solrpycore import SolrException
+        self.assertRaises(
+            SolrException, JavaBinDecoder('\x01\x00').decode)
+
+
+class ParseIdResponseTests(unittest.TestCase):
+
+    def _check(self, response, result):
+        self.assertEqual(result, {5: 1500, 7: 250})
+        self.assertEqual(len(response), 0)
+        self.assertEqual(response.header['QTime'], 3)
+        self.assertEqual(response.header['params'], {'q': u'*:*'})
+        self.assertEqual(response.numFound, u'12')
+        self.assertEqual(response.maxScore, u'1.5')
+        self.assertEqual(response.highlighting,
+                         {u'5': {u'Title': [u'<em>x</em>']}})
+
+    def test_xml_string(self):
+        from alm.solrindex.solrpycore import parse_id_response
+        result = {}
+        response = parse_id_response(_XML_RESPONSE, 'docid', result)
+        self._check(response, result)
+
+    def test_xml_stream(self):
+        from alm.solrindex.solrpycore import parse_id_response
+        result = {}
+        response = parse_id_response(
+            DummyHTTPResponse(_XML_RESPONSE), 'docid', result, chunk_size=7)
+        self._check(response, result)
+
+    def test_xml_without_score(self):
+        from alm.solrindex.solrpycore import parse_id_response
+        result = {}
+        parse_id_response(
+            '<response><result name="response" numFound="1" start="0">'
+            '<doc><int name="docid">3</int></doc></result></response>',
+            'docid', result)
+        self.assertEqual(result, {3: 0})
+
+    def test_next_cursor_mark(self):
+        from alm.solrindex.solrpycore import parse_id_response
+        from alm.solrindex.solrpycore import parse_json_id_response
+        response = parse_id_response(
+            '<response><result name="response" numFound="1" start="0">'
+            '<doc><int name="docid">3</int></doc></result>'
+            '<str name="nextCursorMark">AoE/</str></response>',
+            'docid', {})
+        self.assertEqual(response.nextCursorMark, u'AoE/')
+        response = parse_json_id_response(
+            '{"response": {"numFound": 1, "start": 0, "docs": '
+            '[{"docid": 3}]}, "nextCursorMark": "AoE/"}', 'docid', {})
+        self.assertEqual(response.nextCursorMark, u'AoE/')
+
+    def test_xml_unknown_response(self):
+        from alm.solrindex.solrpycore import parse_id_response
+        from alm.solrindex.solrpycore import SolrException
+        self.assertRaises(SolrException, parse_id_response,
+                          '<html></html>', 'docid', {})
+
+    def test_json(self):
+        from alm.solrindex.solrpycore import parse_json_id_response
+        result = {}
+        response = parse_json_id_response(_JSON_RESPONSE, 'docid', result)
+        self._check(response, result)
+
+    def test_javabin(self):
+        from alm.solrindex.solrpycore import parse_javabin_id_response
+        result = {}
+        response = parse_javabin_id_response(
+            _JAVABIN_RESPONSE, 'docid', result)
+        self._check(response, result)
+
+    def test_query_ids(self):
+        from alm.solrindex.solrpycore import SolrConnection
+        conn = SolrConnection('http://localhost:8983/solr')
+        posted = []
+
+        def _post(url, body, headers):
+            posted.append(body)
+            return DummyHTTPResponse(_XML_RESPONSE)
+        conn._post = _post
+        result = {}
+        response = conn.query_ids('*:*', 'docid', result)
+        self._check(response, result)
+        self.assert_('fl=docid%2Cscore' in posted[0])
+
+
+class HTTPConnectionPoolTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from alm.solrindex.solrpycore import HTTPConnectionPool
+        return HTTPConnectionPool
+
+    def _makeOne(self, max_size=2, idle_timeout=60, wait_timeout=0.01):
+        return self._getTargetClass()(
+            DummyHTTPConnection, max_size=max_size,
+            idle_timeout=idle_timeout, wait_timeout=wait_timeout)
+
+    def test_reuse(self):
+        pool = self._makeOne()
+        conn = pool.get()
+        pool.put(conn)
+        self.assert_(pool.get() is conn)
+        stats = pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 0)
+
+    def test_put_without_reuse_closes(self):
+        pool = self._makeOne()
+        conn = pool.get()
+        pool.put(conn, reuse=False)
+        self.assert_(conn.closed)
+        self.assertFalse(pool.get() is conn)
+        self.assertEqual(pool.stats()['closed'], 1)
+
+    def test_max_size(self):
+        from alm.solrindex.solrpycore import PoolTimeout
+        pool = self._makeOne()
+        pool.get()
+        pool.get()
+        self.assertRaises(PoolTimeout, pool.get)
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['peak_in_use'], 2)
+
+    def test_get_waits_for_put(self):
+        import threading
+        pool = self._makeOne(max_size=1, wait_timeout=10)
+        conn = pool.get()
+        timer = threading.Timer(0.01, pool.put, (conn,))
+        timer.start()
+        self.assert_(pool.get() is conn)
+        timer.join()
+        self.assertEqual(pool.stats()['waits'], 1)
+
+    def test_idle_eviction(self):
+        pool = self._makeOne(idle_timeout=-1)
+        conn = pool.get()
+        pool.put(conn)
+        self.assert_(conn.closed)
+        self.assertEqual(pool.stats()['evicted'], 1)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_solr_connections_share_pool(self):
+        from alm.solrindex.solrpycore import SolrConnection
+        conn1 = SolrConnection('http://localhost:8983/solr')
+        conn2 = SolrConnection('http://localhost:8983/solr/')
+        self.assert_(conn1.pool is conn2.pool)
+        conn3 = SolrConnection('http://otherhost:8983/solr')
+        self.assertFalse(conn1.pool is conn3.pool)
+
+    def test_pool_does_not_keep_solr_connection(self):
+        import gc
+        import weakref
+        from alm.solrindex.solrpycore import SolrConnection
+        conn = SolrConnection('http://pooltest:8983/solr', timeout=5)
+        pool = conn.pool
+        ref = weakref.ref(conn)
+        del conn
+        gc.collect()
+        self.assertEqual(ref(), None)
+        http = pool.factory()
+        self.assertEqual((http.host, http.port, http.timeout),
+                         ('pooltest', 8983, 5))
+
+    def test_solr_connection_returns_http_connection(self):
+        from alm.solrindex.solrpycore import SolrConnection
+        pool = self._makeOne()
+        conn = SolrConnection('http://localhost:8983/solr')
+        conn.pool = pool
+        conn.raw_query(q='*:*')
+        conn.raw_query(q='*:*')
+        stats = pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(conn.conn, None)
+
+    def test_unread_response_is_not_reused(self):
+        from alm.solrindex.solrpycore import SolrConnection
+        pool = self._makeOne()
+        conn = SolrConnection('http://localhost:8983/solr')
+        conn.pool = pool
+        conn._post('/solr/select', u'q=*:*', {})
+        conn.close()
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertEqual(pool.stats()['closed'], 1)
+
+    def test_not_persistent(self):
+        from alm.solrindex.solrpycore import SolrConnection
+        pool = self._makeOne()
+        conn = SolrConnection('http://localhost:8983/solr', persistent=False)
+        conn.pool = pool
+        conn.raw_query(q='*:*')
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertEqual(pool.stats()['closed'], 1)
+
+
+class DummyHTTPConnection:
+
+    closed = False
+
+    def request(self, method, url, body, headers):
+        self.closed = False
+
+    def getresponse(self):
+        return DummyHTTPResponse(_XML_RESPONSE)
+
+    def connect(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class DummyStreamingHTTPConnection(DummyHTTPConnection):
+
+    def __init__(self, fail=0):
+        self.fail = fail
+        self.requests = []
+        self.headers = {}
+        self.sent = []
+        self.chunks = []
+
+    def putrequest(self, method, url, skip_accept_encoding=False):
+        self.requests.append((method, url))
+        self.sent = []
+        self.chunks = []
+
+    def putheader(self, name, value):
+        self.headers[name] = value
+
+    def body(self):
+        data = ''.join(self.chunks)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            import zlib
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+    def endheaders(self):
+        pass
+
+    def send(self, data):
+        self.sent.append(data)
+        size, rest = data.split('\r\n', 1)
+        if int(size, 16):
+            self.chunks.append(rest[:-2])
+
+    def getresponse(self):
+        if self.fail:
+            import socket
+            self.fail -= 1
+            raise socket.error('connection reset')
+        return DummyHTTPResponse('<response/>')
+
+
+class GzipHTTPConnection(DummyHTTPConnection):
+
+    status = 200
+
+    def __init__(self, compressed):
+        self.compressed = compressed
+
+    def request(self, method, url, body, headers):
+        self.sent_body = body
+        self.sent_headers = headers
+
+    def getresponse(self):
+        response = DummyHTTPResponse(
+            self.compressed, {'content-encoding': 'gzip'})
+        response.status = self.status
+        return response
+
+
+class DummyPool:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self):
+        return self.conn
+
+    request_bytes_saved = 0
+    response_bytes_saved = 0
+
+    def put(self, conn, reuse):
+        pass
+
+    def count_bytes_saved(self, request, response):
+        self.request_bytes_saved += request
+        self.response_bytes_saved += response
+
+
+class DummyHTTPResponse:
+
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, data, headers={}):
+        self.data = data
+        self.headers = headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def isclosed(self):
+        return not self.data
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data)
+        data = self.data[:size]
+        self.data = self.data[size:]
+        return data
@@ -0,0 +1,62 @@
+import unittest
+
+
+class TranscoderTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from alm.solrindex.transcode import Transcoder
+        return Transcoder
+
+    def _makeOne(self, encodings=('utf-8',)):
+        return self._getTargetClass()(encodings)
+
+    def test_decode_ascii(self):
+        t = self._makeOne()
+        self.assertTrue(t.ascii_first)
+        self.assertEqual(t.decode('abc'), u'abc')
+        self.assertTrue(isinstance(t.decode('abc'), unicode))
+
+    def test_decode_unicode(self):
+        t = self._makeOne()
+        self.assertEqual(t.decode(u'\xfcber'), u'\xfcber')
+
+    def test_decode_last_encoding_that_works(self):
+        t = self._makeOne(('latin-1', 'utf-8'))
+        self.assertEqual(t.decode('\xc3\xbcber'), u'\xfcber')
+        self.assertEqual(t.decode('\xfcber'), u'\xfcber')
+
+    def test_decode_first_encoding_is_tried_last(self):
+        t = self._makeOne(('utf-8', 'latin-1'))
+        self.assertEqual(t.decode('\xc3\xbcber'), u'\xc3\xbcber')
+
+    def test_decode_fallback(self):
+        t = self._makeOne()
+        self.assertEqual(t.decode('caf\xe9'), u'caf\ufffd')
+
+    def test_no_ascii_shortcut_for_other_encodings(self):
+        t = self._makeOne(('utf-8', 'utf-16'))
+        self.assertFalse(t.ascii_first)
+
+    def test_encode(self):
+        t = self._makeOne(('latin-1', 'utf-8'))
+        utf8 = '\xc3\xbcber'
+        self.assertTrue(t.encode(utf8) is utf8)
+        self.assertEqual(t.encode('\xfcber'), utf8)
+        self.assertEqual(t.encode(u'\xfcber'), utf8)
+        self.assertEqual(t.encode('abc'), 'abc')
+
+    def test_transcode_params(self):
+        t = self._makeOne(('latin-1', 'utf-8'))
+        params = {'q': u'\xfcber', 'fq': ['\xfcber', u'', 5], 'rows': 10}
+        self.assertEqual(t.transcode_params(params), {
+            'q': '\xc3\xbcber', 'fq': ['\xc3\xbcber', '', 5], 'rows': 10})
+        self.assertTrue(isinstance(t.transcode_params(params)['fq'][1], str))
+
+
+class GetTranscoderTests(unittest.TestCase):
+
+    def test_shared(self):
+        from alm.solrindex.transcode import get_transcoder
+        t = get_transcoder(['utf-8', 'latin-1'])
+        self.assertTrue(get_transcoder(('utf-8', 'latin-1')) is t)
+        self.assertFalse(get_transcoder(['utf-8']) is t)
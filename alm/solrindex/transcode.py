@@ -0,0 +1,111 @@
+
+"""Decoding of query and attribute strings with the expected encodings"""
+
+import codecs
+
+_ascii_bytes = ''.join([chr(i) for i in range(128)])
+
+
+def _decodes_ascii(encoding):
+    """Does encoding decode ASCII bytes to the same characters?"""
+    try:
+        return _ascii_bytes.decode(encoding) == unicode(_ascii_bytes)
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+
+class Transcoder(object):
+    """Decodes byte strings with the last of a list of encodings that
+    works, falling back to UTF-8 with replacement characters.
+
+    Encodings are tried from the end of the list, so an encoding that
+    decodes any string, such as latin-1, can come before UTF-8. ASCII
+    strings are passed through when the last encoding is a superset
+    of ASCII.
+    """
+
+    def __init__(self, encodings):
+        self.encodings = tuple(encodings)
+        self.ascii_first = bool(self.encodings) and _decodes_ascii(
+            self.encodings[-1])
+        self.utf8_names = set()
+        for encoding in self.encodings:
+            try:
+                if codecs.lookup(encoding).name == 'utf-8':
+                    self.utf8_names.add(encoding)
+            except LookupError:
+                pass
+
+    def _choose(self, val):
+        """Return (encoding, decoded value) for a byte string"""
+        # Not cached: a hit would still have to decode val, and the
+        # usual last encoding, UTF-8, works on the first try.
+        for encoding in reversed(self.encodings):
+            try:
+                return encoding, val.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+        # Our escape hatch; if none of the expected encodings
+        # work, we fall back to UTF8 and replace characters
+        return None, val.decode('utf-8', 'replace')
+
+    def decode(self, val):
+        """Return val as unicode"""
+        if isinstance(val, unicode):
+            return val
+        if self.ascii_first:
+            try:
+                return val.decode('ascii')
+            except UnicodeDecodeError:
+                pass
+        return self._choose(val)[1]
+
+    def encode(self, val):
+        """Return val as a UTF-8 byte string"""
+        if isinstance(val, unicode):
+            # We don't want to raise a UnicodeEncodeError here
+            return val.encode('utf-8', 'replace')
+        if self.ascii_first:
+            try:
+                val.decode('ascii')
+                return val
+            except UnicodeDecodeError:
+                pass
+        encoding, decoded = self._choose(val)
+        if encoding in self.utf8_names:
+            # Already valid UTF-8
+            return val
+        return decoded.encode('utf-8', 'replace')
+
+    def transcode_params(self, params):
+        """Return a copy of Solr params with all strings in UTF-8"""
+        encode = self.encode
+        transcoded_params = {}
+        for key, val in params.items():
+            if isinstance(val, basestring):
+                val = encode(val)
+            elif isinstance(val, list):
+                val = [encode(v) if isinstance(v, basestring) else v
+                       for v in val]
+            transcoded_params[key] = val
+        return transcoded_params
+
+
+_transcoders = {}
+
+
+def get_transcoder(encodings):
+    """Return the process-wide Transcoder for a list of encodings"""
+    key = tuple(encodings)
+    transcoder = _transcoders.get(key)
+    if transcoder is None:
+        transcoder = _transcoders[key] = Transcoder(key)
+    return transcoder
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(_transcoders.clear)
@@ -58,5 +58,7 @@ setup(
 
     [console_scripts]
     waituri = alm.solrindex.scripts.waituri:main
+    solr_codecbench = alm.solrindex.scripts.codecbench:main
+    solr_reindex = alm.solrindex.scripts.reindex:main
     """,
 )